@@ -1,13 +1,23 @@
 import json
-import gzip
 import dataclasses
 import datetime
+import os
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-from typing import List, Dict, Set
+from itertools import accumulate
+from operator import sub
+from threading import Thread, Lock, Event
+from typing import TYPE_CHECKING, List, Dict, Set, Optional
+
+if TYPE_CHECKING:
+    from storage import ActivityStorage  # storage.py imports this module
 
 
 class EnhancedJSONEncoder(json.JSONEncoder):
     def default(self, o):
+        if isinstance(o, TimeRangeList):
+            return o.to_dicts()
         if dataclasses.is_dataclass(o):
             return dataclasses.asdict(o)
         if isinstance(o, datetime.datetime):
@@ -23,6 +33,41 @@ def ensure_datetime(dt):
         return dt
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def datetime_to_micros(dt: datetime.datetime) -> int:
+    return (dt - EPOCH) // MICROSECOND
+
+
+def micros_to_datetime(micros: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def write_file_atomically(path, content: bytes):
+    """Writes content to a temporary file, fsyncs it and renames it over path."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _int64_array(view: memoryview) -> array:
+    copy = array("q")
+    copy.frombytes(view.cast("B"))
+    return copy
+
+
+def _durations_before(starts, ends) -> array:
+    """Total duration of ranges before each range - TimeRangeList.cumulative."""
+    if not starts:
+        return array("q")
+    return array("q", accumulate(map(sub, ends[:-1], starts[:-1]), initial=0))
+
+
 @dataclasses.dataclass
 class DateTimeRange:
     start: datetime.datetime
@@ -36,52 +81,250 @@ class DateTimeRange:
         return f"[{self.start.isoformat()}, {self.end.isoformat()}]"
 
 
+class TimeRangeList:
+    """
+    Activity ranges of one user kept as two int64 arrays of epoch microseconds.
+    Behaves like a read-only list of DateTimeRange - the objects are created on access,
+    so modify ranges only through append and set_last_end.
+
+    Ranges are appended in chronological order and never overlap, so both starts and
+    ends are sorted and can be searched with bisect. `cumulative[i]` holds the total
+    duration of ranges before i, which makes duration queries logarithmic too.
+
+    The arrays may also be read-only memoryviews of a memory-mapped file (see columnar.py),
+    which are copied into arrays before the first change. cumulative is not stored there,
+    it is computed when first needed.
+    """
+
+    __slots__ = ("starts", "ends", "cumulative")
+
+    def __init__(self, ranges=()):
+        self.starts = array("q")
+        self.ends = array("q")
+        self.cumulative = array("q")
+        for dt_range in ranges:
+            self.append(dt_range)
+
+    @classmethod
+    def wrap(cls, starts, ends, cumulative=None) -> "TimeRangeList":
+        """Uses given int64 sequences without copying them."""
+        ranges = cls()
+        ranges.starts, ranges.ends, ranges.cumulative = starts, ends, cumulative
+        return ranges
+
+    def _ensure_cumulative(self):
+        if self.cumulative is None:
+            self.cumulative = _durations_before(self.starts, self.ends)
+
+    def _make_writable(self):
+        if not isinstance(self.starts, array):
+            self.starts, self.ends = _int64_array(self.starts), _int64_array(self.ends)
+        if not isinstance(self.cumulative, array):
+            self.cumulative = (
+                _durations_before(self.starts, self.ends) if self.cumulative is None else _int64_array(self.cumulative)
+            )
+
+    def append(self, dt_range: DateTimeRange):
+        self.append_micros(datetime_to_micros(dt_range.start), datetime_to_micros(dt_range.end))
+
+    def append_micros(self, start: int, end: int):
+        self._make_writable()
+        if self.starts:
+            self.cumulative.append(self.cumulative[-1] + self.ends[-1] - self.starts[-1])
+        else:
+            self.cumulative.append(0)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def set_last_end(self, dt: datetime.datetime):
+        end = datetime_to_micros(dt)
+        assert self.starts[-1] <= end
+        self._make_writable()
+        self.ends[-1] = end
+
+    def is_active_at(self, micros: int) -> bool:
+        index = bisect_right(self.starts, micros) - 1
+        return index >= 0 and self.ends[index] >= micros
+
+    def overlapping_slice(self, start: int, end: int) -> slice:
+        """Returns slice of ranges that overlap with [start, end]."""
+        return slice(bisect_left(self.ends, start), bisect_right(self.starts, end))
+
+    def duration_between(self, start: int, end: int) -> int:
+        """Returns microseconds of activity within [start, end]."""
+        overlapping = self.overlapping_slice(start, end)
+        first, last = overlapping.start, overlapping.stop - 1
+        if first > last:
+            return 0
+        self._ensure_cumulative()
+        total = self.cumulative[last] + self.ends[last] - self.starts[last] - self.cumulative[first]
+        total -= max(0, start - self.starts[first])
+        total -= max(0, self.ends[last] - end)
+        return total
+
+    def copy(self) -> "TimeRangeList":
+        ranges = TimeRangeList()
+        ranges.starts = self.starts[:]
+        ranges.ends = self.ends[:]
+        ranges.cumulative = None if self.cumulative is None else self.cumulative[:]
+        return ranges
+
+    def drop_first(self, count: int):
+        """Removes `count` oldest ranges. cumulative keeps its offset, only differences matter."""
+        self.starts = self.starts[count:]
+        self.ends = self.ends[count:]
+        if self.cumulative is not None:
+            self.cumulative = self.cumulative[count:]
+
+    def to_dicts(self):
+        return [
+            {
+                "start": micros_to_datetime(start).isoformat(),
+                "end": micros_to_datetime(end).isoformat(),
+            }
+            for start, end in zip(self.starts, self.ends)
+        ]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return DateTimeRange(micros_to_datetime(self.starts[index]), micros_to_datetime(self.ends[index]))
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield DateTimeRange(micros_to_datetime(start), micros_to_datetime(end))
+
+    def __eq__(self, other):
+        if isinstance(other, TimeRangeList):
+            return self.starts == other.starts and self.ends == other.ends
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+DAY = "day"
+HOUR = "hour"
+_BUCKET_MICROS = {DAY: 24 * 3600 * 10**6, HOUR: 3600 * 10**6}
+_BUCKET_KEY_FORMAT = {DAY: "%Y-%m-%d", HOUR: "%Y-%m-%dT%H"}
+
+
+@dataclasses.dataclass
+class Compaction:
+    """Result of ActivityTracker.prepare_compaction, applied by apply_compaction."""
+    cutoff: datetime.datetime
+    user_to_dropped_count: Dict[str, int]
+    user_to_bucket_seconds: Dict[str, Dict[str, int]]
+
+
+def split_into_buckets(start: int, end: int, resolution: str) -> Dict[str, int]:
+    """Returns microseconds of [start, end] falling into each day or hour bucket."""
+    bucket_micros = _BUCKET_MICROS[resolution]
+    key_format = _BUCKET_KEY_FORMAT[resolution]
+    bucket_to_micros = {}
+    while start < end:
+        bucket_start = start - start % bucket_micros
+        part_end = min(end, bucket_start + bucket_micros)
+        key = micros_to_datetime(bucket_start).strftime(key_format)
+        bucket_to_micros[key] = bucket_to_micros.get(key, 0) + part_end - start
+        start = part_end
+    return bucket_to_micros
+
+
 class ActivityTracker:
     STORAGE_FILE = "activeusers_storage.json"
+    JOURNAL_FILE = "activeusers_storage.journal"
+
+    def __init__(
+        self,
+        read_status_from_file=True,
+        retention_days: Optional[int] = None,
+        aggregate_resolution=DAY,
+        storage: Optional["ActivityStorage"] = None,
+    ):
+        """
+        Every save is handed to `storage` (see storage.py), by default a JsonFileStorage
+        writing the whole history to STORAGE_FILE.
 
-    def __init__(self, read_status_from_file=True):
+        With `retention_days` set, compaction replaces ranges older than that with
+        per-user totals of active seconds per day or hour (`aggregate_resolution`),
+        kept in `user_to_activity_totals`.
+        """
+        if storage is None:
+            from storage import JsonFileStorage  # storage.py imports this module
+
+            storage = JsonFileStorage()
         self.active_users: Set[str] = set()
-        self.user_to_time_ranges: Dict[str, List[DateTimeRange]] = defaultdict(list)
+        self.user_to_time_ranges: Dict[str, TimeRangeList] = defaultdict(TimeRangeList)
+        self.user_to_activity_totals: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.retention_days = retention_days
+        self.aggregate_resolution = aggregate_resolution
+        self._journal_seq = 0
+        # set by ActivityPersister - file storages then only mark state dirty and it writes in background
+        self.persister: Optional["ActivityPersister"] = None
+        self.storage = storage
         if read_status_from_file:
             self.read_activity_status_from_file(ignore_error=True)
 
     def save_activity_status(
         self, active_users: Set[str], inactive_users: Set[str], dt: datetime.datetime
     ):
+        opened, extended, closed = self._apply_transitions(active_users, inactive_users, dt)
+        self.storage.record_transitions(self, dt, opened, extended, closed)
+
+    def _apply_transitions(self, active_users, inactive_users, dt):
+        opened, extended, closed = [], [], []
         for user in active_users:
             if user in self.active_users:
                 self._prolong_last_activity(user, dt)
+                extended.append(user)
             else:
                 self._add_new_activity(user, dt)
+                opened.append(user)
 
         for user in inactive_users:
             if user in self.active_users:
                 self._prolong_last_activity(user, dt)
+                closed.append(user)
 
         self.active_users.update(active_users)
         self.active_users = self.active_users - inactive_users
-        self.store_activity_in_file()
+        return opened, extended, closed
 
-    def get_activity_status_json(self):
-        return json.dumps(
-            {
-                "active_users": list(self.active_users),
-                "user_to_time_ranges": self.user_to_time_ranges,
-                "now": datetime.datetime.now(),
-            },
-            cls=EnhancedJSONEncoder,
-        )
-
-    def restore_activity_status_from_json(self, activity_json):
-        activity_dict = json.loads(activity_json)
+    def take_snapshot(self) -> dict:
+        """Copies the state to be stored. Cheap compared to serialization: arrays are memcpy'd."""
+        return {
+            "active_users": list(self.active_users),
+            "user_to_time_ranges": {user: ranges.copy() for user, ranges in self.user_to_time_ranges.items()},
+            "user_to_activity_totals": {user: dict(totals) for user, totals in self.user_to_activity_totals.items()},
+            "journal_seq": self._journal_seq,
+        }
+
+    def _restore_activity_status_from_dict(self, activity_dict) -> datetime.datetime:
         self.active_users = set(activity_dict["active_users"])
         range_dicts_list = activity_dict["user_to_time_ranges"]
         self.user_to_time_ranges.clear()
+        fromisoformat = datetime.datetime.fromisoformat
         for user, range_list in range_dicts_list.items():
+            # straight to arrays - DateTimeRange objects would double the cost of loading
+            ranges = self.user_to_time_ranges[user]
             for range_dict in range_list:
-                dt_range = DateTimeRange(**range_dict)
-                self.user_to_time_ranges[user].append(dt_range)
-        then = datetime.datetime.fromisoformat(activity_dict["now"])
+                ranges.append_micros(
+                    datetime_to_micros(fromisoformat(range_dict["start"])),
+                    datetime_to_micros(fromisoformat(range_dict["end"])),
+                )
+        self.user_to_activity_totals.clear()
+        for user, totals in activity_dict.get("user_to_activity_totals", {}).items():
+            self.user_to_activity_totals[user] = totals
+        self._journal_seq = activity_dict.get("journal_seq", 0)
+        return datetime.datetime.fromisoformat(activity_dict["now"])
+
+    def _close_activities_after_long_pause(self, then: datetime.datetime):
         now = datetime.datetime.now()
         if then + datetime.timedelta(minutes=10) < now:
             # long pause - mark all users as offline on then
@@ -90,30 +333,82 @@ class ActivityTracker:
             )
 
     def store_activity_in_file(self):
-        content = self.get_activity_status_json()
-        with gzip.open(ActivityTracker.STORAGE_FILE, "wt") as f:
-            f.write(content)
+        """Writes the whole state to the storage now, bypassing the persister."""
+        self.storage.store(self)
 
     def read_activity_status_from_file(self, ignore_error=False):
+        """With `ignore_error` a missing file means there is no history yet. Unreadable files always raise."""
         try:
-            with gzip.open(ActivityTracker.STORAGE_FILE, "rt") as f:
-                content = f.read()
-            self.restore_activity_status_from_json(content)
-        except OSError:
+            then = self.storage.load(self)
+        except FileNotFoundError:
             if not ignore_error:
                 raise
+            return
+        if then is not None:
+            self._close_activities_after_long_pause(then)
+
+    def active_users_at(self, dt: datetime.datetime) -> Set[str]:
+        """Users active at given moment."""
+        return self.storage.active_users_at(self, dt)
+
+    def ranges_overlapping(
+        self, start: datetime.datetime, end: datetime.datetime
+    ) -> Dict[str, List[DateTimeRange]]:
+        """Activity ranges of every user that overlap with [start, end]."""
+        return self.storage.ranges_overlapping(self, start, end)
+
+    def active_duration(
+        self, user: str, start: datetime.datetime, end: datetime.datetime
+    ) -> datetime.timedelta:
+        """How long the user was active within [start, end]."""
+        return self.storage.active_duration(self, user, start, end)
+
+    def last_presence_change(self, user: str) -> Optional[datetime.datetime]:
+        """When the user last went online (if active now) or offline."""
+        ranges = self.user_to_time_ranges.get(user)
+        if not ranges:
+            return None
+        if user in self.active_users:
+            return micros_to_datetime(ranges.starts[-1])
+        return micros_to_datetime(ranges.ends[-1])
+
+    def prepare_compaction(self, now: Optional[datetime.datetime] = None) -> Optional[Compaction]:
+        """
+        Computes totals for ranges older than the retention window. File storages do not
+        modify the tracker here, so it can run without the lock that guards saves: closed
+        ranges never change and new ranges are only appended after them.
+        """
+        if self.retention_days is None:
+            return None
+        now = now or datetime.datetime.now()
+        cutoff = now - datetime.timedelta(days=self.retention_days)
+        return self.storage.compact(self, cutoff, self.aggregate_resolution)
+
+    def apply_compaction(self, compaction: Optional[Compaction]):
+        """Merges totals of compacted ranges and lets the storage drop them."""
+        if not compaction or not compaction.user_to_dropped_count:
+            return
+        for user, bucket_to_seconds in compaction.user_to_bucket_seconds.items():
+            totals = self.user_to_activity_totals[user]
+            for key, seconds in bucket_to_seconds.items():
+                totals[key] = totals.get(key, 0) + seconds
+        self.storage.apply_compaction(self, compaction)
 
     def _prolong_last_activity(self, user: str, dt: datetime.datetime):
         try:
-            last_range = self.user_to_time_ranges[user][-1]
-            last_range.end = dt
-            assert last_range.start <= last_range.end
+            self.user_to_time_ranges[user].set_last_end(dt)
         except IndexError:
             self._add_new_activity(user, dt)
 
     def _add_new_activity(self, user: str, dt: datetime.datetime):
         new_range = DateTimeRange(dt, dt)
-        self.user_to_time_ranges[user].append(new_range)
+        ranges = self.user_to_time_ranges[user]
+        ranges.append(new_range)
+        if self.storage.keeps_history and len(ranges) > 1:
+            ranges.drop_first(len(ranges) - 1)  # older ranges are in the storage
+
+    def close(self):
+        self.storage.close()
 
     def pprint(self):
         print("=================================================")
@@ -121,3 +416,72 @@ class ActivityTracker:
             print(f"User: {user}")
             for dt_range in activity_list:
                 print(f"   {dt_range}")
+
+
+class ActivityPersister(Thread):
+    """
+    Writes snapshots of a tracker with a file storage in the background. Saves only mark the state dirty; bursts
+    are coalesced into one write every `interval` seconds, or sooner once
+    `max_pending_saves` saves are waiting. `lock` must be the lock guarding the tracker.
+
+    With `wake` the thread is not started: the caller runs write_pending() every `interval`
+    seconds and `wake` is called when a write is wanted sooner.
+    """
+
+    def __init__(self, tracker: ActivityTracker, lock, interval=60, max_pending_saves=20, wake=None):
+        super().__init__(name="ActivityPersister", daemon=True)
+        self._tracker = tracker
+        self._tracker_lock = lock
+        self.interval = interval
+        self.max_pending_saves = max_pending_saves
+        self._pending_saves = 0
+        self._pending_lock = Lock()
+        self._wake_event = Event()
+        self._wake = wake or self._wake_event.set
+        self._stop_requested = False
+        tracker.persister = self
+
+    def mark_dirty(self):
+        with self._pending_lock:
+            self._pending_saves += 1
+            write_now = self._pending_saves >= self.max_pending_saves
+        if write_now:
+            self._wake()
+
+    def request_write(self):
+        with self._pending_lock:
+            self._pending_saves += 1
+        self._wake()
+
+    def flush(self):
+        with self._pending_lock:
+            if self._pending_saves == 0:
+                return
+            self._pending_saves = 0
+        with self._tracker_lock:
+            snapshot = self._tracker.take_snapshot()
+            self._tracker.storage.snapshot_taken(self._tracker, snapshot)
+        self._tracker.storage.write_snapshot(snapshot)
+        with self._tracker_lock:
+            self._tracker.storage.snapshot_written(self._tracker, snapshot)
+
+    def write_pending(self):
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"Failed to store activity: {e}")
+            self.mark_dirty()  # retry with next write
+
+    def run(self):
+        while not self._stop_requested:
+            self._wake_event.wait(self.interval)
+            self._wake_event.clear()
+            self.write_pending()
+
+    def stop(self):
+        """Stops the thread and writes anything still pending."""
+        self._stop_requested = True
+        self._wake_event.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
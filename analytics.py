@@ -0,0 +1,237 @@
+"""
+Activity reports computed from ActivityTracker history with NumPy.
+
+Intervals are turned into per-hour active time without looping over them: the active
+time before moment t is sum(min(t, end) - start) over intervals that started before t,
+which two searchsorted calls over sorted starts and ends give for all hour boundaries at once.
+
+    python -m analytics heatmap --group coreteam --days 90
+    python -m analytics daily --days 30
+    python -m analytics window --user U012AB3CD
+"""
+import argparse
+import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+import columnar
+from activity_tracker import ActivityTracker, datetime_to_micros
+from directory import load_directory
+from storage import JournaledFileStorage, SqliteStorage
+
+HOUR_MICROS = 3600 * 10**6
+DAY_MICROS = 24 * HOUR_MICROS
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+SHADES = " ░▒▓█"
+
+Intervals = Tuple[np.ndarray, np.ndarray]
+
+
+def collect_intervals(
+    tracker: ActivityTracker, since: datetime.datetime, until: datetime.datetime, user_ids: Optional[Iterable[str]] = None
+) -> Dict[str, Intervals]:
+    """
+    Returns starts and ends (epoch microseconds) of every user's activity within [since, until],
+    clipped to it. Call it under the lock guarding the tracker - ranges are copied, so the
+    result can be used after the lock is released.
+    """
+    since_micros, until_micros = datetime_to_micros(since), datetime_to_micros(until)
+    user_to_intervals = {}
+    if tracker.storage.keeps_history:
+        for user, ranges in tracker.storage.ranges_micros(since_micros, until_micros, user_ids).items():
+            columns = np.array(ranges, dtype=np.int64)
+            user_to_intervals[user] = columns[:, 0], columns[:, 1]
+    else:
+        for user in tracker.user_to_time_ranges if user_ids is None else user_ids:
+            ranges = tracker.user_to_time_ranges.get(user)
+            if ranges is None:
+                continue
+            window = ranges.overlapping_slice(since_micros, until_micros)
+            # array slices are copies and views of a mapped file never change,
+            # np.frombuffer wraps them without copying again
+            user_to_intervals[user] = (
+                np.frombuffer(ranges.starts[window], dtype=np.int64),
+                np.frombuffer(ranges.ends[window], dtype=np.int64),
+            )
+    return {
+        user: (np.maximum(starts, since_micros), np.minimum(ends, until_micros))
+        for user, (starts, ends) in user_to_intervals.items()
+        if len(starts)
+    }
+
+
+def _concatenate(user_to_intervals: Dict[str, Intervals]) -> Intervals:
+    if not user_to_intervals:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.concatenate([starts for starts, _ in user_to_intervals.values()])
+    ends = np.concatenate([ends for _, ends in user_to_intervals.values()])
+    return starts, ends
+
+
+def active_seconds_before(starts: np.ndarray, ends: np.ndarray, moments: np.ndarray) -> np.ndarray:
+    """Total active seconds of all intervals before each of sorted moments. Intervals may overlap."""
+    # sums of a year of microsecond timestamps overflow int64, seconds since the first moment don't lose precision
+    origin = moments[0]
+    starts, ends, moments = ((values - origin) / 10**6 for values in (starts, ends, moments))
+    sorted_starts, sorted_ends = np.sort(starts), np.sort(ends)
+    starts_before = np.searchsorted(sorted_starts, moments)
+    ends_before = np.searchsorted(sorted_ends, moments)
+    starts_sum = np.concatenate(([0], np.cumsum(sorted_starts)))[starts_before]
+    ends_sum = np.concatenate(([0], np.cumsum(sorted_ends)))[ends_before]
+    # intervals that ended count end - start, the open ones moment - start
+    return starts_before * moments - starts_sum - (ends_before * moments - ends_sum)
+
+
+def _hour_buckets(since: datetime.datetime, until: datetime.datetime) -> np.ndarray:
+    first = datetime_to_micros(since) // HOUR_MICROS * HOUR_MICROS
+    return np.arange(first, datetime_to_micros(until) + HOUR_MICROS, HOUR_MICROS, dtype=np.int64)
+
+
+def active_seconds_per_hour(intervals: Intervals, since, until) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns start of every hour in [since, until] and active seconds in it."""
+    boundaries = _hour_buckets(since, until)
+    # float sums of millions of intervals are off by fractions of a second
+    active = np.maximum(np.round(np.diff(active_seconds_before(*intervals, boundaries))), 0)
+    return boundaries[:-1], active
+
+
+def hour_of_week_heatmap(intervals: Intervals, since, until) -> np.ndarray:
+    """
+    7x24 array (Monday first) of average number of active users in every hour of the week,
+    i.e. probability of being active for intervals of a single user.
+    """
+    hours, active = active_seconds_per_hour(intervals, since, until)
+    days = hours // DAY_MICROS
+    hour_of_week = (days + EPOCH_WEEKDAY) % 7 * 24 + hours % DAY_MICROS // HOUR_MICROS
+    active_seconds = np.bincount(hour_of_week, weights=active, minlength=7 * 24)
+    occurrences = np.bincount(hour_of_week, minlength=7 * 24)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        heatmap = np.where(occurrences > 0, active_seconds / (occurrences * 3600), 0.0)
+    return heatmap.reshape(7, 24)
+
+
+def daily_active_counts(user_to_intervals: Dict[str, Intervals], since, until) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns every day in [since, until] (datetime64[D]) and how many users were active on it."""
+    first_day = datetime_to_micros(since) // DAY_MICROS
+    days_count = datetime_to_micros(until) // DAY_MICROS - first_day + 1
+    days = np.arange(first_day, first_day + days_count).astype("datetime64[D]")
+    if not user_to_intervals:
+        return days, np.zeros(days_count, dtype=np.int64)
+    starts, ends = _concatenate(user_to_intervals)
+    user_index = np.repeat(np.arange(len(user_to_intervals)), [len(s) for s, _ in user_to_intervals.values()])
+    start_days = starts // DAY_MICROS - first_day
+    end_days = ends // DAY_MICROS - first_day
+    # one (user, day) pair for every day an interval touches
+    spans = end_days - start_days + 1
+    offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    pair_days = np.repeat(start_days, spans) + offsets
+    pairs = np.unique(np.repeat(user_index, spans) * days_count + pair_days)
+    return days, np.bincount(pairs % days_count, minlength=days_count)
+
+
+def typical_online_window(intervals: Intervals, since, until, coverage=0.8) -> Optional[Tuple[int, int]]:
+    """
+    Shortest range of hours of the day [start, end) - possibly wrapping past midnight -
+    that holds `coverage` of all activity. None if there was no activity.
+    """
+    hours, active = active_seconds_per_hour(intervals, since, until)
+    profile = np.bincount(hours % DAY_MICROS // HOUR_MICROS, weights=active, minlength=24)
+    total = profile.sum()
+    if total <= 0:
+        return None
+    cumulative = np.concatenate(([0.0], np.cumsum(np.concatenate((profile, profile)))))
+    for length in range(1, 25):
+        window_sums = cumulative[length:length + 24] - cumulative[:24]
+        start = int(np.argmax(window_sums))
+        if window_sums[start] >= coverage * total - 1e-9:
+            return start, (start + length) % 24
+    return 0, 0
+
+
+def format_heatmap(heatmap: np.ndarray) -> str:
+    peak = heatmap.max()
+    levels = np.zeros(heatmap.shape, dtype=int) if peak <= 0 else np.ceil(heatmap / peak * (len(SHADES) - 1))
+    lines = ["    " + "".join(str(hour // 10) if hour % 6 == 0 else " " for hour in range(24))]
+    lines.append("    " + "".join(str(hour % 10) if hour % 6 == 0 else " " for hour in range(24)))
+    for weekday, row in zip(WEEKDAYS, levels.astype(int)):
+        lines.append(f"{weekday} " + "".join(SHADES[level] for level in row))
+    return "\n".join(lines)
+
+
+def format_window(window: Optional[Tuple[int, int]]) -> str:
+    if window is None:
+        return "no activity"
+    return f"{window[0]:02d}:00-{window[1]:02d}:00"
+
+
+def activity_report(user_to_intervals: Dict[str, Intervals], name: str, since, until) -> str:
+    intervals = _concatenate(user_to_intervals)
+    _, counts = daily_active_counts(user_to_intervals, since, until)
+    window = typical_online_window(intervals, since, until)
+    return (
+        f"Activity of {name} from {since:%Y-%m-%d} to {until:%Y-%m-%d}\n"
+        f"Typical online hours: {format_window(window)}. "
+        f"Active users per day: {counts.mean():.1f} on average, {counts.max()} at most.\n"
+        f"```\n{format_heatmap(hour_of_week_heatmap(intervals, since, until))}\n```"
+    )
+
+
+def load_tracker(sqlite_path=None, binary_path=None) -> ActivityTracker:
+    """Reads history like the bot does, but without closing activities or writing anything back."""
+    if binary_path is not None:
+        tracker = ActivityTracker(read_status_from_file=False, storage=columnar.ColumnarFileStorage(binary_path))
+        tracker.storage.load(tracker)
+        return tracker
+    if sqlite_path is not None:
+        tracker = ActivityTracker(read_status_from_file=False, storage=SqliteStorage(sqlite_path))
+        tracker.storage.load(tracker)
+        return tracker
+    storage = JournaledFileStorage()
+    tracker = ActivityTracker(read_status_from_file=False, storage=storage)
+    storage.load(tracker, repair_journal=False)  # the bot may still be appending to the journal
+    return tracker
+
+
+def main():
+    from app import RefreshStatusThread  # app imports this module
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("report", choices=["heatmap", "daily", "window"])
+    who = parser.add_mutually_exclusive_group()
+    who.add_argument("--user")
+    who.add_argument("--group", help="needs the directory cache written by the bot")
+    parser.add_argument("--days", type=int, default=90)
+    history = parser.add_mutually_exclusive_group()
+    history.add_argument("--sqlite", help="read history from this SQLite database instead of the storage file")
+    history.add_argument("--binary", help="read history from this file in binary format, see columnar.py")
+    args = parser.parse_args()
+
+    tracker = load_tracker(args.sqlite, args.binary)
+    until = datetime.datetime.now()
+    since = until - datetime.timedelta(days=args.days)
+    user_ids = None
+    if args.user:
+        user_ids = [args.user]
+    elif args.group:
+        directory = load_directory(RefreshStatusThread.DIRECTORY_CACHE_FILE)
+        if directory is None or args.group not in directory.group_handle_to_group:
+            parser.error(f"unknown group {args.group}")
+        user_ids = directory.group_handle_to_group[args.group].user_ids
+    user_to_intervals = collect_intervals(tracker, since, until, user_ids)
+    intervals = _concatenate(user_to_intervals)
+    tracker.close()
+
+    if args.report == "heatmap":
+        print(format_heatmap(hour_of_week_heatmap(intervals, since, until)))
+    elif args.report == "daily":
+        for day, count in zip(*daily_active_counts(user_to_intervals, since, until)):
+            print(f"{day} {count}")
+    else:
+        print(format_window(typical_online_window(intervals, since, until)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,142 +1,639 @@
 import datetime
+import json
 import os
 import signal
-import socket
 import ssl
+import statistics
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import replace
 from functools import partial
-from http.client import HTTPException
-from threading import Thread
-from urllib.error import URLError
+from threading import Thread, Lock, Event
+from typing import Dict, Optional, Set, Tuple
 
 import certifi as certifi
-from ratelimit import sleep_and_retry, limits
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
 
-from activity_tracker import ActivityTracker
+from activity_tracker import ActivityTracker, ActivityPersister, write_file_atomically
+from analytics import activity_report, collect_intervals
+from columnar import ColumnarFileStorage
+from metrics import metrics, start_metrics_server, CycleProfiler
+from scheduler import JobScheduler
+from storage import JournaledFileStorage, JsonFileStorage, SqliteStorage
+from directory import Directory, build_directory, merge_directories, store_directory, load_directory
+from presence import (
+    PresenceFetcher,
+    PresenceScheduler,
+    TokenBucket,
+    call_with_retries,
+    NETWORK_ERRORS,
+    DIRECTORY_CALLS_PER_MINUTE,
+)
 from utils import (
+    ActiveUsersReplyCache,
     GroupsAndUsersThreadSafeDict,
-    user_dict_to_user,
-    group_dict_to_group,
-    get_group_name_and_limit_from_msg, apply_aliases, get_limit,
+    User,
+    get_group_name_and_limit_from_msg, apply_aliases, get_limit, get_report_subject_from_msg,
 )
 
 BOT_NAME = "ActiveUsers"
 MINUTE = 60
 
+REFRESH_SECONDS = 120
+# Users and groups change rarely, so they are downloaded less often than presence.
+DIRECTORY_REFRESH_SECONDS = 60 * MINUTE
+USERS_PAGE_SIZE = 200
+COMPACTION_SECONDS = 60 * MINUTE
+# a failed directory refresh, or compaction waiting for history, is retried this soon
+DIRECTORY_RETRY_SECONDS = MINUTE
+COMPACTION_RETRY_SECONDS = MINUTE
+# every job runs up to this fraction of its interval later
+JOB_JITTER = 0.1
+PRESENCE_MODE_POLL = "poll"
+PRESENCE_MODE_EVENTS = "events"
+# In events mode polling is only a reconciliation sweep for missed events.
+RECONCILE_SECONDS = 15 * MINUTE
+# Presence events are saved one by one, so in events mode saves are written behind this often by default.
+EVENTS_WRITE_BEHIND_SECONDS = REFRESH_SECONDS
+# Presence saved by a previous run is used until the first refresh only if it is this fresh.
+HOT_STATE_MAX_AGE_SECONDS = 15 * MINUTE
+# Fresh mentions re-fetch presence older than the TTL, but wait for it at most the deadline.
+FRESH_PRESENCE_TTL_SECONDS = MINUTE
+FRESH_PRESENCE_DEADLINE_SECONDS = 2
+FRESH_PRESENCE_WORKERS = 4
+REPORT_DAYS = 28
+
+
+class DirectoryRefreshStopped(Exception):
+    pass
+
+
+class HistoryNotLoaded(Exception):
+    pass
+
 
 class RefreshStatusThread(Thread):
+    DIRECTORY_CACHE_FILE = "activeusers_directory.json"
+    HOT_STATE_FILE = "activeusers_hot_state.json"
+
     def __init__(
         self,
         slack_client,
         groups_users_dict: GroupsAndUsersThreadSafeDict,
         refresh_seconds=120,
-        sleep_time=1,
+        presence_fetcher: PresenceFetcher = None,
+        presence_subscriber=None,
+        activity_tracker: ActivityTracker = None,
+        presence_scheduler: PresenceScheduler = None,
+        directory_refresh_seconds=DIRECTORY_REFRESH_SECONDS,
+        directory_bucket: TokenBucket = None,
+        profiler: CycleProfiler = None,
+        write_behind_seconds=None,
+        load_history_in_background=False,
+        scheduler: JobScheduler = None,
+        events_fallback_seconds=None,
     ):
+        """
+        With `load_history_in_background` the activity tracker should be created without
+        reading its file - run() loads it in another thread while the first refresh goes on.
+        run() runs directory refresh, presence polling, persistence and compaction as jobs of `scheduler`.
+        With `presence_subscriber` (events mode) saves are written behind every EVENTS_WRITE_BEHIND_SECONDS
+        unless `write_behind_seconds` is given - otherwise every event would rewrite the history in a Bolt thread.
+        Storages that keep history are never written behind.
+        If no presence_change event arrives for `events_fallback_seconds` (the subscription may not be
+        honored), presence is polled that often instead of every `refresh_seconds` until events arrive again.
+        In events mode `presence_scheduler` is used only meanwhile - reconciliation sweeps poll everyone.
+        """
         super().__init__(name="RefreshStatusThread")
+        self._started_at = time.monotonic()
         self._groups_users_dict = groups_users_dict
         self._client = slack_client
-        self._stop_requested = False
-        self.last_refresh_time = None
+        self._presence_fetcher = presence_fetcher or PresenceFetcher(slack_client)
+        self._scheduler = scheduler or JobScheduler()
+        self.last_cycle_seconds = None
+        self.presence_staleness = {}
         self.refresh_seconds = refresh_seconds
-        self.sleep_time = sleep_time
         self.bot_user = None
-        self.activity_tracker = ActivityTracker(read_status_from_file=True)
+        self.activity_tracker = activity_tracker or ActivityTracker(read_status_from_file=True)
+        self._activity_tracker_lock = Lock()
+        self._load_history_in_background = load_history_in_background
+        self._history_loaded = Event()
+        # set when loading finished, also when it failed - then _history_loaded stays unset
+        self._history_load_finished = Event()
+        # presence changes from Bolt threads that arrived while history was loading
+        self._queued_presence_changes = []
+        self._queued_presence_lock = Lock()
+        if not load_history_in_background:
+            self._history_loaded.set()
+            self._history_load_finished.set()
+        self._persister = None
+        if write_behind_seconds is None and presence_subscriber is not None:
+            write_behind_seconds = EVENTS_WRITE_BEHIND_SECONDS
+        # storages that keep history store every save themselves, there are no snapshots to write behind
+        if write_behind_seconds is not None and not self.activity_tracker.storage.keeps_history:
+            self._persister = ActivityPersister(
+                self.activity_tracker,
+                self._activity_tracker_lock,
+                interval=write_behind_seconds,
+                wake=lambda: self._scheduler.trigger("persistence"),
+            )
+        self._presence_subscriber = presence_subscriber
+        self._events_fallback_seconds = events_fallback_seconds
+        self._last_presence_event_at: Optional[float] = None
+        self._presence_events_missing = False
+        # Without a scheduler every user in groups is polled in each cycle.
+        self._presence_scheduler = presence_scheduler
+        self._user_to_presence = {}
+        self._user_to_presence_time: Dict[str, float] = {}
+        # user id -> (directory user, its copy with active=True), reused while the directory user is the same
+        self._user_id_to_active_copy: Dict[str, Tuple[User, User]] = {}
+        self._published_directory: Optional[Directory] = None
+        # group handle -> in-flight fresh presence fetch shared by concurrent mentions
+        self._fresh_fetches: Dict[str, Future] = {}
+        self._fresh_fetches_lock = Lock()
+        self._fresh_executor = ThreadPoolExecutor(
+            max_workers=FRESH_PRESENCE_WORKERS, thread_name_prefix="fresh-presence"
+        )
+        self.directory_refresh_seconds = directory_refresh_seconds
+        self._directory_bucket = directory_bucket or TokenBucket(DIRECTORY_CALLS_PER_MINUTE, name="directory")
+        self.directory: Optional[Directory] = None
+        self._profiler = profiler or CycleProfiler(every_n_cycles=0)
+        self._load_directory_cache()
+        self._load_hot_state()
+        self._add_jobs()
+        metrics.set("activeusers_startup_seconds", time.monotonic() - self._started_at, phase="hot_state")
+
+    def _add_jobs(self):
+        scheduler = self._scheduler
+        directory_delay = 0
+        if self.directory is not None:
+            # the cached directory is refreshed when it gets old, not right after start
+            directory_delay = max(0, self.directory.fetched_at + self.directory_refresh_seconds - time.time())
+        # jitter keeps jobs of workers started together from hitting Slack at the same moments
+        scheduler.add_job(
+            "directory",
+            self._refresh_directory_job,
+            self.directory_refresh_seconds,
+            jitter=self.directory_refresh_seconds * JOB_JITTER,
+            delay=directory_delay,
+        )
+        scheduler.add_job(
+            "presence", self._refresh_presence_job, self.refresh_seconds, jitter=self.refresh_seconds * JOB_JITTER
+        )
+        if self._persister is not None:
+            interval = self._persister.interval
+            scheduler.add_job("persistence", self._persister.write_pending, interval, delay=interval, background=True)
+        if self._presence_subscriber is not None and self._events_fallback_seconds is not None:
+            scheduler.add_job(
+                "presence_events_check",
+                self._check_presence_events_job,
+                self._events_fallback_seconds,
+                delay=self._events_fallback_seconds,
+            )
+        if self.activity_tracker.retention_days is not None:
+            scheduler.add_job(
+                "compaction",
+                self._compaction_job,
+                COMPACTION_SECONDS,
+                jitter=COMPACTION_SECONDS * JOB_JITTER,
+                background=True,
+            )
 
     def request_stop(self):
-        self._stop_requested = True
+        self._scheduler.stop()
+
+    def trigger_presence_refresh(self):
+        """Polls presence now instead of waiting for the next cycle, e.g. after reconnecting."""
+        self._scheduler.trigger("presence")
+
+    def presence_event_received(self):
+        self._last_presence_event_at = time.monotonic()
+
+    def _check_presence_events_job(self):
+        last_event_at = self._last_presence_event_at
+        missing = last_event_at is None or time.monotonic() - last_event_at > self._events_fallback_seconds
+        if missing == self._presence_events_missing:
+            return
+        self._presence_events_missing = missing
+        metrics.set("activeusers_presence_events_missing", int(missing))
+        if missing:
+            interval = self._events_fallback_seconds
+            print(
+                f"[{datetime.datetime.now()}] Warning: no presence_change events in the last {interval:.0f}s, "
+                f"presence_sub may not be honored. Polling presence every {interval:.0f}s."
+            )
+        else:
+            interval = self.refresh_seconds
+            print(f"[{datetime.datetime.now()}] presence_change events arrive again, polling every {interval:.0f}s.")
+        self._scheduler.set_interval("presence", interval, jitter=interval * JOB_JITTER)
+
+    def _should_stop(self):
+        return self._scheduler.stopped.is_set()
+
+    def _call_directory_method(self, call, method):
+        response = call_with_retries(
+            self._directory_bucket,
+            call,
+            should_stop=self._should_stop,
+            method=method,
+            stop_event=self._scheduler.stopped,
+        )
+        if response is None:
+            raise DirectoryRefreshStopped()
+        return response
 
-    @sleep_and_retry
-    @limits(calls=20, period=MINUTE)
     def get_usergroups_list(self):
-        return self._client.usergroups_list(include_users=True)["usergroups"]
+        response = self._call_directory_method(
+            lambda: self._client.usergroups_list(include_users=True), method="usergroups.list"
+        )
+        return response["usergroups"]
+
+    def get_users_list_page(self, cursor=None):
+        response = self._call_directory_method(
+            lambda: self._client.users_list(limit=USERS_PAGE_SIZE, cursor=cursor), method="users.list"
+        )
+        next_cursor = (response.get("response_metadata") or {}).get("next_cursor") or None
+        return response["members"], next_cursor
 
-    @sleep_and_retry
-    @limits(calls=20, period=MINUTE)
     def get_users_list(self):
-        return self._client.users_list()["members"]
+        users, cursor = self.get_users_list_page()
+        while cursor is not None:
+            page, cursor = self.get_users_list_page(cursor)
+            users.extend(page)
+        return users
 
-    @sleep_and_retry
-    @limits(calls=50, period=MINUTE)
-    def get_user_presence(self, user_id):
-        return self._client.users_getPresence(user=user_id)["presence"]
+    def _load_directory_cache(self):
+        directory = load_directory(self.DIRECTORY_CACHE_FILE)
+        if directory is None:
+            return
+        self.directory = directory
+        self._set_bot_user(directory.bot_user)
+        print(f"[{datetime.datetime.now()}] Loaded cached directory with {len(directory.user_id_to_user)} users")
 
-    def refresh_groups_and_users_info(self):
+    def _load_hot_state(self):
+        """Publishes presence saved by the previous run, so mentions are answered before the first refresh."""
+        if self.directory is None:
+            return
+        try:
+            with open(self.HOT_STATE_FILE, "r") as f:
+                hot_state = json.load(f)
+            if time.time() - hot_state["saved_at"] > HOT_STATE_MAX_AGE_SECONDS:
+                return
+            user_to_presence = dict.fromkeys(hot_state["active_user_ids"], "active")
+        except (OSError, ValueError, KeyError, TypeError):
+            return  # a missing or malformed hot state only means waiting for the first refresh
+        self._user_to_presence = user_to_presence
+        self._publish_presence(self.directory, self.directory.users_in_groups_ids())
+        print(f"[{datetime.datetime.now()}] Restored {len(self._user_to_presence)} active users from hot state")
+
+    def _store_hot_state(self, active_ids):
+        content = json.dumps({"saved_at": time.time(), "active_user_ids": sorted(active_ids)})
+        write_file_atomically(self.HOT_STATE_FILE, content.encode())
+
+    def _load_history(self):
+        start = time.monotonic()
+        with self._activity_tracker_lock:
+            try:
+                self.activity_tracker.read_activity_status_from_file(ignore_error=True)
+            except Exception as e:
+                # saving the partially loaded tracker would overwrite the history, so nothing is saved until restart
+                metrics.inc("activeusers_history_load_errors_total")
+                print(f"[{datetime.datetime.now()}] Failed to load activity history, activity is not recorded: {e!r}")
+                with self._queued_presence_lock:
+                    self._queued_presence_changes = []
+                    self._history_load_finished.set()
+                return
+            with self._queued_presence_lock:
+                queued, self._queued_presence_changes = self._queued_presence_changes, []
+                self._history_loaded.set()
+                self._history_load_finished.set()
+            # still under the lock, so saves of refresh come after these
+            for dt, active_ids, inactive_ids in queued:
+                self.activity_tracker.save_activity_status(active_users=active_ids, inactive_users=inactive_ids, dt=dt)
+        seconds = time.monotonic() - start
+        metrics.set("activeusers_startup_seconds", seconds, phase="history")
+        print(f"[{datetime.datetime.now()}] Loaded activity history in {seconds:.1f}s")
+
+    @contextmanager
+    def _locked_tracker(self):
+        """Waits until history is loaded and locks the activity tracker. Raises HistoryNotLoaded if loading failed."""
+        self._history_load_finished.wait()
+        if not self._history_loaded.is_set():
+            raise HistoryNotLoaded()
+        with self._activity_tracker_lock:
+            yield self.activity_tracker
+
+    def _set_bot_user(self, bot_user):
+        if bot_user is not None and self.bot_user is None:
+            self.bot_user = bot_user
+            self._groups_users_dict.set_bot_user(bot_user)
+
+    def directory_refresh_due(self):
+        return self.directory is None or time.time() - self.directory.fetched_at >= self.directory_refresh_seconds
+
+    def refresh_directory(self) -> bool:
+        """Downloads users and groups and replaces the ones that changed. Returns True on success."""
         try:
             groups = self.get_usergroups_list()
             users = self.get_users_list()
-        except (SlackApiError, URLError, socket.timeout, socket.error, HTTPException):
-            return
-        user_id_to_user = {}
-        users_in_groups_ids = set()
-        for user_dict in users:
-            if (
-                user_dict["is_bot"]
-                and "real_name" in user_dict
-                and user_dict["real_name"] == BOT_NAME
-            ):
-                if self.bot_user is None:
-                    self.bot_user = user_dict_to_user(user_dict)
-                    self._groups_users_dict.set_bot_user(self.bot_user)
-                continue
-            if user_dict["deleted"] or user_dict["is_bot"]:
-                continue
-            user = user_dict_to_user(user_dict)
-            user_id_to_user[user.id] = user
-
-        group_handle_to_group = {}
-        for group_dict in groups:
-            group = group_dict_to_group(group_dict)
-            users_in_groups_ids.update(group.user_ids)
-            group_handle_to_group[group.handle] = group
-        for user_id in users_in_groups_ids:
-            try:
-                presence = self.get_user_presence(user_id)
-                if self._stop_requested:
-                    return
-            except (
-                SlackApiError,
-                URLError,
-                socket.timeout,
-                socket.error,
-                HTTPException,
-            ):
-                continue
-            if presence == "active":
-                user = user_id_to_user.get(user_id)
-                if user is None:
-                    continue  # Unknown user - we will get his info next time
-                user.active = True
-        self._groups_users_dict.update_groups_and_users(
-            list(group_handle_to_group.values()), list(user_id_to_user.values())
-        )
-        users = user_id_to_user.values()
-        active_ids = set([u.id for u in users if u.active])
-        inactive_ids = set([u.id for u in users if not u.active])
-        self.activity_tracker.save_activity_status(
-            active_users=active_ids,
-            inactive_users=inactive_ids,
-            dt=datetime.datetime.now(),
+        except (DirectoryRefreshStopped, *NETWORK_ERRORS):
+            return False
+        new_directory = build_directory(users, groups, bot_name=BOT_NAME)
+        if self.directory is None:
+            self.directory = new_directory
+            diff_str = "initial"
+        else:
+            self.directory, diff = merge_directories(self.directory, new_directory)
+            diff_str = str(diff)
+        self._set_bot_user(self.directory.bot_user)
+        store_directory(self.DIRECTORY_CACHE_FILE, self.directory)
+        print(f"[{datetime.datetime.now()}] Refreshed directory: {diff_str}")
+        return True
+
+    def refresh_groups_and_users_info(self):
+        if self.directory_refresh_due():
+            self.refresh_directory()
+        self._refresh_presence_job()
+
+    def _refresh_directory_job(self):
+        if self.refresh_directory():
+            self._scheduler.trigger("presence")  # publish new groups and members right away
+        else:
+            self._scheduler.trigger("directory", delay=DIRECTORY_RETRY_SECONDS)
+
+    def _refresh_presence_job(self):
+        if self.directory is not None:
+            with self._profiler.profile_cycle():
+                self.refresh_presence()
+
+    def refresh_presence(self):
+        cycle_start = time.monotonic()
+        directory = self.directory
+        users_in_groups_ids = directory.users_in_groups_ids()
+        user_to_presence = self._presence_fetcher.fetch(
+            self._select_users_to_poll(directory.group_handle_to_group, users_in_groups_ids),
+            should_stop=self._should_stop,
+            stop_event=self._scheduler.stopped,
         )
-        active_names = [u.id for u in users if u.active]
-        active_names.sort()
+        if self._should_stop():
+            return
+        if self._presence_scheduler is not None:
+            self._presence_scheduler.mark_polled(user_to_presence)
+        # users not polled in this cycle keep their last known presence
+        self._user_to_presence.update(user_to_presence)
+        self._user_to_presence_time.update(dict.fromkeys(user_to_presence, time.time()))
+        active_ids = self._publish_presence(directory, users_in_groups_ids)
+        if self._presence_subscriber is not None:
+            self._presence_subscriber(users_in_groups_ids)
+        self._store_hot_state(active_ids)
+        with self._locked_tracker() as activity_tracker:
+            # only users the tracker has as active can go inactive - no need to pass everyone else
+            user_id_to_user = directory.user_id_to_user
+            inactive_ids = {
+                user_id for user_id in activity_tracker.active_users
+                if user_id not in active_ids and user_id in user_id_to_user
+            }
+            activity_tracker.save_activity_status(
+                active_users=active_ids,
+                inactive_users=inactive_ids,
+                dt=datetime.datetime.now(),
+            )
+        active_names = sorted(active_ids)
+        if self.last_cycle_seconds is None:
+            metrics.set("activeusers_startup_seconds", time.monotonic() - self._started_at, phase="first_refresh")
+        self.last_cycle_seconds = time.monotonic() - cycle_start
+        metrics.observe("activeusers_refresh_cycle_seconds", self.last_cycle_seconds)
+        metrics.set("activeusers_users_in_groups", len(users_in_groups_ids))
+        metrics.set("activeusers_active_users", len(active_ids))
+        staleness_str = ""
+        if self._presence_scheduler is not None:
+            self.presence_staleness = self._presence_scheduler.staleness(users_in_groups_ids)
+            known_staleness = [s for s in self.presence_staleness.values() if s is not None]
+            metrics.set("activeusers_presence_never_polled_users", len(self.presence_staleness) - len(known_staleness))
+            if known_staleness:
+                metrics.set("activeusers_presence_staleness_seconds", max(known_staleness), stat="max")
+                metrics.set("activeusers_presence_staleness_seconds", statistics.mean(known_staleness), stat="mean")
+                staleness_str = f" Max presence staleness: {max(known_staleness):.0f}s."
         print(
-            f"[{datetime.datetime.now()}] Refreshed active users: {', '.join(active_names)}"
+            f"[{datetime.datetime.now()}] Refreshed presence of {len(user_to_presence)}/{len(users_in_groups_ids)} users "
+            f"in {self.last_cycle_seconds:.1f}s.{staleness_str} Active users: {', '.join(active_names)}"
         )
 
+    def _active_copy(self, user: User) -> User:
+        cached = self._user_id_to_active_copy.get(user.id)
+        if cached is not None and cached[0] is user:
+            return cached[1]
+        active_user = replace(user, active=True)
+        self._user_id_to_active_copy[user.id] = (user, active_user)
+        return active_user
+
+    def _publish_presence(self, directory: Directory, users_in_groups_ids) -> Set[str]:
+        """
+        Publishes directory users with their last known presence in a single pass over group
+        members. Returns ids of active users.
+
+        Directory users are shared with published snapshots, so they are never modified:
+        active users are published as copies that are created once and reused in later
+        cycles. Groups are indexed again only when the directory changed, otherwise only
+        users whose published object differs are replaced.
+        """
+        user_id_to_user = directory.user_id_to_user
+        published_users = self._groups_users_dict.get_snapshot().user_id_to_user
+        rebuild = directory is not self._published_directory
+        active_ids = set()
+        active_users = []
+        changed_users = []
+        for user_id in users_in_groups_ids:
+            user = user_id_to_user.get(user_id)
+            if user is None:
+                continue  # Unknown user - we will get their info with next directory refresh
+            if self._user_to_presence.get(user_id) == "active":
+                active_ids.add(user_id)
+                user = self._active_copy(user)
+                active_users.append(user)
+            if published_users.get(user_id) is not user:
+                changed_users.append(user)
+        if rebuild:
+            # starts from inactive directory users, so every active one is replaced - not only the changed ones
+            published = dict(user_id_to_user)
+            for user in active_users:
+                published[user.id] = user
+            self._groups_users_dict.update_groups_and_users(
+                list(directory.group_handle_to_group.values()), list(published.values())
+            )
+            self._published_directory = directory
+            # copies of users that left the directory are not needed any more
+            for user_id in self._user_id_to_active_copy.keys() - user_id_to_user.keys():
+                del self._user_id_to_active_copy[user_id]
+        elif changed_users:
+            self._groups_users_dict.replace_users(changed_users)
+        return active_ids
+
+    def _select_users_to_poll(self, group_handle_to_group, users_in_groups_ids):
+        if self._presence_scheduler is None:
+            return users_in_groups_ids
+        if self._presence_subscriber is not None and not self._presence_events_missing:
+            return users_in_groups_ids  # reconciliation sweep for missed events
+        self._presence_scheduler.update_group_scores(self._groups_users_dict.get_group_request_counts())
+        snapshot = self._groups_users_dict.get_snapshot()
+        if self._published_directory is self.directory:
+            # the published index is up to date, no need to build it again
+            user_to_groups = snapshot.user_id_to_group_handles
+        else:
+            user_to_groups = {user_id: [] for user_id in users_in_groups_ids}
+            for handle, group in group_handle_to_group.items():
+                for user_id in group.user_ids:
+                    user_to_groups[user_id].append(handle)
+
+        def last_change_of(user_id):
+            if not self._history_loaded.is_set():
+                return None  # do not hold up polling until history is loaded
+            with self._activity_tracker_lock:
+                dt = self.activity_tracker.last_presence_change(user_id)
+            return None if dt is None else dt.timestamp()
+
+        return self._presence_scheduler.select_users(user_to_groups, last_change_of)
+
+    def record_presence_changes(self, active_ids=(), inactive_ids=()):
+        """
+        Publishes presence learned outside of refresh cycles and records it in one save.
+        Called from Bolt threads, so it never waits for history to load: until then changes are queued.
+        """
+        active_ids = {user_id for user_id in active_ids if self._groups_users_dict.set_user_presence(user_id, True)}
+        inactive_ids = {
+            user_id for user_id in inactive_ids if self._groups_users_dict.set_user_presence(user_id, False)
+        }
+        if not active_ids and not inactive_ids:
+            return
+        with self._queued_presence_lock:
+            if not self._history_load_finished.is_set():
+                self._queued_presence_changes.append((datetime.datetime.now(), active_ids, inactive_ids))
+                return
+        if not self._history_loaded.is_set():
+            return  # loading failed, nothing is recorded until restart
+        with self._activity_tracker_lock:
+            # taken under the lock, so saves are never out of order with the ones of refresh
+            dt = datetime.datetime.now()
+            self.activity_tracker.save_activity_status(active_users=active_ids, inactive_users=inactive_ids, dt=dt)
+
+    def refresh_groups_presence(
+        self, group_handles, ttl=FRESH_PRESENCE_TTL_SECONDS, deadline=FRESH_PRESENCE_DEADLINE_SECONDS
+    ) -> bool:
+        """
+        Fetches presence of members of given groups that was not refreshed in the last `ttl`
+        seconds, using the poller's rate budget. Waits at most `deadline` seconds - then callers
+        use cached presence, and calls already made are published when they finish.
+        Concurrent calls for the same group share one fetch. Returns True if nothing was late.
+        """
+        directory = self.directory
+        if directory is None:
+            return False
+        deadline_at = time.monotonic() + deadline
+        futures = []
+        with self._fresh_fetches_lock:
+            for handle in group_handles:
+                future = self._fresh_fetches.get(handle)
+                group = directory.group_handle_to_group.get(handle)
+                if future is None and group is not None:
+                    now = time.time()
+                    stale_ids = [
+                        user_id for user_id in group.user_ids
+                        if now - self._user_to_presence_time.get(user_id, 0) > ttl
+                    ]
+                    if not stale_ids:
+                        continue
+                    future = self._fresh_executor.submit(self._fetch_fresh_presence, handle, stale_ids, deadline_at)
+                    self._fresh_fetches[handle] = future
+                if future is not None:
+                    futures.append(future)
+        if not futures:
+            metrics.inc("activeusers_fresh_presence_total", result="cached")
+            return True
+        _, late = wait(futures, timeout=max(0.0, deadline_at - time.monotonic()))
+        metrics.inc("activeusers_fresh_presence_total", result="late" if late else "fresh")
+        return not late
+
+    def _fetch_fresh_presence(self, handle, user_ids, deadline_at):
+        try:
+            # after the deadline nobody waits, so the budget is left to the poller
+            user_to_presence = self._presence_fetcher.fetch(
+                user_ids,
+                should_stop=lambda: self._should_stop() or time.monotonic() > deadline_at,
+                stop_event=self._scheduler.stopped,
+            )
+            self._user_to_presence.update(user_to_presence)
+            self._user_to_presence_time.update(dict.fromkeys(user_to_presence, time.time()))
+            self.record_presence_changes(
+                active_ids=[user_id for user_id, presence in user_to_presence.items() if presence == "active"],
+                inactive_ids=[user_id for user_id, presence in user_to_presence.items() if presence != "active"],
+            )
+        finally:
+            with self._fresh_fetches_lock:
+                del self._fresh_fetches[handle]
+
+    def activity_report(self, subject, days=REPORT_DAYS) -> str:
+        """Report of activity of a group (handle) or a user (id) in the last `days` days."""
+        snapshot = self._groups_users_dict.get_snapshot()
+        group = snapshot.group_handle_to_group.get(subject)
+        if group is not None:
+            user_ids, name = group.user_ids, subject
+        elif subject in snapshot.user_id_to_user:
+            user_ids, name = [subject], f"<@{subject}>"
+        else:
+            return f"Can't recognise group or user {subject}."
+        # answered from a Bolt thread - do not wait for history to load
+        if not self._history_load_finished.is_set():
+            return "Activity history is still loading, try again in a minute."
+        if not self._history_loaded.is_set():
+            return "Activity history could not be loaded, reports are unavailable until the bot is restarted."
+        until = datetime.datetime.now()
+        since = until - datetime.timedelta(days=days)
+        with self._activity_tracker_lock:
+            user_to_intervals = collect_intervals(self.activity_tracker, since, until, user_ids)
+        # computed without the lock - collect_intervals copies the ranges
+        return activity_report(user_to_intervals, name, since, until)
+
+    def compact_history(self):
+        start = time.monotonic()
+        # the expensive part runs without the lock, so saves from refresh are not blocked
+        compaction = self.activity_tracker.prepare_compaction()
+        if compaction is None:
+            return
+        with self._activity_tracker_lock:
+            self.activity_tracker.apply_compaction(compaction)
+        metrics.observe("activeusers_compaction_seconds", time.monotonic() - start)
+        if compaction.user_to_dropped_count:
+            print(
+                f"[{datetime.datetime.now()}] Compacted {sum(compaction.user_to_dropped_count.values())} ranges "
+                f"older than {compaction.cutoff}"
+            )
+
+    def _compaction_job(self):
+        if not self._history_loaded.is_set():
+            self._scheduler.trigger("compaction", delay=COMPACTION_RETRY_SECONDS)
+            return
+        self.compact_history()
+
+    def shutdown(self):
+        """Stops the thread and flushes activity that was not stored yet."""
+        self.request_stop()
+        if self.is_alive():
+            self.join()
+        # a persistence write or compaction may still be running
+        self._scheduler.join_background_jobs()
+        self._fresh_executor.shutdown()
+        if self._persister is not None:
+            self._persister.stop()
+        if self.activity_tracker is not None:
+            self.activity_tracker.close()
+
     def run(self):
-        while not self._stop_requested:
-            now = time.time()
-            if (
-                self.last_refresh_time is None
-                or now - self.last_refresh_time >= self.refresh_seconds
-            ):
-                self.refresh_groups_and_users_info()
-                self.last_refresh_time = now
-            time.sleep(self.sleep_time)
+        if self._load_history_in_background:
+            Thread(target=self._load_history, name="HistoryLoader", daemon=True).start()
+        self._scheduler.run()
 
 
 STARFISH_ALIASES = {
@@ -146,6 +643,9 @@ STARFISH_ALIASES = {
 
 STARFISH_TEAM_ID = "T04QW7B6D"
 
+# team id -> group aliases of that workspace
+TEAM_ALIASES = {STARFISH_TEAM_ID: STARFISH_ALIASES}
+
 
 def _groups_str(names):
     if not names:
@@ -155,18 +655,54 @@ def _groups_str(names):
     return ", ".join(names[:-1]) + " and " + names[-1]
 
 
-def handle_app_mention(groups_dict: GroupsAndUsersThreadSafeDict, event, say):
+def handle_app_mention(
+    groups_dict: GroupsAndUsersThreadSafeDict,
+    event,
+    say,
+    *,
+    refresh_thread: Optional[RefreshStatusThread] = None,
+    fresh_presence=False,
+    team_aliases=TEAM_ALIASES,
+    reply_cache: Optional[ActiveUsersReplyCache] = None,
+):
+    """
+    With `refresh_thread` the bot also answers "report <group or user>" mentions, and with
+    `fresh_presence` presence of requested groups is refreshed before answering
+    (see RefreshStatusThread.refresh_groups_presence). `reply_cache` shares lookups between
+    repeated mentions.
+    """
+    # Bolt passes arguments by parameter names, so the handler can't be wrapped in a decorator.
+    # Other parameters are keyword-only, because Bolt only looks at positional ones.
+    with metrics.time("activeusers_mention_seconds"):
+        _handle_app_mention(groups_dict, event, say, refresh_thread, fresh_presence, team_aliases, reply_cache)
+
+
+def _handle_app_mention(
+    groups_dict: GroupsAndUsersThreadSafeDict,
+    event,
+    say,
+    refresh_thread=None,
+    fresh_presence=False,
+    team_aliases=TEAM_ALIASES,
+    reply_cache: Optional[ActiveUsersReplyCache] = None,
+):
     if event is None:
         return
+    if reply_cache is None:
+        reply_cache = ActiveUsersReplyCache(groups_dict)
     bot_user = groups_dict.bot_user
     if bot_user is None:
         return
     team_id = event.get("team")
     text: str = event["text"]
     assert bot_user.id in text
+    report_subject = get_report_subject_from_msg(text, bot_user.id)
+    if report_subject is not None and refresh_thread is not None:
+        say(text=refresh_thread.activity_report(report_subject), thread_ts=event.get("thread_ts", event["ts"]))
+        return
     requested_groups_with_limits = get_group_name_and_limit_from_msg(text, bot_user.id)
-    if team_id == STARFISH_TEAM_ID:
-        requested_groups_with_limits = apply_aliases(requested_groups_with_limits, STARFISH_ALIASES)
+    if team_id in team_aliases:
+        requested_groups_with_limits = apply_aliases(requested_groups_with_limits, team_aliases[team_id])
 
     msg_list = []
     notify_msgs = []
@@ -175,17 +711,24 @@ def handle_app_mention(groups_dict: GroupsAndUsersThreadSafeDict, event, say):
         msg_list.append("You need to type name of the group!")
     else:
         try:
-            group_name_to_group_and_users = groups_dict.get_groups_and_users(requested_groups_with_limits)
-            for group_name, group_and_users in group_name_to_group_and_users.items():
-                group, users_in_group = group_and_users
+            requested_group_names = dict.fromkeys(name for name, _ in requested_groups_with_limits)
+            groups_dict.record_group_requests(list(requested_group_names))
+            if fresh_presence and refresh_thread is not None:
+                refresh_thread.refresh_groups_presence(list(requested_group_names))
+            # look up all groups before building messages, so an unknown group fails the whole request
+            group_name_to_mentions = {
+                group_name: reply_cache.get_mentions(
+                    group_name,
+                    get_limit(requested_groups_with_limits, group_name),
+                    exclude_user_id=requesting_user_id,
+                )
+                for group_name in requested_group_names
+            }
+            for group_name, user_ids_str in group_name_to_mentions.items():
                 limit = get_limit(requested_groups_with_limits, group_name)
-                active_users = [user for user in users_in_group if user.active and user.id != requesting_user_id]
-                if limit is not None:
-                    active_users = active_users[:limit]
-                if not active_users:
+                if not user_ids_str:
                     msg_list.append(f"There are no active users in group {group_name}.")
                 else:
-                    user_ids_str = ", ".join([f"<@{user.id}>" for user in active_users])
                     amount_str = "all" if limit is None else f"{limit}"
                     notify_msgs.append(f"{amount_str} active users of {group_name}: {user_ids_str}")
         except KeyError as e:
@@ -200,24 +743,135 @@ def handle_app_mention(groups_dict: GroupsAndUsersThreadSafeDict, event, say):
     say(text=msg, thread_ts=event.get("thread_ts", event["ts"]))
 
 
+def handle_presence_change(refresh_thread: RefreshStatusThread, event):
+    if event is None:
+        return
+    refresh_thread.presence_event_received()
+    # Batched presence_change events carry a "users" list instead of "user".
+    user_ids = [user_id for user_id in event.get("users") or [event.get("user")] if user_id is not None]
+    if event.get("presence") == "active":
+        refresh_thread.record_presence_changes(active_ids=user_ids)
+    else:
+        refresh_thread.record_presence_changes(inactive_ids=user_ids)
+
+
+def handle_socket_message(refresh_thread: RefreshStatusThread, client, message, raw_message):
+    """Slack sends "hello" after every (re)connection - presence changed meanwhile is polled at once."""
+    if message.get("type") == "hello":
+        refresh_thread.trigger_presence_refresh()
+
+
+def subscribe_to_presence(socket_mode_handler: SocketModeHandler, user_ids):
+    """
+    Asks Slack to send presence_change events for given users. presence_sub replaces the
+    previous subscription, so it has to list all users every time.
+    Slack documents presence_sub for RTM connections; if the subscription is not honored
+    RefreshStatusThread notices that no events arrive and polls presence as in poll mode.
+    """
+    message = json.dumps({"type": "presence_sub", "ids": sorted(user_ids)})
+    try:
+        socket_mode_handler.client.send_message(message)
+    except Exception as e:
+        print(f"Failed to subscribe to presence events: {e}")
+
+
 def connect_to_slack():
     ssl_context = ssl.create_default_context(cafile=certifi.where())
     client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"), ssl=ssl_context)
     bolt_app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
     socket_mode_handler = SocketModeHandler(bolt_app, os.environ.get("SLACK_APP_TOKEN"))
     socket_mode_handler.connect()
-    return bolt_app, client
+    return bolt_app, client, socket_mode_handler
+
+
+def check_storage_settings(journaled=False, binary=False, sqlite_path=None):
+    """Raises ValueError if more than one storage is chosen - none of them can be combined."""
+    chosen = [
+        name
+        for name, value in (
+            ("ACTIVEUSERS_SQLITE_STORAGE", sqlite_path),
+            ("ACTIVEUSERS_JOURNALED_STORAGE", journaled),
+            ("ACTIVEUSERS_BINARY_STORAGE", binary),
+        )
+        if value
+    ]
+    if len(chosen) > 1:
+        raise ValueError(f"Conflicting storage settings, set only one of: {', '.join(chosen)}")
 
 
-def main():
+def main(team_aliases=TEAM_ALIASES):
+    """Runs the bot for the workspace of SLACK_BOT_TOKEN. Storage files go to the current directory."""
     thread = None
+    presence_mode = os.environ.get("ACTIVEUSERS_PRESENCE_MODE", PRESENCE_MODE_POLL)
+    journaled_storage = os.environ.get("ACTIVEUSERS_JOURNALED_STORAGE") == "1"
+    # memory-mapped binary storage file instead of JSON, see columnar.py
+    binary_storage = os.environ.get("ACTIVEUSERS_BINARY_STORAGE") == "1"
+    # path of an SQLite database to use instead of the storage file, see storage.py
+    sqlite_path = os.environ.get("ACTIVEUSERS_SQLITE_STORAGE")
+    fresh_mentions = os.environ.get("ACTIVEUSERS_FRESH_MENTIONS") == "1"
+    retention_days = os.environ.get("ACTIVEUSERS_RETENTION_DAYS")
+    retention_days = int(retention_days) if retention_days else None
+    write_behind_seconds = os.environ.get("ACTIVEUSERS_WRITE_BEHIND_SECONDS")
+    write_behind_seconds = float(write_behind_seconds) if write_behind_seconds else None
+    # fails here, the loop below would retry forever
+    check_storage_settings(journaled_storage, binary_storage, sqlite_path)
+    metrics_port = os.environ.get("ACTIVEUSERS_METRICS_PORT")
+    if metrics_port:
+        start_metrics_server(int(metrics_port))
+    # profile every N-th refresh cycle, 0 disables profiling
+    profiler = CycleProfiler(every_n_cycles=int(os.environ.get("ACTIVEUSERS_PROFILE_EVERY", "0")))
     while True:
         try:
-            bolt_app, client = connect_to_slack()
+            bolt_app, client, socket_mode_handler = connect_to_slack()
             groups_dict = GroupsAndUsersThreadSafeDict()
-            thread = RefreshStatusThread(client, groups_dict, sleep_time=3)
-            handle_app_mention_with_param = partial(handle_app_mention, groups_dict)
+            # history is loaded by the refresh thread, mentions are answered from hot state meanwhile
+            if sqlite_path:
+                storage = SqliteStorage(sqlite_path)
+            elif journaled_storage:
+                storage = JournaledFileStorage()
+            elif binary_storage:
+                storage = ColumnarFileStorage()
+            else:
+                storage = JsonFileStorage()
+            activity_tracker = ActivityTracker(
+                read_status_from_file=False, retention_days=retention_days, storage=storage
+            )
+            if presence_mode == PRESENCE_MODE_EVENTS:
+                thread = RefreshStatusThread(
+                    client,
+                    groups_dict,
+                    refresh_seconds=RECONCILE_SECONDS,
+                    presence_subscriber=partial(subscribe_to_presence, socket_mode_handler),
+                    events_fallback_seconds=REFRESH_SECONDS,
+                    # only while events do not arrive - polls then as in poll mode
+                    presence_scheduler=PresenceScheduler.for_refresh_interval(REFRESH_SECONDS),
+                    activity_tracker=activity_tracker,
+                    profiler=profiler,
+                    write_behind_seconds=write_behind_seconds,
+                    load_history_in_background=True,
+                )
+                bolt_app.event("presence_change")(partial(handle_presence_change, thread))
+            else:
+                thread = RefreshStatusThread(
+                    client,
+                    groups_dict,
+                    refresh_seconds=REFRESH_SECONDS,
+                    activity_tracker=activity_tracker,
+                    presence_scheduler=PresenceScheduler.for_refresh_interval(REFRESH_SECONDS),
+                    profiler=profiler,
+                    write_behind_seconds=write_behind_seconds,
+                    load_history_in_background=True,
+                )
+            handle_app_mention_with_param = partial(
+                handle_app_mention,
+                groups_dict,
+                refresh_thread=thread,
+                fresh_presence=fresh_mentions,
+                team_aliases=team_aliases,
+                reply_cache=ActiveUsersReplyCache(groups_dict),
+            )
             bolt_app.event("app_mention")(handle_app_mention_with_param)
+            socket_mode_handler.client.message_listeners.append(partial(handle_socket_message, thread))
             thread.start()
             signal.pause()
         except KeyboardInterrupt:
@@ -228,9 +882,8 @@ def main():
             time.sleep(10)  # to prevent tight error loop
         finally:
             print("Stopping thread")
-            if thread is not None and thread.is_alive():
-                thread.request_stop()
-                thread.join()
+            if thread is not None:
+                thread.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""
+Measures handle_app_mention latency while refreshes of a large workspace keep
+publishing new GroupsAndUsersThreadSafeDict snapshots.
+
+    python -m benchmarks.bench_groups_dict --users 20000 --groups 300 --seconds 10
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from functools import partial
+
+from app import handle_app_mention
+from utils import GroupsAndUsersThreadSafeDict, Group, User
+
+BOT_ID = "UBOT"
+
+
+def make_workspace(users_count, groups_count, group_size):
+    users = [User(f"U{i}", f"user{i}", f"User {i}", "", active=random.random() < 0.3) for i in range(users_count)]
+    groups = [
+        Group(f"G{i}", f"group{i}", [u.id for u in random.sample(users, min(group_size, users_count))])
+        for i in range(groups_count)
+    ]
+    return groups, users
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run(users_count, groups_count, group_size, seconds, readers):
+    groups, users = make_workspace(users_count, groups_count, group_size)
+    groups_dict = GroupsAndUsersThreadSafeDict()
+    groups_dict.set_bot_user(User(BOT_ID, "activeusers", "ActiveUsers", ""))
+    groups_dict.update_groups_and_users(groups, users)
+    stop = threading.Event()
+    refreshes = 0
+
+    def refresher():
+        nonlocal refreshes
+        while not stop.is_set():
+            fresh_users = [User(u.id, u.name, u.real_name, u.avatar, active=random.random() < 0.3) for u in users]
+            groups_dict.update_groups_and_users(groups, fresh_users)
+            refreshes += 1
+
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def reader():
+        local = []
+        handler = partial(handle_app_mention, groups_dict, say=lambda **kwargs: None)
+        while not stop.is_set():
+            group = random.choice(groups)
+            event = {"text": f"<@{BOT_ID}> {group.handle} --5", "user": "U0", "ts": "1.0"}
+            start = time.perf_counter()
+            handler(event)
+            local.append(time.perf_counter() - start)
+        with latencies_lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=refresher)] + [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "users": users_count,
+        "groups": groups_count,
+        "refreshes": refreshes,
+        "mentions": len(latencies),
+        "mention_p50_ms": statistics.median(latencies) * 1000,
+        "mention_p99_ms": percentile(latencies, 0.99) * 1000,
+        "mention_max_ms": latencies[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--groups", type=int, default=300)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+    print(json.dumps(run(args.users, args.groups, args.group_size, args.seconds, args.readers)))
+
+
+if __name__ == "__main__":
+    main()
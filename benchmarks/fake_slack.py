@@ -0,0 +1,143 @@
+"""In-process stand-in for slack_sdk.WebClient that simulates a workspace of any size."""
+import math
+import random
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+# Calls per minute that Slack allows for each method (Tier 2 / Tier 3).
+SLACK_RATE_LIMITS = {
+    "users.list": 20,
+    "usergroups.list": 20,
+    "users.getPresence": 50,
+}
+
+
+class FakeRateLimit:
+    def __init__(self, calls_per_minute):
+        self.capacity = calls_per_minute
+        self.rate = calls_per_minute / 60
+        self.tokens = float(calls_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def retry_after(self):
+        """Takes a token and returns 0, or returns seconds until a token is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class FakeWebClient:
+    """
+    Simulates a workspace with `users_count` users and `groups_count` user groups.
+
+    Every method sleeps `latency` seconds, answers 429 with Retry-After when its
+    per-minute rate limit (`rate_limits`, None to disable) is exceeded, and randomly
+    answers 429 with probability `error_rate`.
+    """
+
+    def __init__(
+        self,
+        users_count=1000,
+        groups_count=100,
+        group_size=30,
+        active_ratio=0.3,
+        latency=0.0,
+        rate_limits=None,
+        error_rate=0.0,
+        bot_name="ActiveUsers",
+        seed=0,
+    ):
+        self._random = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.active_ratio = active_ratio
+        self.users = [
+            {
+                "id": f"U{i:06d}",
+                "name": f"user{i}",
+                "deleted": False,
+                "is_bot": False,
+                "profile": {"real_name": f"User {i}", "image_48": f"https://avatars.example/{i}.png"},
+            }
+            for i in range(users_count)
+        ]
+        self.users.append(
+            {
+                "id": "UBOT",
+                "name": "activeusers",
+                "deleted": False,
+                "is_bot": True,
+                "real_name": bot_name,
+                "profile": {"real_name": bot_name, "image_48": ""},
+            }
+        )
+        user_ids = [u["id"] for u in self.users if not u["is_bot"]]
+        self.usergroups = [
+            {
+                "id": f"G{i:04d}",
+                "handle": f"group{i}",
+                "users": self._random.sample(user_ids, min(group_size, len(user_ids))),
+            }
+            for i in range(groups_count)
+        ]
+        self.active_ids = set(self._random.sample(user_ids, int(len(user_ids) * active_ratio)))
+        self._rate_limits = {
+            method: FakeRateLimit(calls) for method, calls in (rate_limits or {}).items()
+        }
+        self.calls = {}
+        self.rate_limited_calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        retry_after = 0
+        rate_limit = self._rate_limits.get(method)
+        if rate_limit is not None:
+            retry_after = rate_limit.retry_after()
+        if not retry_after and self.error_rate and self._random.random() < self.error_rate:
+            retry_after = 1
+        if retry_after:
+            with self._lock:
+                self.rate_limited_calls += 1
+            response = SlackResponse(
+                client=self,
+                http_verb="POST",
+                api_url=f"https://slack.com/api/{method}",
+                req_args={},
+                data={"ok": False, "error": "ratelimited"},
+                headers={"Retry-After": str(math.ceil(retry_after))},
+                status_code=429,
+            )
+            raise SlackApiError("ratelimited", response)
+
+    def flip_presence(self, ratio=0.05):
+        """Changes presence of a random subset of users."""
+        for user in self._random.sample(self.users, int(len(self.users) * ratio)):
+            self.active_ids.symmetric_difference_update({user["id"]})
+
+    def users_list(self, limit=200, cursor=None):
+        self._call("users.list")
+        start = int(cursor or 0)
+        end = start + (limit or 200)
+        next_cursor = str(end) if end < len(self.users) else ""
+        return {"ok": True, "members": self.users[start:end], "response_metadata": {"next_cursor": next_cursor}}
+
+    def usergroups_list(self, include_users=False):
+        self._call("usergroups.list")
+        return {"ok": True, "usergroups": self.usergroups}
+
+    def users_getPresence(self, user):
+        self._call("users.getPresence")
+        return {"ok": True, "presence": "active" if user in self.active_ids else "away"}
@@ -0,0 +1,339 @@
+"""
+Benchmarks refresh cycles, mention handling, activity persistence, startup and the binary history
+format against FakeWebClient.
+Prints one JSON object per scenario, so results can be compared between commits.
+
+    python -m benchmarks.run --users 1000 10000 --groups 300 --output results.jsonl
+"""
+import argparse
+import contextlib
+import datetime
+import gc
+import gzip
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+
+import columnar
+from activity_tracker import ActivityTracker, DateTimeRange
+from analytics import load_tracker
+from app import RefreshStatusThread, handle_app_mention
+from benchmarks.fake_slack import FakeWebClient, SLACK_RATE_LIMITS
+from metrics import metrics
+from presence import PresenceFetcher, PresenceScheduler, TokenBucket
+from storage import JournaledFileStorage, JsonFileStorage
+from utils import ActiveUsersReplyCache, GroupsAndUsersThreadSafeDict
+
+UNLIMITED_CALLS_PER_MINUTE = 10**9
+
+
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {
+        "count": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def make_refresh_thread(client, slack_limits, workers, calls_per_cycle=None):
+    presence_calls = SLACK_RATE_LIMITS["users.getPresence"] if slack_limits else UNLIMITED_CALLS_PER_MINUTE
+    directory_calls = SLACK_RATE_LIMITS["users.list"] if slack_limits else UNLIMITED_CALLS_PER_MINUTE
+    return RefreshStatusThread(
+        client,
+        GroupsAndUsersThreadSafeDict(),
+        presence_fetcher=PresenceFetcher(client, bucket=TokenBucket(presence_calls), max_workers=workers),
+        activity_tracker=ActivityTracker(read_status_from_file=False),
+        directory_bucket=TokenBucket(directory_calls),
+        presence_scheduler=None if calls_per_cycle is None else PresenceScheduler(calls_per_cycle),
+    )
+
+
+def bench_refresh(args, users_count):
+    client = FakeWebClient(
+        users_count=users_count,
+        groups_count=args.groups,
+        group_size=args.group_size,
+        latency=args.latency,
+        rate_limits=SLACK_RATE_LIMITS if args.slack_limits else None,
+        error_rate=args.error_rate,
+    )
+    thread = make_refresh_thread(client, args.slack_limits, args.workers, args.calls_per_cycle)
+    start = time.perf_counter()
+    thread.refresh_directory()
+    directory_seconds = time.perf_counter() - start
+
+    cycle_seconds = []
+    gc_collections = sum(stats["collections"] for stats in gc.get_stats())
+    for _ in range(args.cycles):
+        client.flip_presence()
+        start = time.perf_counter()
+        thread.refresh_presence()
+        cycle_seconds.append(time.perf_counter() - start)
+    gc_collections = sum(stats["collections"] for stats in gc.get_stats()) - gc_collections
+    presence_calls = client.calls.get("users.getPresence", 0)
+
+    # allocations are traced in separate cycles, tracing slows them down
+    client.flip_presence()
+    tracemalloc.start()
+    thread.refresh_presence()
+    _, cycle_peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "scenario": "refresh",
+        "users": users_count,
+        "groups": args.groups,
+        "directory_refresh_seconds": directory_seconds,
+        "presence_cycle": latency_stats(cycle_seconds),
+        "presence_calls_per_second": presence_calls / sum(cycle_seconds),
+        "rate_limited_calls": client.rate_limited_calls,
+        "gc_collections_per_cycle": gc_collections / args.cycles,
+        "cycle_peak_traced_bytes": cycle_peak_bytes,
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def bench_mention(args, users_count):
+    client = FakeWebClient(users_count=users_count, groups_count=args.groups, group_size=args.group_size)
+    thread = make_refresh_thread(client, slack_limits=False, workers=args.workers)
+    tracemalloc.start()
+    thread.refresh_directory()
+    thread.refresh_presence()
+    retained_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    groups_dict = thread._groups_users_dict
+    handler = partial(
+        handle_app_mention, groups_dict, say=lambda **kwargs: None, reply_cache=ActiveUsersReplyCache(groups_dict)
+    )
+    hits_before = metrics.get("activeusers_reply_cache_total", result="hit") or 0
+    handles = groups_dict.get_groups_handles()
+    rng = random.Random(0)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.mentions):
+        text = f"<@UBOT> {rng.choice(handles)}" + (" --5" if i % 2 else "")
+        event = {"text": text, "user": "U000000", "ts": "1.0"}
+        mention_start = time.perf_counter()
+        handler(event)
+        latencies.append(time.perf_counter() - mention_start)
+    total = time.perf_counter() - start
+    return {
+        "scenario": "mention",
+        "users": users_count,
+        "groups": args.groups,
+        "mentions_per_second": args.mentions / total,
+        "reply_cache_hit_ratio": (metrics.get("activeusers_reply_cache_total", result="hit") - hits_before) / args.mentions,
+        "latency": latency_stats(latencies),
+        "state_retained_bytes": retained_bytes,
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def make_history(tracker, users_count, intervals_per_user):
+    dt = datetime.datetime(2024, 1, 1)
+    for i in range(users_count):
+        ranges = tracker.user_to_time_ranges[f"U{i:06d}"]
+        start = dt
+        for _ in range(intervals_per_user):
+            end = start + datetime.timedelta(minutes=40)
+            ranges.append(DateTimeRange(start, end))
+            start = end + datetime.timedelta(hours=3)
+    return start
+
+
+def bench_persistence(args, users_count):
+    results = []
+    for journaled in (False, True):
+        storage = JournaledFileStorage() if journaled else JsonFileStorage()
+        tracker = ActivityTracker(read_status_from_file=False, storage=storage)
+        tracemalloc.start()
+        last_dt = make_history(tracker, users_count, args.intervals)
+        retained_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        tracker.store_activity_in_file()
+        store_seconds = time.perf_counter() - start
+        file_bytes = os.path.getsize(ActivityTracker.STORAGE_FILE)
+
+        all_users = set(tracker.user_to_time_ranges)
+        save_seconds = []
+        for cycle in range(args.cycles):
+            active = {user for user in all_users if random.random() < 0.3}
+            dt = last_dt + datetime.timedelta(minutes=2 * (cycle + 1))
+            start = time.perf_counter()
+            tracker.save_activity_status(active_users=active, inactive_users=all_users - active, dt=dt)
+            save_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ActivityTracker(read_status_from_file=True, storage=JournaledFileStorage() if journaled else JsonFileStorage())
+        load_seconds = time.perf_counter() - start
+        results.append(
+            {
+                "scenario": "persistence",
+                "journaled": journaled,
+                "users": users_count,
+                "intervals": users_count * args.intervals,
+                "store_seconds": store_seconds,
+                "file_bytes": file_bytes,
+                "save_cycle": latency_stats(save_seconds),
+                "load_seconds": load_seconds,
+                "history_retained_bytes": retained_bytes,
+                "max_rss_bytes": max_rss_bytes(),
+            }
+        )
+        for path in (ActivityTracker.STORAGE_FILE, ActivityTracker.JOURNAL_FILE):
+            if os.path.exists(path):
+                os.unlink(path)
+    return results
+
+
+def bench_binary(args, users_count):
+    tracker = ActivityTracker(read_status_from_file=False)
+    last_dt = make_history(tracker, users_count, args.intervals)
+    tracker.store_activity_in_file()
+    start = time.perf_counter()
+    columnar.convert_to_binary(ActivityTracker.STORAGE_FILE, columnar.FILE)
+    convert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    json_tracker = load_tracker()
+    json_load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    binary_tracker = ActivityTracker(read_status_from_file=False)
+    columnar.load(binary_tracker, columnar.FILE)
+    binary_load_seconds = time.perf_counter() - start
+
+    # queries read the mapped file directly
+    query_dt = last_dt - datetime.timedelta(days=1)
+    query_seconds = {}
+    for name, loaded in (("json", json_tracker), ("binary", binary_tracker)):
+        start = time.perf_counter()
+        loaded.active_users_at(query_dt)
+        query_seconds[name] = time.perf_counter() - start
+    with open(columnar.FILE, "rb") as f:
+        binary_gzip_bytes = len(gzip.compress(f.read()))
+    return {
+        "scenario": "binary",
+        "users": users_count,
+        "intervals": users_count * args.intervals,
+        "json_file_bytes": os.path.getsize(ActivityTracker.STORAGE_FILE),
+        "binary_file_bytes": os.path.getsize(columnar.FILE),
+        "binary_gzip_bytes": binary_gzip_bytes,
+        "convert_seconds": convert_seconds,
+        "json_load_seconds": json_load_seconds,
+        "binary_load_seconds": binary_load_seconds,
+        "json_query_seconds": query_seconds["json"],
+        "binary_query_seconds": query_seconds["binary"],
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def bench_startup(args, users_count):
+    client = FakeWebClient(users_count=users_count, groups_count=args.groups, group_size=args.group_size)
+    thread = make_refresh_thread(client, slack_limits=False, workers=args.workers)
+    thread.refresh_directory()
+    thread.refresh_presence()  # writes the hot state
+    make_history(thread.activity_tracker, users_count, args.intervals)
+    thread.activity_tracker.store_activity_in_file()
+
+    # before: history was parsed before anything else
+    start = time.perf_counter()
+    ActivityTracker(read_status_from_file=True)
+    blocking_load_seconds = time.perf_counter() - start
+
+    groups_dict = GroupsAndUsersThreadSafeDict()
+    start = time.perf_counter()
+    restarted = RefreshStatusThread(
+        client,
+        groups_dict,
+        presence_fetcher=PresenceFetcher(client, bucket=TokenBucket(UNLIMITED_CALLS_PER_MINUTE)),
+        activity_tracker=ActivityTracker(read_status_from_file=False),
+        load_history_in_background=True,
+    )
+    handle = groups_dict.get_groups_handles()[0]
+    groups_dict.get_active_users(handle)
+    ready_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    restarted._load_history()
+    history_seconds = time.perf_counter() - start
+    return {
+        "scenario": "startup",
+        "users": users_count,
+        "intervals": users_count * args.intervals,
+        "blocking_load_seconds": blocking_load_seconds,
+        "ready_for_mentions_seconds": ready_seconds,
+        "background_history_seconds": history_seconds,
+        "storage_file_bytes": os.path.getsize(ActivityTracker.STORAGE_FILE),
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+SCENARIOS = {
+    "refresh": bench_refresh,
+    "mention": bench_mention,
+    "persistence": bench_persistence,
+    "startup": bench_startup,
+    "binary": bench_binary,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--groups", type=int, default=300)
+    parser.add_argument("--group-size", type=int, default=40)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--mentions", type=int, default=20000)
+    parser.add_argument("--intervals", type=int, default=100, help="history intervals per user")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--calls-per-cycle", type=int, help="poll only this many users per cycle, like in poll mode")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fake Slack call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a random 429")
+    parser.add_argument("--slack-limits", action="store_true", help="apply Slack's per-method rate limits")
+    parser.add_argument("--output", help="append results to this file instead of printing them")
+    args = parser.parse_args()
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the tracker and directory cache write files to the current directory
+        os.chdir(work_dir)
+        try:
+            # keep stdout for results only - refresh logs go to stderr
+            with contextlib.redirect_stdout(sys.stderr):
+                for scenario in args.scenarios:
+                    for users_count in args.users:
+                        result = SCENARIOS[scenario](args, users_count)
+                        results.extend(result if isinstance(result, list) else [result])
+        finally:
+            os.chdir(cwd)
+
+    lines = "\n".join(json.dumps(result) for result in results) + "\n"
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Stress and soak test of state shared between the refresh thread and Bolt handler threads.
+
+The refresh thread runs its jobs against FakeWebClient with presence changing all the time,
+while many threads send mentions through handle_app_mention and checkers watch invariants:
+
+- every published snapshot is consistent: active member lists match users' presence,
+- a reply lists exactly the active members of one snapshot (no torn reads),
+- bot_user never changes once set,
+- activity ranges never overlap and their ends never move back.
+
+Prints a JSON line with throughput and mention latency every `--report-every` seconds and a
+summary at the end; exits with 1 if any invariant was violated.
+
+    python -m benchmarks.stress --users 5000 --mention-threads 200 --seconds 600
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+from activity_tracker import ActivityTracker
+from app import RefreshStatusThread, handle_app_mention
+from benchmarks.fake_slack import FakeWebClient
+from benchmarks.run import UNLIMITED_CALLS_PER_MINUTE, max_rss_bytes
+from metrics import metrics
+from presence import PresenceFetcher, TokenBucket
+from utils import ActiveUsersReplyCache, GroupsAndUsersThreadSafeDict
+
+MENTION_ID = re.compile(r"<@(\w+)>")
+MAX_REPORTED_VIOLATIONS = 20
+TRACKER_CHECK_SECONDS = 0.1
+
+
+def tail_latency(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "p999_ms": percentile(0.999),
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def expected_mentions(snapshot, handle, limit, requester):
+    active_user_ids = [user_id for user_id in snapshot.group_handle_to_active_user_ids[handle] if user_id != requester]
+    return active_user_ids if limit is None else active_user_ids[:limit]
+
+
+class StressTest:
+    def __init__(self, args):
+        self.args = args
+        self.client = FakeWebClient(
+            users_count=args.users, groups_count=args.groups, group_size=args.group_size, latency=args.latency
+        )
+        self.groups_dict = GroupsAndUsersThreadSafeDict()
+        self.refresh_thread = RefreshStatusThread(
+            self.client,
+            self.groups_dict,
+            refresh_seconds=args.refresh_seconds,
+            presence_fetcher=PresenceFetcher(
+                self.client, bucket=TokenBucket(UNLIMITED_CALLS_PER_MINUTE), max_workers=args.workers
+            ),
+            activity_tracker=ActivityTracker(read_status_from_file=False),
+            directory_refresh_seconds=args.directory_refresh_seconds,
+            directory_bucket=TokenBucket(UNLIMITED_CALLS_PER_MINUTE),
+            write_behind_seconds=args.write_behind_seconds,
+        )
+        self.handles = [group["handle"] for group in self.client.usergroups]
+        self.handle_to_members = {group["handle"]: group["users"] for group in self.client.usergroups}
+        self.stop = threading.Event()
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.window_latencies = []
+        self.violations = []
+        self.violations_count = 0
+        self.exact_replies = 0
+        self.snapshot_checks = 0
+        self.tracker_checks = 0
+
+    def violation(self, message):
+        with self._lock:
+            self.violations_count += 1
+            if len(self.violations) < MAX_REPORTED_VIOLATIONS:
+                self.violations.append(message)
+
+    def flip_presence(self):
+        while not self.stop.wait(self.args.flip_seconds):
+            self.client.flip_presence(self.args.flip_ratio)
+
+    def send_mentions(self, seed):
+        rng = random.Random(seed)
+        handler = partial(
+            handle_app_mention, self.groups_dict, reply_cache=self.reply_cache, refresh_thread=self.refresh_thread
+        )
+        bot_id = self.groups_dict.bot_user.id
+        latencies = []
+        exact_replies = 0
+        while not self.stop.is_set():
+            handle = rng.choice(self.handles)
+            limit = rng.choice((None, 1, 5))
+            # members are excluded from their own mentions, so ask as one sometimes
+            requester = rng.choice(self.handle_to_members[handle]) if rng.random() < 0.3 else "UOUTSIDER"
+            text = f"<@{bot_id}> {handle}" + ("" if limit is None else f" --{limit}")
+            replies = []
+            before = self.groups_dict.get_snapshot()
+            start = time.perf_counter()
+            handler({"text": text, "user": requester, "ts": "1.0"}, say=lambda **kwargs: replies.append(kwargs["text"]))
+            latencies.append(time.perf_counter() - start)
+            after = self.groups_dict.get_snapshot()
+            if self.groups_dict.bot_user.id != bot_id:
+                self.violation(f"bot_user changed to {self.groups_dict.bot_user.id}")
+            exact_replies += self.check_reply(replies, handle, limit, requester, before, after)
+            if len(latencies) >= 100:
+                self.add_latencies(latencies)
+                latencies = []
+        self.add_latencies(latencies)
+        with self._lock:
+            self.exact_replies += exact_replies
+
+    def add_latencies(self, latencies):
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.window_latencies.extend(latencies)
+
+    def check_reply(self, replies, handle, limit, requester, before, after) -> bool:
+        """Returns True if the reply could be compared with the one snapshot it was built from."""
+        if len(replies) != 1:
+            self.violation(f"{len(replies)} replies to a mention of {handle}")
+            return False
+        reply = replies[0]
+        if f"no active users in group {handle}" in reply:
+            mentioned = []
+        else:
+            _, _, mentions = reply.partition(f" active users of {handle}: ")
+            mentioned = MENTION_ID.findall(mentions)
+        members = set(self.handle_to_members[handle])
+        if requester in mentioned or not members.issuperset(mentioned) or len(set(mentioned)) != len(mentioned):
+            self.violation(f"reply to {requester} about {handle} mentions wrong users: {reply}")
+        if limit is not None and len(mentioned) > limit:
+            self.violation(f"reply about {handle} --{limit} mentions {len(mentioned)} users")
+        if before.version != after.version:
+            return False  # built from either of them, or a snapshot published in between
+        expected = expected_mentions(before, handle, limit, requester)
+        if mentioned != expected:
+            self.violation(f"torn read: reply about {handle} at version {before.version} {mentioned} != {expected}")
+        return True
+
+    def check_snapshots(self):
+        rng = random.Random(1)
+        while not self.stop.wait(0.001):
+            snapshot = self.groups_dict.get_snapshot()
+            for handle in rng.sample(self.handles, min(20, len(self.handles))):
+                active_user_ids = tuple(
+                    sorted(
+                        user_id for user_id in set(self.handle_to_members[handle])
+                        if user_id in snapshot.user_id_to_user and snapshot.user_id_to_user[user_id].active
+                    )
+                )
+                if snapshot.group_handle_to_active_user_ids[handle] != active_user_ids:
+                    self.violation(f"snapshot {snapshot.version} lists wrong active users of {handle}")
+            with self._lock:
+                self.snapshot_checks += 1
+
+    def check_tracker(self):
+        user_to_last = {}
+        rng = random.Random(2)
+        while not self.stop.wait(TRACKER_CHECK_SECONDS):
+            # only what is checked is copied under the lock, checks run without it - holding it
+            # would delay saves and the harness would measure itself
+            with self.refresh_thread._locked_tracker() as tracker:
+                user_to_time_ranges = tracker.user_to_time_ranges
+                user_to_current = {
+                    user: (len(ranges), ranges.starts[-1], ranges.ends[-1])
+                    for user, ranges in user_to_time_ranges.items()
+                }
+                active_users = set(tracker.active_users)
+                sample = rng.sample(list(user_to_time_ranges), min(50, len(user_to_time_ranges)))
+                user_to_sampled_ranges = {user: user_to_time_ranges[user].copy() for user in sample}
+            for user, (count, start, end) in user_to_current.items():
+                if end < start:
+                    self.violation(f"range of {user} ends before it starts")
+                previous = user_to_last.get(user)
+                if previous is not None:
+                    previous_count, previous_end = previous
+                    if count == previous_count and end < previous_end:
+                        self.violation(f"end of the last range of {user} moved back")
+                    if count > previous_count and start < previous_end:
+                        self.violation(f"new range of {user} starts before the previous one ended")
+                user_to_last[user] = count, end
+            for user in active_users - user_to_current.keys():
+                self.violation(f"active user {user} has no range")
+            for user, ranges in user_to_sampled_ranges.items():
+                for i in range(1, len(ranges)):
+                    if ranges.starts[i] < ranges.ends[i - 1]:
+                        self.violation(f"ranges of {user} overlap")
+                        break
+            with self._lock:
+                self.tracker_checks += 1
+
+    def report(self, started_at, window_seconds):
+        with self._lock:
+            window_latencies, self.window_latencies = self.window_latencies, []
+        return {
+            "elapsed_seconds": round(time.monotonic() - started_at, 1),
+            "mentions_per_second": len(window_latencies) / window_seconds,
+            "latency": tail_latency(window_latencies),
+            "snapshot_version": self.groups_dict.get_snapshot().version,
+            "violations": self.violations_count,
+            "max_rss_bytes": max_rss_bytes(),
+        }
+
+    def run(self, output=sys.stdout):
+        args = self.args
+        # directory and first presence, so mentions have something to read from the start
+        self.refresh_thread.refresh_groups_and_users_info()
+        self.reply_cache = ActiveUsersReplyCache(self.groups_dict)
+        cycles_before = (metrics.get("activeusers_job_seconds", job="presence") or (0, 0))[0]
+        self.refresh_thread.start()
+        threads = [threading.Thread(target=self.flip_presence, name="flipper")]
+        threads += [threading.Thread(target=self.check_snapshots, name="snapshot-checker")]
+        threads += [threading.Thread(target=self.check_tracker, name="tracker-checker")]
+        threads += [
+            threading.Thread(target=self.send_mentions, args=(i,), name=f"mentions-{i}")
+            for i in range(args.mention_threads)
+        ]
+        started_at = time.monotonic()
+        for thread in threads:
+            thread.start()
+        try:
+            deadline = started_at + args.seconds
+            while True:
+                window = min(args.report_every, deadline - time.monotonic())
+                if window <= 0:
+                    break
+                time.sleep(window)
+                if args.report_every < args.seconds:
+                    output.write(json.dumps(self.report(started_at, window)) + "\n")
+                    output.flush()
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+            self.refresh_thread.shutdown()
+        elapsed = time.monotonic() - started_at
+        cycles = (metrics.get("activeusers_job_seconds", job="presence") or (0, 0))[0] - cycles_before
+        return {
+            "users": args.users,
+            "groups": args.groups,
+            "mention_threads": args.mention_threads,
+            "seconds": elapsed,
+            "presence_cycles": cycles,
+            "snapshot_version": self.groups_dict.get_snapshot().version,
+            "mentions_per_second": len(self.latencies) / elapsed,
+            "latency": tail_latency(self.latencies),
+            "exact_replies": self.exact_replies,
+            "snapshot_checks": self.snapshot_checks,
+            "tracker_checks": self.tracker_checks,
+            "violations": self.violations_count,
+            "violation_examples": self.violations,
+            "max_rss_bytes": max_rss_bytes(),
+        }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--group-size", type=int, default=40)
+    parser.add_argument("--mention-threads", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--report-every", type=float, default=10)
+    parser.add_argument("--refresh-seconds", type=float, default=0.1, help="interval of presence polling")
+    parser.add_argument("--directory-refresh-seconds", type=float, default=5)
+    parser.add_argument("--write-behind-seconds", type=float, default=1)
+    parser.add_argument("--flip-seconds", type=float, default=0.02, help="how often presence changes")
+    parser.add_argument("--flip-ratio", type=float, default=0.02, help="fraction of users changing presence")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fake Slack call")
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the tracker and directory cache write files to the current directory
+        os.chdir(work_dir)
+        try:
+            stdout = sys.stdout
+            # keep stdout for results only - refresh logs go to stderr
+            sys.stdout = sys.stderr
+            try:
+                result = StressTest(args).run(output=stdout)
+            finally:
+                sys.stdout = stdout
+        finally:
+            os.chdir(cwd)
+    print(json.dumps(result))
+    sys.exit(1 if result["violations"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Binary columnar format of ActivityTracker state, loaded by memory-mapping the file.
+
+The JSON storage file keeps every range as two ISO timestamps that have to be parsed one
+by one. This format keeps the int64 arrays of TimeRangeList as they are in memory:
+
+    header      magic, now, journal_seq and sizes of the sections below (little-endian int64)
+    offsets     int64[users + 1] - ranges of the i-th user are [offsets[i], offsets[i + 1])
+    starts      int64[ranges]    - epoch microseconds
+    ends        int64[ranges]
+    user ids    utf-8, separated by newlines
+    rest        JSON with active users and activity totals
+
+ColumnarFileStorage keeps the tracker's state in this format; the bot uses it with
+ACTIVEUSERS_BINARY_STORAGE=1, after converting its storage file with to-binary below.
+Loaded ranges are read-only views of the mapped file, a user's arrays are copied only when
+their ranges change. TimeRangeList.cumulative is derived from starts and ends, so it is not
+stored; it is computed for a user on the first duration query. Conversion from and to the JSON storage file:
+
+    python -m columnar to-binary activeusers_storage.json activeusers_storage.bin
+    python -m columnar to-json activeusers_storage.bin activeusers_storage.json
+"""
+import argparse
+import datetime
+import gzip
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+from activity_tracker import (
+    ActivityTracker,
+    EnhancedJSONEncoder,
+    TimeRangeList,
+    datetime_to_micros,
+    micros_to_datetime,
+    write_file_atomically,
+)
+from storage import FileStorage
+
+FILE = "activeusers_storage.bin"
+MAGIC = b"AUCOL002"
+# magic, now, journal_seq, users, ranges, user ids bytes, rest bytes
+HEADER = struct.Struct("<8s6q")
+ITEM_SIZE = 8
+
+
+def dumps(snapshot: dict, now: datetime.datetime) -> bytes:
+    """Serializes ActivityTracker.take_snapshot()."""
+    user_to_time_ranges = snapshot["user_to_time_ranges"]
+    offsets, starts, ends = array("q", [0]), array("q"), array("q")
+    for ranges in user_to_time_ranges.values():
+        starts.extend(ranges.starts)
+        ends.extend(ranges.ends)
+        offsets.append(len(starts))
+    user_ids = "\n".join(user_to_time_ranges).encode()
+    rest = json.dumps(
+        {"active_users": snapshot["active_users"], "user_to_activity_totals": snapshot["user_to_activity_totals"]}
+    ).encode()
+    header = HEADER.pack(
+        MAGIC, datetime_to_micros(now), snapshot["journal_seq"], len(user_to_time_ranges), len(starts),
+        len(user_ids), len(rest),
+    )
+    columns = [offsets, starts, ends]
+    if sys.byteorder != "little":
+        for column in columns:
+            column.byteswap()
+    return b"".join([header, *(column.tobytes() for column in columns), user_ids, rest])
+
+
+def _int64_column(view: memoryview, position: int, count: int):
+    column = view[position:position + count * ITEM_SIZE].cast("q")
+    if sys.byteorder != "little":
+        column = array("q", column)  # no way to map it - copy and swap
+        column.byteswap()
+    return column
+
+
+def load(tracker: ActivityTracker, path=FILE) -> datetime.datetime:
+    """Restores tracker state from the file without parsing ranges. Returns time the state was saved."""
+    with open(path, "rb") as f:
+        # the mapping stays valid after the file is closed, and files are replaced by rename, never rewritten
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    magic, now, journal_seq, users_count, ranges_count, user_ids_size, rest_size = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not an activity file in binary format")
+    position = HEADER.size
+    offsets = _int64_column(view, position, users_count + 1)
+    position += (users_count + 1) * ITEM_SIZE
+    starts = _int64_column(view, position, ranges_count)
+    ends = _int64_column(view, position + ranges_count * ITEM_SIZE, ranges_count)
+    position += 2 * ranges_count * ITEM_SIZE
+    user_ids = bytes(view[position:position + user_ids_size]).decode().split("\n") if users_count else []
+    position += user_ids_size
+    rest = json.loads(bytes(view[position:position + rest_size]))
+
+    tracker.active_users = set(rest["active_users"])
+    tracker.user_to_time_ranges.clear()
+    for i, user in enumerate(user_ids):
+        window = slice(offsets[i], offsets[i + 1])
+        tracker.user_to_time_ranges[user] = TimeRangeList.wrap(starts[window], ends[window])
+    tracker.user_to_activity_totals.clear()
+    for user, totals in rest["user_to_activity_totals"].items():
+        tracker.user_to_activity_totals[user] = totals
+    tracker._journal_seq = journal_seq
+    return micros_to_datetime(now)
+
+
+class ColumnarFileStorage(FileStorage):
+    """Stores the whole state in binary format. Loading maps the file instead of parsing it."""
+
+    def __init__(self, path=FILE):
+        super().__init__(path)
+
+    def load(self, tracker: ActivityTracker) -> datetime.datetime:
+        return load(tracker, self.path)
+
+    def serialize(self, snapshot: dict, now: datetime.datetime) -> bytes:
+        return dumps(snapshot, now)
+
+
+def convert_to_binary(json_path, binary_path):
+    with gzip.open(json_path, "rt") as f:
+        activity_dict = json.load(f)
+    tracker = ActivityTracker(read_status_from_file=False)
+    then = tracker._restore_activity_status_from_dict(activity_dict)
+    write_file_atomically(binary_path, dumps(tracker.take_snapshot(), then))
+    return tracker
+
+
+def convert_to_json(binary_path, json_path):
+    tracker = ActivityTracker(read_status_from_file=False)
+    then = load(tracker, binary_path)
+    content = json.dumps({**tracker.take_snapshot(), "now": then.isoformat()}, cls=EnhancedJSONEncoder)
+    write_file_atomically(json_path, gzip.compress(content.encode()))
+    return tracker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_binary = subparsers.add_parser("to-binary", help="convert a storage file to binary format")
+    to_binary.add_argument("json_path", nargs="?", default=ActivityTracker.STORAGE_FILE)
+    to_binary.add_argument("binary_path", nargs="?", default=FILE)
+    to_json = subparsers.add_parser("to-json", help="convert a binary file back to a storage file")
+    to_json.add_argument("binary_path", nargs="?", default=FILE)
+    to_json.add_argument("json_path", nargs="?", default=ActivityTracker.STORAGE_FILE)
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        tracker = convert_to_binary(args.json_path, args.binary_path)
+        target = args.binary_path
+    else:
+        tracker = convert_to_json(args.binary_path, args.json_path)
+        target = args.json_path
+    ranges_count = sum(len(ranges) for ranges in tracker.user_to_time_ranges.values())
+    print(f"Wrote {ranges_count} ranges of {len(tracker.user_to_time_ranges)} users to {target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import dataclasses
+import gzip
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+from activity_tracker import write_file_atomically
+from utils import User, Group, user_dict_to_user, group_dict_to_group
+
+
+@dataclass
+class Directory:
+    """Workspace roster: users and groups, without presence."""
+    user_id_to_user: Dict[str, User] = field(default_factory=dict)
+    group_handle_to_group: Dict[str, Group] = field(default_factory=dict)
+    bot_user: Optional[User] = None
+    fetched_at: float = 0.0
+    _users_in_groups_ids: Optional[FrozenSet[str]] = field(default=None, repr=False, compare=False)
+
+    def users_in_groups_ids(self) -> FrozenSet[str]:
+        """Ids of all members of groups. Computed once - a directory is not modified after it is built, apart from `fetched_at`."""
+        if self._users_in_groups_ids is None:
+            user_ids = set()
+            for group in self.group_handle_to_group.values():
+                user_ids.update(group.user_ids)
+            self._users_in_groups_ids = frozenset(user_ids)
+        return self._users_in_groups_ids
+
+
+@dataclass
+class DirectoryDiff:
+    added_users: Set[str] = field(default_factory=set)
+    removed_users: Set[str] = field(default_factory=set)
+    changed_users: Set[str] = field(default_factory=set)
+    added_groups: Set[str] = field(default_factory=set)
+    removed_groups: Set[str] = field(default_factory=set)
+    changed_groups: Set[str] = field(default_factory=set)
+
+    def is_empty(self):
+        return not any(dataclasses.astuple(self))
+
+    def __str__(self):
+        return (
+            f"users +{len(self.added_users)} -{len(self.removed_users)} ~{len(self.changed_users)}, "
+            f"groups +{len(self.added_groups)} -{len(self.removed_groups)} ~{len(self.changed_groups)}"
+        )
+
+
+def build_directory(user_dicts, group_dicts, bot_name, fetched_at=None) -> Directory:
+    directory = Directory(fetched_at=time.time() if fetched_at is None else fetched_at)
+    for user_dict in user_dicts:
+        if user_dict["is_bot"] and user_dict.get("real_name") == bot_name:
+            directory.bot_user = user_dict_to_user(user_dict)
+            continue
+        if user_dict["deleted"] or user_dict["is_bot"]:
+            continue
+        user = user_dict_to_user(user_dict)
+        directory.user_id_to_user[user.id] = user
+    for group_dict in group_dicts:
+        group = group_dict_to_group(group_dict)
+        directory.group_handle_to_group[group.handle] = group
+    return directory
+
+
+def _merge(old: Dict, new: Dict, added: Set, removed: Set, changed: Set) -> Dict:
+    merged = {}
+    for key, new_value in new.items():
+        old_value = old.get(key)
+        if old_value is None:
+            added.add(key)
+            merged[key] = new_value
+        elif old_value != new_value:
+            changed.add(key)
+            merged[key] = new_value
+        else:
+            merged[key] = old_value
+    removed.update(old.keys() - new.keys())
+    return merged
+
+
+def merge_directories(old: Directory, new: Directory) -> Tuple[Directory, DirectoryDiff]:
+    """
+    Returns directory equal to `new` that reuses objects of `old` which did not change,
+    and the differences between both. When nothing changed it is `old` itself with
+    `fetched_at` of `new`, so nothing has to be published again.
+    """
+    diff = DirectoryDiff()
+    user_id_to_user = _merge(
+        old.user_id_to_user, new.user_id_to_user, diff.added_users, diff.removed_users, diff.changed_users
+    )
+    group_handle_to_group = _merge(
+        old.group_handle_to_group,
+        new.group_handle_to_group,
+        diff.added_groups,
+        diff.removed_groups,
+        diff.changed_groups,
+    )
+    if old.bot_user == new.bot_user:
+        if diff.is_empty():
+            old.fetched_at = new.fetched_at
+            return old, diff
+        bot_user = old.bot_user
+    else:
+        bot_user = new.bot_user
+    return Directory(user_id_to_user, group_handle_to_group, bot_user, new.fetched_at), diff
+
+
+def store_directory(path, directory: Directory):
+    content = json.dumps(
+        {
+            "users": [dataclasses.asdict(user) for user in directory.user_id_to_user.values()],
+            "groups": [dataclasses.asdict(group) for group in directory.group_handle_to_group.values()],
+            "bot_user": None if directory.bot_user is None else dataclasses.asdict(directory.bot_user),
+            "fetched_at": directory.fetched_at,
+        }
+    )
+    write_file_atomically(path, gzip.compress(content.encode()))
+
+
+def load_directory(path) -> Optional[Directory]:
+    """
+    Returns cached directory or None if there is no readable cache. A cache written by
+    another version (other User or Group fields) counts as unreadable.
+    """
+    try:
+        with gzip.open(path, "rt") as f:
+            content = json.load(f)
+        directory = Directory(fetched_at=content["fetched_at"])
+        for user_dict in content["users"]:
+            user = User(**user_dict)
+            directory.user_id_to_user[user.id] = user
+        for group_dict in content["groups"]:
+            group = Group(**group_dict)
+            directory.group_handle_to_group[group.handle] = group
+        if content["bot_user"] is not None:
+            directory.bot_user = User(**content["bot_user"])
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    return directory
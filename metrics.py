@@ -0,0 +1,186 @@
+"""
+Process-wide metrics exposed in Prometheus text format.
+
+    from metrics import metrics
+    metrics.inc("activeusers_slack_calls_total", method="users.getPresence")
+    with metrics.time("activeusers_refresh_cycle_seconds"):
+        ...
+"""
+import cProfile
+import datetime
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+def _labels_key(labels) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels_key, extra=()):
+    pairs = list(labels_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(key, value.replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class _Histogram:
+    __slots__ = ("bucket_counts", "count", "sum")
+
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._types: Dict[str, str] = {}
+        self._values: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, _Histogram]] = {}
+
+    def _register(self, name, metric_type):
+        registered = self._types.setdefault(name, metric_type)
+        assert registered == metric_type, f"{name} is a {registered}, not a {metric_type}"
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._register(name, COUNTER)
+            values = self._values.setdefault(name, {})
+            key = _labels_key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._register(name, GAUGE)
+            self._values.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            self._register(name, HISTOGRAM)
+            histograms = self._histograms.setdefault(name, {})
+            key = _labels_key(labels)
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = _Histogram(self._buckets)
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    histogram.bucket_counts[i] += 1
+            histogram.count += 1
+            histogram.sum += value
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        """Returns value of a counter or gauge, or (count, sum) of a histogram."""
+        key = _labels_key(labels)
+        with self._lock:
+            if name in self._histograms:
+                histogram = self._histograms[name].get(key)
+                return None if histogram is None else (histogram.count, histogram.sum)
+            return self._values.get(name, {}).get(key)
+
+    def render(self, extra_labels=None) -> str:
+        """Returns all metrics in Prometheus text exposition format."""
+        extra = _labels_key(extra_labels or {})
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                metric_type = self._types[name]
+                lines.append(f"# TYPE {name} {metric_type}")
+                if metric_type != HISTOGRAM:
+                    for key, value in sorted(self._values[name].items()):
+                        lines.append(f"{name}{_format_labels(key, extra)} {value}")
+                    continue
+                for key, histogram in sorted(self._histograms[name].items()):
+                    for bound, count in zip(self._buckets, histogram.bucket_counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, extra + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, extra + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_count{_format_labels(key, extra)} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key, extra)} {histogram.sum}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    render: Callable[[], str] = metrics.render
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the log
+
+
+def start_metrics_server(
+    port, host="127.0.0.1", registry: Metrics = metrics, render: Optional[Callable[[], str]] = None
+) -> ThreadingHTTPServer:
+    """
+    Serves /metrics from a daemon thread. Call shutdown() on the result to stop it.
+    `render` replaces registry.render, e.g. to serve metrics gathered from other processes.
+    """
+    render = render or registry.render
+    handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"render": staticmethod(render)})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True)
+    thread.start()
+    return server
+
+
+class CycleProfiler:
+    """
+    Profiles every `every_n_cycles`-th refresh cycle with cProfile and, if tracemalloc
+    is tracing, dumps a memory snapshot next to it. Files go to `output_dir`.
+    """
+
+    def __init__(self, every_n_cycles, output_dir="profiles"):
+        self.every_n_cycles = every_n_cycles
+        self.output_dir = output_dir
+        self._cycles = 0
+
+    @contextmanager
+    def profile_cycle(self, name="refresh"):
+        self._cycles += 1
+        if self.every_n_cycles <= 0 or self._cycles % self.every_n_cycles != 0:
+            yield
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.output_dir, f"{name}-{stamp}.prof"))
+            if tracemalloc.is_tracing():
+                tracemalloc.take_snapshot().dump(os.path.join(self.output_dir, f"{name}-{stamp}.tracemalloc"))
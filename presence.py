@@ -0,0 +1,269 @@
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from typing import Callable, Dict, Iterable, Optional, Mapping, List
+from urllib.error import URLError
+
+from slack_sdk.errors import SlackApiError
+
+from metrics import metrics
+
+MINUTE = 60
+
+# users.getPresence is a Tier 3 method: 50+ calls per minute per workspace.
+PRESENCE_CALLS_PER_MINUTE = 50
+# users.list and usergroups.list are Tier 2 methods: 20+ calls per minute.
+DIRECTORY_CALLS_PER_MINUTE = 20
+
+NETWORK_ERRORS = (SlackApiError, URLError, socket.timeout, socket.error, HTTPException)
+
+
+def get_retry_after(error: SlackApiError) -> Optional[float]:
+    """Returns Retry-After seconds if the error is a 429 response, None otherwise."""
+    response = error.response
+    if response is None or response.status_code != 429:
+        return None
+    for key, value in (response.headers or {}).items():
+        if key.lower() == "retry-after":
+            try:
+                return float(value[0] if isinstance(value, list) else value)
+            except (TypeError, ValueError):
+                break
+    return 1.0
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all callers of one Slack API tier.
+
+    The bucket starts full, so a cycle can spend the whole per-minute budget
+    immediately and is then paced at `calls` per `period`.
+    """
+
+    def __init__(self, calls, period=MINUTE, clock=time.monotonic, sleep=time.sleep, name="default"):
+        self.name = name
+        self.capacity = float(calls)
+        self.rate = calls / period
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Takes a token and returns 0, or returns how many seconds to wait for one."""
+        with self._lock:
+            now = self._clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(
+        self, should_stop: Callable[[], bool] = lambda: False, stop_event: Optional[threading.Event] = None
+    ) -> bool:
+        """
+        Blocks until a token is taken. Returns False if stopped while waiting.
+        Setting `stop_event` interrupts the wait at once.
+        """
+        while not should_stop():
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            wait = min(wait, 1.0)
+            metrics.inc("activeusers_rate_limit_sleep_seconds_total", wait, bucket=self.name)
+            if stop_event is None:
+                self._sleep(wait)
+            elif stop_event.wait(wait):
+                return False
+        return False
+
+    def pause(self, seconds):
+        """Stops handing out tokens for `seconds` - used when Slack answers with 429."""
+        with self._lock:
+            now = self._clock()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = now
+
+
+def call_with_retries(
+    bucket: TokenBucket,
+    call,
+    max_retries=3,
+    should_stop: Callable[[], bool] = lambda: False,
+    method="unknown",
+    stop_event: Optional[threading.Event] = None,
+):
+    """
+    Makes a Slack API call within the bucket's budget, retrying 429 responses after
+    Retry-After seconds. Returns None if stopped while waiting for the budget.
+    """
+    for attempt in range(max_retries + 1):
+        if not bucket.acquire(should_stop, stop_event):
+            return None
+        start = time.perf_counter()
+        try:
+            response = call()
+        except SlackApiError as e:
+            metrics.observe("activeusers_slack_call_seconds", time.perf_counter() - start, method=method)
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                metrics.inc("activeusers_slack_calls_total", method=method, status="error")
+                raise
+            metrics.inc("activeusers_slack_calls_total", method=method, status="rate_limited")
+            if attempt == max_retries:
+                raise
+            bucket.pause(retry_after)
+            continue
+        except NETWORK_ERRORS:
+            metrics.inc("activeusers_slack_calls_total", method=method, status="error")
+            raise
+        metrics.observe("activeusers_slack_call_seconds", time.perf_counter() - start, method=method)
+        metrics.inc("activeusers_slack_calls_total", method=method, status="ok")
+        return response
+    return None
+
+
+class PresenceFetcher:
+    def __init__(
+        self,
+        slack_client,
+        bucket: Optional[TokenBucket] = None,
+        max_workers=8,
+        max_retries=3,
+    ):
+        self._client = slack_client
+        self.bucket = bucket or TokenBucket(PRESENCE_CALLS_PER_MINUTE, name="presence")
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+    def get_user_presence(
+        self, user_id, should_stop: Callable[[], bool] = lambda: False, stop_event: Optional[threading.Event] = None
+    ):
+        response = call_with_retries(
+            self.bucket,
+            lambda: self._client.users_getPresence(user=user_id),
+            max_retries=self.max_retries,
+            should_stop=should_stop,
+            method="users.getPresence",
+            stop_event=stop_event,
+        )
+        return None if response is None else response["presence"]
+
+    def fetch(
+        self,
+        user_ids: Iterable[str],
+        should_stop: Callable[[], bool] = lambda: False,
+        stop_event: Optional[threading.Event] = None,
+    ) -> Dict[str, str]:
+        """
+        Fetches presence of all users concurrently. Users whose presence could not be
+        fetched (network error, stop requested) are missing from the result.
+        """
+        def fetch_one(user_id):
+            try:
+                return user_id, self.get_user_presence(user_id, should_stop, stop_event)
+            except NETWORK_ERRORS:
+                return user_id, None
+
+        user_to_presence = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="presence") as executor:
+            for user_id, presence in executor.map(fetch_one, list(user_ids)):
+                if presence is not None:
+                    user_to_presence[user_id] = presence
+        return user_to_presence
+
+
+class PresenceScheduler:
+    """
+    Picks which users to poll in a cycle when the rate-limit budget can't cover everyone.
+
+    Every user gets a weight: 1, plus how often their groups were mentioned recently, plus
+    a bonus if their presence changed recently. Users are polled in order of
+    weight * seconds since last poll, so important users are polled more often while
+    everyone else is still refreshed eventually.
+    """
+
+    def __init__(
+        self,
+        calls_per_cycle,
+        mention_weight=1.0,
+        volatility_weight=4.0,
+        volatility_window=60 * MINUTE,
+        mentions_half_life=24 * 60 * MINUTE,
+        clock=time.time,
+    ):
+        self.calls_per_cycle = max(1, int(calls_per_cycle))
+        self.mention_weight = mention_weight
+        self.volatility_weight = volatility_weight
+        self.volatility_window = volatility_window
+        self.mentions_half_life = mentions_half_life
+        self._clock = clock
+        self._group_scores: Dict[str, float] = {}
+        self._last_group_counts: Dict[str, int] = {}
+        self._last_scores_update = clock()
+        self.user_to_last_poll: Dict[str, float] = {}
+
+    @classmethod
+    def for_refresh_interval(cls, refresh_seconds, calls_per_minute=PRESENCE_CALLS_PER_MINUTE, **kwargs):
+        return cls(calls_per_minute * refresh_seconds / MINUTE, **kwargs)
+
+    def update_group_scores(self, group_request_counts: Mapping[str, int]):
+        """Takes total mention counts per group and adds new mentions to decayed scores."""
+        now = self._clock()
+        decay = 0.5 ** ((now - self._last_scores_update) / self.mentions_half_life)
+        self._last_scores_update = now
+        for group in set(self._group_scores) | set(group_request_counts):
+            new_requests = group_request_counts.get(group, 0) - self._last_group_counts.get(group, 0)
+            self._group_scores[group] = self._group_scores.get(group, 0.0) * decay + max(0, new_requests)
+        self._last_group_counts = dict(group_request_counts)
+
+    def user_weight(self, user_id, groups: Iterable[str], last_change: Optional[float], now) -> float:
+        weight = 1.0
+        weight += self.mention_weight * sum(self._group_scores.get(group, 0.0) for group in groups)
+        if last_change is not None and now - last_change < self.volatility_window:
+            weight += self.volatility_weight
+        return weight
+
+    def select_users(
+        self,
+        user_to_groups: Mapping[str, Iterable[str]],
+        last_change_of: Callable[[str], Optional[float]] = lambda user_id: None,
+    ) -> List[str]:
+        """Returns users to poll in this cycle, most urgent first."""
+        now = self._clock()
+        priorities = []
+        for user_id, groups in user_to_groups.items():
+            last_poll = self.user_to_last_poll.get(user_id)
+            if last_poll is None:
+                priority = float("inf")
+            else:
+                weight = self.user_weight(user_id, groups, last_change_of(user_id), now)
+                priority = weight * (now - last_poll)
+            priorities.append((priority, user_id))
+        priorities.sort(reverse=True)
+        return [user_id for _, user_id in priorities[: self.calls_per_cycle]]
+
+    def mark_polled(self, user_ids: Iterable[str]):
+        now = self._clock()
+        for user_id in user_ids:
+            self.user_to_last_poll[user_id] = now
+
+    def staleness(self, user_ids: Iterable[str]) -> Dict[str, Optional[float]]:
+        """Seconds since last successful poll of each user, None if never polled."""
+        now = self._clock()
+        return {
+            user_id: None if user_id not in self.user_to_last_poll else now - self.user_to_last_poll[user_id]
+            for user_id in user_ids
+        }
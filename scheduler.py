@@ -0,0 +1,127 @@
+"""
+Runs periodic jobs of the bot - directory refresh, presence polling, persistence and compaction.
+
+Instead of waking up every few seconds to check the clock, the scheduler waits on an event
+until the next job is due, so stop() and trigger() take effect at once.
+"""
+import datetime
+import random
+import time
+from dataclasses import dataclass
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Optional
+
+from metrics import metrics
+
+
+@dataclass
+class Job:
+    name: str
+    function: Callable[[], None]
+    interval: float
+    jitter: float = 0.0
+    # background jobs run in their own thread, so they don't delay the others
+    background: bool = False
+    next_run_at: float = 0.0
+    running: bool = False
+    thread: Optional[Thread] = None
+
+
+class JobScheduler:
+    """
+    Runs every job `interval` plus up to `jitter` seconds after its previous start.
+    Jobs run one by one in the thread calling run(), except background ones; a background
+    job that is due while still running runs again when it finishes.
+    Long-running jobs should check `stopped` (or wait on it) to finish quickly on stop().
+    """
+
+    def __init__(self, clock=time.monotonic, rng: random.Random = None):
+        self._clock = clock
+        self._random = rng or random.Random()
+        self._jobs: Dict[str, Job] = {}
+        self._lock = Lock()
+        self._wake = Event()
+        self.stopped = Event()
+
+    def add_job(self, name, function, interval, jitter=0.0, delay=0.0, background=False):
+        """Adds a job that first runs after `delay` seconds."""
+        with self._lock:
+            self._jobs[name] = Job(name, function, interval, jitter, background, next_run_at=self._clock() + delay)
+        self._wake.set()
+
+    def trigger(self, name, delay=0.0):
+        """Runs the job in `delay` seconds unless it is due sooner. Unknown jobs are ignored."""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                return
+            job.next_run_at = min(job.next_run_at, self._clock() + delay)
+        self._wake.set()
+
+    def set_interval(self, name, interval, jitter=0.0):
+        """Changes how often the job runs; a shorter interval also brings its next run closer."""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                return
+            job.interval, job.jitter = interval, jitter
+            job.next_run_at = min(job.next_run_at, self._clock() + interval)
+        self._wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self._wake.set()
+
+    def _execute(self, job: Job):
+        start = time.perf_counter()
+        try:
+            job.function()
+        except Exception as e:
+            metrics.inc("activeusers_job_errors_total", job=job.name)
+            print(f"[{datetime.datetime.now()}] Job {job.name} failed: {e!r}")
+        finally:
+            metrics.observe("activeusers_job_seconds", time.perf_counter() - start, job=job.name)
+            with self._lock:
+                job.running = False
+            if job.background:
+                self._wake.set()  # it may be due again
+
+    def run_pending(self) -> Optional[float]:
+        """Runs jobs that are due. Returns seconds until the next one, None if there is nothing to wait for."""
+        now = self._clock()
+        with self._lock:
+            due = [job for job in self._jobs.values() if job.next_run_at <= now and not job.running]
+            for job in due:
+                # set before running, so the job can be triggered again while it runs
+                job.next_run_at = now + job.interval + self._random.uniform(0, job.jitter)
+                job.running = True
+        for job in due:
+            if self.stopped.is_set():
+                with self._lock:
+                    job.running = False
+                continue
+            if job.background:
+                job.thread = Thread(target=self._execute, args=(job,), name=f"{job.name}-job", daemon=True)
+                job.thread.start()
+            else:
+                self._execute(job)
+        with self._lock:
+            next_runs = [job.next_run_at for job in self._jobs.values() if not job.running]
+        if not next_runs:
+            return None
+        return max(0.0, min(next_runs) - self._clock())
+
+    def run(self):
+        """Runs jobs until stop() is called."""
+        while not self.stopped.is_set():
+            self._wake.clear()
+            timeout = self.run_pending()
+            if not self.stopped.is_set():
+                self._wake.wait(timeout)
+
+    def join_background_jobs(self, timeout=None):
+        """Waits for background jobs that are still running."""
+        with self._lock:
+            threads = [job.thread for job in self._jobs.values() if job.thread is not None]
+        for thread in threads:
+            thread.join(timeout)
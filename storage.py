@@ -0,0 +1,599 @@
+"""
+Storage backends for ActivityTracker.
+
+File storages keep the whole history in tracker memory and write it to
+ActivityTracker.STORAGE_FILE (optionally with a journal). SqliteStorage keeps the history
+in a database: the tracker then keeps only the last range of every user and asks it for history.
+
+One-time import of an existing storage file (and its journal, if any):
+
+    python -m storage migrate activeusers_storage.json activeusers.sqlite3
+"""
+import abc
+import argparse
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from activity_tracker import (
+    ActivityTracker,
+    Compaction,
+    DateTimeRange,
+    EnhancedJSONEncoder,
+    datetime_to_micros,
+    micros_to_datetime,
+    split_into_buckets,
+    write_file_atomically,
+)
+from metrics import metrics
+
+
+class ActivityStorage(abc.ABC):
+    """Interface of ActivityTracker storage backends."""
+
+    # True if the backend keeps the history itself - the tracker then keeps only the last range of every user
+    keeps_history = False
+
+    @abc.abstractmethod
+    def load(self, tracker: ActivityTracker) -> Optional[datetime.datetime]:
+        """
+        Restores the stored state into tracker. Returns time of the last stored save or
+        None if nothing was stored yet; file storages raise FileNotFoundError instead.
+        """
+
+    @abc.abstractmethod
+    def record_transitions(self, tracker: ActivityTracker, dt: datetime.datetime, opened, extended, closed):
+        """Stores ranges of users that changed in one save, after tracker applied them."""
+
+    @abc.abstractmethod
+    def store(self, tracker: ActivityTracker):
+        """Stores the whole state of tracker now."""
+
+    @abc.abstractmethod
+    def active_users_at(self, tracker: ActivityTracker, dt: datetime.datetime) -> Set[str]:
+        pass
+
+    @abc.abstractmethod
+    def ranges_overlapping(
+        self, tracker: ActivityTracker, start: datetime.datetime, end: datetime.datetime
+    ) -> Dict[str, List[DateTimeRange]]:
+        pass
+
+    @abc.abstractmethod
+    def active_duration(
+        self, tracker: ActivityTracker, user: str, start: datetime.datetime, end: datetime.datetime
+    ) -> datetime.timedelta:
+        pass
+
+    def ranges_micros(
+        self, start: int, end: int, users: Optional[Iterable[str]] = None
+    ) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Like ranges_overlapping, but in epoch microseconds and only for `users` if given.
+        Needed only by backends that keep history, file storages' ranges are in tracker memory.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def compact(self, tracker: ActivityTracker, cutoff: datetime.datetime, resolution: str) -> Compaction:
+        """Computes totals of closed ranges that ended before cutoff; see ActivityTracker.prepare_compaction."""
+
+    def apply_compaction(self, tracker: ActivityTracker, compaction: Compaction):
+        """Drops ranges counted by compact, after tracker merged their totals."""
+
+    def close(self):
+        pass
+
+
+class FileStorage(ActivityStorage):
+    """
+    Base of storages that keep the whole history in tracker memory and write snapshots
+    of it to a file - on every save, or through tracker.persister if it has one.
+    History queries are answered from memory. Subclasses define the file format.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @abc.abstractmethod
+    def serialize(self, snapshot: dict, now: datetime.datetime) -> bytes:
+        pass
+
+    def snapshot_taken(self, tracker: ActivityTracker, snapshot: dict):
+        """Called under the tracker lock right after ActivityTracker.take_snapshot()."""
+
+    def snapshot_written(self, tracker: ActivityTracker, snapshot: dict):
+        """Called under the tracker lock after write_snapshot succeeded."""
+
+    def write_snapshot(self, snapshot: dict):
+        """Writes ActivityTracker.take_snapshot() result. Does not touch the tracker, so it needs no lock."""
+        start = time.perf_counter()
+        content = self.serialize(snapshot, datetime.datetime.now())
+        write_file_atomically(self.path, content)
+        metrics.observe("activeusers_store_seconds", time.perf_counter() - start)
+        metrics.inc("activeusers_store_bytes_total", len(content))
+        metrics.set("activeusers_storage_file_bytes", len(content))
+
+    def record_transitions(self, tracker: ActivityTracker, dt: datetime.datetime, opened, extended, closed):
+        if tracker.persister is not None:
+            tracker.persister.mark_dirty()
+        else:
+            self.store(tracker)
+
+    def store(self, tracker: ActivityTracker):
+        snapshot = tracker.take_snapshot()
+        self.snapshot_taken(tracker, snapshot)
+        self.write_snapshot(snapshot)
+        self.snapshot_written(tracker, snapshot)
+
+    def active_users_at(self, tracker: ActivityTracker, dt: datetime.datetime) -> Set[str]:
+        """Costs O(log n) per user with any history."""
+        micros = datetime_to_micros(dt)
+        return {user for user, ranges in tracker.user_to_time_ranges.items() if ranges.is_active_at(micros)}
+
+    def ranges_overlapping(
+        self, tracker: ActivityTracker, start: datetime.datetime, end: datetime.datetime
+    ) -> Dict[str, List[DateTimeRange]]:
+        start_micros, end_micros = datetime_to_micros(start), datetime_to_micros(end)
+        user_to_ranges = {}
+        for user, ranges in tracker.user_to_time_ranges.items():
+            overlapping = ranges[ranges.overlapping_slice(start_micros, end_micros)]
+            if overlapping:
+                user_to_ranges[user] = overlapping
+        return user_to_ranges
+
+    def active_duration(
+        self, tracker: ActivityTracker, user: str, start: datetime.datetime, end: datetime.datetime
+    ) -> datetime.timedelta:
+        ranges = tracker.user_to_time_ranges.get(user)
+        if ranges is None:
+            return datetime.timedelta(0)
+        micros = ranges.duration_between(datetime_to_micros(start), datetime_to_micros(end))
+        return datetime.timedelta(microseconds=micros)
+
+    def compact(self, tracker: ActivityTracker, cutoff: datetime.datetime, resolution: str) -> Compaction:
+        cutoff_micros = datetime_to_micros(cutoff)
+        active_users = set(tracker.active_users)
+        compaction = Compaction(cutoff, {}, {})
+        for user, ranges in list(tracker.user_to_time_ranges.items()):
+            count = bisect_left(ranges.ends, cutoff_micros)
+            if count == len(ranges) and user in active_users:
+                count -= 1  # last range is still open
+            if count <= 0:
+                continue
+            bucket_to_micros = defaultdict(int)
+            for i in range(count):
+                for key, micros in split_into_buckets(ranges.starts[i], ranges.ends[i], resolution).items():
+                    bucket_to_micros[key] += micros
+            compaction.user_to_dropped_count[user] = count
+            compaction.user_to_bucket_seconds[user] = {
+                key: micros // 10**6 for key, micros in bucket_to_micros.items()
+            }
+        return compaction
+
+    def apply_compaction(self, tracker: ActivityTracker, compaction: Compaction):
+        for user, count in compaction.user_to_dropped_count.items():
+            tracker.user_to_time_ranges[user].drop_first(count)
+        if tracker.persister is not None:
+            tracker.persister.request_write()
+        else:
+            self.store(tracker)
+
+
+class JsonFileStorage(FileStorage):
+    """Stores the whole state as gzipped JSON."""
+
+    def __init__(self, path=ActivityTracker.STORAGE_FILE):
+        super().__init__(path)
+
+    def load(self, tracker: ActivityTracker) -> Optional[datetime.datetime]:
+        with gzip.open(self.path, "rt") as f:
+            content = f.read()
+        return tracker._restore_activity_status_from_dict(json.loads(content))
+
+    def serialize(self, snapshot: dict, now: datetime.datetime) -> bytes:
+        return gzip.compress(json.dumps({**snapshot, "now": now}, cls=EnhancedJSONEncoder).encode())
+
+
+class JournaledFileStorage(JsonFileStorage):
+    """
+    Every save only appends the changed transitions to `journal_path`. The full state is
+    checkpointed to `path` every `checkpoint_every` saves.
+
+    When a checkpoint's snapshot is taken, the journal is renamed to a segment file and a
+    new one is started, so saves landing while the checkpoint is written go to the new
+    journal. The segment is deleted once the checkpoint is written.
+    """
+
+    def __init__(
+        self, path=ActivityTracker.STORAGE_FILE, journal_path=ActivityTracker.JOURNAL_FILE, checkpoint_every=100
+    ):
+        super().__init__(path)
+        self.journal_path = journal_path
+        self.segment_path = f"{journal_path}.segment"
+        self.checkpoint_every = checkpoint_every
+        self._saves_since_checkpoint = 0
+
+    def load(self, tracker: ActivityTracker, repair_journal=True) -> Optional[datetime.datetime]:
+        """Pass `repair_journal=False` to read a journal that a running bot may still append to."""
+        try:
+            then = super().load(tracker)
+        except FileNotFoundError:
+            if not os.path.exists(self.journal_path) and not os.path.exists(self.segment_path):
+                raise
+            then = None
+        journal_dt = self._replay_journal(tracker, repair=repair_journal)
+        if journal_dt is not None:
+            then = journal_dt if then is None else max(then, journal_dt)
+        return then
+
+    def record_transitions(self, tracker: ActivityTracker, dt: datetime.datetime, opened, extended, closed):
+        self._saves_since_checkpoint += 1
+        persister = tracker.persister
+        if self._saves_since_checkpoint >= self.checkpoint_every and persister is None:
+            self.store(tracker)
+            return
+        # with a persister the journal stays the source of truth until its checkpoint is written
+        self._append_to_journal(tracker, dt, opened, extended, closed)
+        if self._saves_since_checkpoint >= self.checkpoint_every:
+            persister.request_write()
+
+    def snapshot_taken(self, tracker: ActivityTracker, snapshot: dict):
+        if os.path.exists(self.segment_path):
+            # the previous checkpoint failed - its segment stays, the journal holds what came after
+            return
+        try:
+            os.replace(self.journal_path, self.segment_path)
+        except FileNotFoundError:
+            pass
+
+    def snapshot_written(self, tracker: ActivityTracker, snapshot: dict):
+        # Records of the segment are in the checkpoint now. Records of the journal that are
+        # too (if the segment was kept) are skipped on replay by their sequence number.
+        self._saves_since_checkpoint = 0
+        try:
+            os.unlink(self.segment_path)
+        except FileNotFoundError:
+            pass
+
+    def _append_to_journal(self, tracker: ActivityTracker, dt, opened, extended, closed):
+        tracker._journal_seq += 1
+        record = {
+            "seq": tracker._journal_seq,
+            "dt": dt.isoformat(),
+            "opened": opened,
+            "extended": extended,
+            "closed": closed,
+        }
+        line = json.dumps(record) + "\n"
+        metrics.inc("activeusers_journal_bytes_total", len(line))
+        with open(self.journal_path, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replay_journal(self, tracker: ActivityTracker, repair=False) -> Optional[datetime.datetime]:
+        """Applies records of the segment (if a checkpoint was not written) and of the journal."""
+        segment_dt = self._replay_file(tracker, self.segment_path)
+        journal_dt = self._replay_file(tracker, self.journal_path, repair=repair)
+        return journal_dt or segment_dt
+
+    def _replay_file(self, tracker: ActivityTracker, path, repair=False) -> Optional[datetime.datetime]:
+        """
+        Applies records newer than the checkpoint. Returns time of the last one.
+        A torn last record is skipped; with `repair` it is also cut off the file, otherwise
+        the next record would be appended to it and lost together with all later ones.
+        """
+        last_dt = None
+        valid_size = 0
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("no newline")
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn write of the last record
+                    valid_size += len(line)
+                    if record["seq"] <= tracker._journal_seq:
+                        continue
+                    last_dt = datetime.datetime.fromisoformat(record["dt"])
+                    tracker._apply_transitions(
+                        active_users=set(record["opened"]) | set(record["extended"]),
+                        inactive_users=set(record["closed"]),
+                        dt=last_dt,
+                    )
+                    tracker._journal_seq = record["seq"]
+        except FileNotFoundError:
+            return None
+        if repair and os.path.getsize(path) > valid_size:
+            os.truncate(path, valid_size)
+        return last_dt
+
+
+class SqliteStorage(ActivityStorage):
+    """
+    Keeps ranges in an SQLite database in WAL mode. Every save is one transaction that
+    inserts opened ranges and updates ends of the others, so its cost depends on the
+    number of changed users, not on the size of the history.
+    """
+
+    FILE = "activeusers.sqlite3"
+    keeps_history = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ranges (
+            id INTEGER PRIMARY KEY,
+            user TEXT NOT NULL,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ranges_user_start ON ranges (user, start);
+        CREATE INDEX IF NOT EXISTS ranges_start_end ON ranges (start, end);
+        CREATE INDEX IF NOT EXISTS ranges_user_end ON ranges (user, end);
+        -- every user with ranges, so point queries can do one index lookup per user
+        CREATE TABLE IF NOT EXISTS users (user TEXT PRIMARY KEY) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS activity_totals (
+            user TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            seconds INTEGER NOT NULL,
+            PRIMARY KEY (user, bucket)
+        );
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    ACTIVE_USERS_AT = (
+        "SELECT user FROM users WHERE ("
+        " SELECT end FROM ranges WHERE ranges.user = users.user AND start <= :dt ORDER BY start DESC LIMIT 1"
+        ") >= :dt"
+    )
+
+    def __init__(self, path=FILE):
+        self.path = path
+        # used from the refresh, compaction and Bolt threads - every use holds _lock
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = Lock()
+        self._user_to_last_id: Dict[str, int] = {}
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # WAL with synchronous=NORMAL can lose the last commits on power loss, never corrupt the db
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(self.SCHEMA)
+            if not self._connection.execute("SELECT 1 FROM users LIMIT 1").fetchall():
+                # databases created before the users table
+                self._connection.execute("INSERT INTO users (user) SELECT DISTINCT user FROM ranges")
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def load(self, tracker: ActivityTracker) -> Optional[datetime.datetime]:
+        state = dict(self._query("SELECT key, value FROM state"))
+        rows = self._query(
+            "SELECT id, user, start, end FROM ranges WHERE id IN (SELECT MAX(id) FROM ranges GROUP BY user)"
+        )
+        totals = self._query("SELECT user, bucket, seconds FROM activity_totals")
+        tracker.active_users = set(json.loads(state.get("active_users", "[]")))
+        tracker.user_to_time_ranges.clear()
+        self._user_to_last_id = {}
+        for range_id, user, start, end in rows:
+            tracker.user_to_time_ranges[user].append(DateTimeRange(micros_to_datetime(start), micros_to_datetime(end)))
+            self._user_to_last_id[user] = range_id
+        tracker.user_to_activity_totals.clear()
+        for user, bucket, seconds in totals:
+            tracker.user_to_activity_totals[user][bucket] = seconds
+        if "now" not in state:
+            return None
+        return datetime.datetime.fromisoformat(state["now"])
+
+    def record_transitions(self, tracker: ActivityTracker, dt: datetime.datetime, opened, extended, closed):
+        start = time.perf_counter()
+        opened = set(opened)
+        inserts, updates = [], []
+        for user in opened.union(extended, closed):
+            ranges = tracker.user_to_time_ranges[user]
+            range_id = self._user_to_last_id.get(user)
+            if user in opened or range_id is None:
+                inserts.append((user, ranges.starts[-1], ranges.ends[-1]))
+            else:
+                updates.append((ranges.ends[-1], range_id))
+        state = [("active_users", json.dumps(sorted(tracker.active_users))), ("now", dt.isoformat())]
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                connection.executemany("UPDATE ranges SET end = ? WHERE id = ?", updates)
+                for user, range_start, range_end in inserts:
+                    cursor = connection.execute(
+                        "INSERT INTO ranges (user, start, end) VALUES (?, ?, ?)", (user, range_start, range_end)
+                    )
+                    self._user_to_last_id[user] = cursor.lastrowid
+                connection.executemany(
+                    "INSERT OR IGNORE INTO users (user) VALUES (?)",
+                    ((user,) for user, _, _ in inserts),
+                )
+                connection.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", state)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        metrics.observe("activeusers_store_seconds", time.perf_counter() - start)
+
+    def store(self, tracker: ActivityTracker):
+        pass  # every save is stored already
+
+    def active_users_at(self, tracker: ActivityTracker, dt: datetime.datetime) -> Set[str]:
+        """
+        Ranges of a user never overlap, so only the last one starting before dt can contain it:
+        one (user, start) index lookup per user instead of scanning all ranges that started before dt.
+        """
+        rows = self._query(self.ACTIVE_USERS_AT, {"dt": datetime_to_micros(dt)})
+        return {user for user, in rows}
+
+    def ranges_overlapping(
+        self, tracker: ActivityTracker, start: datetime.datetime, end: datetime.datetime
+    ) -> Dict[str, List[DateTimeRange]]:
+        user_to_ranges = self.ranges_micros(datetime_to_micros(start), datetime_to_micros(end))
+        return {
+            user: [DateTimeRange(micros_to_datetime(start), micros_to_datetime(end)) for start, end in ranges]
+            for user, ranges in user_to_ranges.items()
+        }
+
+    def ranges_micros(
+        self, start: int, end: int, users: Optional[Iterable[str]] = None
+    ) -> Dict[str, List[Tuple[int, int]]]:
+        if users is None:
+            rows = self._query(
+                "SELECT user, start, end FROM ranges WHERE start <= ? AND end >= ? ORDER BY user, start", (end, start)
+            )
+            user_to_ranges = defaultdict(list)
+            for user, range_start, range_end in rows:
+                user_to_ranges[user].append((range_start, range_end))
+            return dict(user_to_ranges)
+        user_to_ranges = {}
+        with self._lock:
+            for user in users:
+                # (user, end) index - reports usually cover recent history, which has the latest ends
+                ranges = self._connection.execute(
+                    "SELECT start, end FROM ranges WHERE user = ? AND end >= ? AND start <= ? ORDER BY end",
+                    (user, start, end),
+                ).fetchall()
+                if ranges:
+                    user_to_ranges[user] = ranges
+        return user_to_ranges
+
+    def active_duration(
+        self, tracker: ActivityTracker, user: str, start: datetime.datetime, end: datetime.datetime
+    ) -> datetime.timedelta:
+        start_micros, end_micros = datetime_to_micros(start), datetime_to_micros(end)
+        (micros,), = self._query(
+            "SELECT TOTAL(MIN(end, :end) - MAX(start, :start)) FROM ranges"
+            " WHERE user = :user AND start <= :end AND end >= :start",
+            {"user": user, "start": start_micros, "end": end_micros},
+        )
+        return datetime.timedelta(microseconds=int(micros))
+
+    def compact(self, tracker: ActivityTracker, cutoff: datetime.datetime, resolution: str) -> Compaction:
+        """Deletes the compacted ranges right away - apply_compaction has nothing left to do."""
+        cutoff_micros = datetime_to_micros(cutoff)
+        compaction = Compaction(cutoff, {}, {})
+        with self._lock:
+            # last ranges may still be extended, so they stay even if they ended before cutoff
+            last_ids = set(self._user_to_last_id.values())
+            rows = self._connection.execute(
+                "SELECT id, user, start, end FROM ranges WHERE end < ? ORDER BY user, start", (cutoff_micros,)
+            ).fetchall()
+            user_to_bucket_micros = defaultdict(lambda: defaultdict(int))
+            dropped_ids = []
+            for range_id, user, start, end in rows:
+                if range_id in last_ids:
+                    continue
+                for key, micros in split_into_buckets(start, end, resolution).items():
+                    user_to_bucket_micros[user][key] += micros
+                compaction.user_to_dropped_count[user] = compaction.user_to_dropped_count.get(user, 0) + 1
+                dropped_ids.append((range_id,))
+            for user, bucket_to_micros in user_to_bucket_micros.items():
+                compaction.user_to_bucket_seconds[user] = {
+                    key: micros // 10**6 for key, micros in bucket_to_micros.items()
+                }
+            totals = [
+                (user, key, seconds)
+                for user, bucket_to_seconds in compaction.user_to_bucket_seconds.items()
+                for key, seconds in bucket_to_seconds.items()
+            ]
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                connection.executemany(
+                    "INSERT INTO activity_totals (user, bucket, seconds) VALUES (?, ?, ?)"
+                    " ON CONFLICT (user, bucket) DO UPDATE SET seconds = seconds + excluded.seconds",
+                    totals,
+                )
+                connection.executemany("DELETE FROM ranges WHERE id = ?", dropped_ids)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return compaction
+
+    def import_tracker(self, tracker: ActivityTracker, then: datetime.datetime):
+        with self._lock:
+            connection = self._connection
+            (count,), = connection.execute("SELECT COUNT(*) FROM ranges").fetchall()
+            if count:
+                raise ValueError(f"{self.path} already contains activity")
+            connection.execute("BEGIN")
+            try:
+                for user, ranges in tracker.user_to_time_ranges.items():
+                    connection.executemany(
+                        "INSERT INTO ranges (user, start, end) VALUES (?, ?, ?)",
+                        ((user, start, end) for start, end in zip(ranges.starts, ranges.ends)),
+                    )
+                connection.executemany(
+                    "INSERT OR IGNORE INTO users (user) VALUES (?)",
+                    ((user,) for user, ranges in tracker.user_to_time_ranges.items() if ranges),
+                )
+                connection.executemany(
+                    "INSERT INTO activity_totals (user, bucket, seconds) VALUES (?, ?, ?)",
+                    (
+                        (user, bucket, seconds)
+                        for user, totals in tracker.user_to_activity_totals.items()
+                        for bucket, seconds in totals.items()
+                    ),
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                    [("active_users", json.dumps(sorted(tracker.active_users))), ("now", then.isoformat())],
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def migrate(json_path, sqlite_path, journal_path=None):
+    """Imports a storage file and, if given, its journal into a new SQLite database."""
+    tracker = ActivityTracker(read_status_from_file=False)
+    if journal_path is None:
+        then = JsonFileStorage(json_path).load(tracker)
+    else:
+        then = JournaledFileStorage(json_path, journal_path).load(tracker, repair_journal=False)
+    storage = SqliteStorage(sqlite_path)
+    try:
+        storage.import_tracker(tracker, then)
+    finally:
+        storage.close()
+    return tracker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="import a storage file into SQLite")
+    migrate_parser.add_argument("json_path", nargs="?", default=ActivityTracker.STORAGE_FILE)
+    migrate_parser.add_argument("sqlite_path", nargs="?", default=SqliteStorage.FILE)
+    migrate_parser.add_argument("--journal", help=f"journal to replay, e.g. {ActivityTracker.JOURNAL_FILE}")
+    args = parser.parse_args()
+
+    tracker = migrate(args.json_path, args.sqlite_path, args.journal)
+    ranges_count = sum(len(ranges) for ranges in tracker.user_to_time_ranges.values())
+    print(f"Imported {ranges_count} ranges of {len(tracker.user_to_time_ranges)} users into {args.sqlite_path}")
+
+
+if __name__ == "__main__":
+    main()
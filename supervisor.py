@@ -0,0 +1,225 @@
+"""
+Runs the bot for several workspaces, each in its own worker process.
+
+    python -m supervisor workspaces.json
+
+The config lists workspaces; a token starting with "$" is read from that environment variable:
+
+    {
+        "metrics_port": 9100,
+        "workspaces": [
+            {
+                "name": "starfish",
+                "bot_token": "$STARFISH_BOT_TOKEN",
+                "app_token": "$STARFISH_APP_TOKEN",
+                "team_id": "T04QW7B6D",
+                "aliases": {"core": "coreteam", "gui": "gui_team"},
+                "env": {"ACTIVEUSERS_PRESENCE_MODE": "poll"}
+            }
+        ]
+    }
+
+Every worker keeps its storage files in its own directory (workspaces/<name> by default)
+and serves metrics on a local port. The supervisor restarts workers that exit and serves
+metrics of all of them, labelled with workspace, on `metrics_port`.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from urllib.error import URLError
+
+from metrics import metrics, start_metrics_server
+
+WORKER_METRICS_BASE_PORT = 9200
+CHECK_SECONDS = 1
+# restart delay doubles after every crash up to the maximum, and is reset after a stable run
+MIN_RESTART_DELAY_SECONDS = 1
+MAX_RESTART_DELAY_SECONDS = 60
+STABLE_RUN_SECONDS = 300
+
+
+@dataclass
+class WorkspaceConfig:
+    name: str
+    bot_token: str
+    app_token: str
+    team_id: Optional[str] = None
+    aliases: Dict[str, str] = field(default_factory=dict)
+    env: Dict[str, str] = field(default_factory=dict)
+    directory: Optional[str] = None
+
+    def __post_init__(self):
+        if self.directory is None:
+            self.directory = os.path.join("workspaces", self.name)
+
+
+@dataclass
+class SupervisorConfig:
+    workspaces: List[WorkspaceConfig]
+    metrics_port: Optional[int] = None
+    worker_metrics_base_port: int = WORKER_METRICS_BASE_PORT
+
+
+def _resolve_token(value: str) -> str:
+    if value.startswith("$"):
+        return os.environ[value[1:]]
+    return value
+
+
+def load_config(path) -> SupervisorConfig:
+    with open(path, "r") as f:
+        content = json.load(f)
+    workspaces = [WorkspaceConfig(**workspace) for workspace in content.pop("workspaces")]
+    names = [workspace.name for workspace in workspaces]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Workspace names must be unique: {names}")
+    return SupervisorConfig(workspaces=workspaces, **content)
+
+
+def run_worker(workspace: WorkspaceConfig, metrics_port: int):
+    """Entry point of a worker process."""
+    # terminate() sends SIGTERM - handle it like Ctrl+C, so the bot flushes activity on exit
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    os.makedirs(workspace.directory, exist_ok=True)
+    os.chdir(workspace.directory)
+    os.environ.update(workspace.env)
+    os.environ["SLACK_BOT_TOKEN"] = _resolve_token(workspace.bot_token)
+    os.environ["SLACK_APP_TOKEN"] = _resolve_token(workspace.app_token)
+    os.environ["ACTIVEUSERS_METRICS_PORT"] = str(metrics_port)
+    import app  # imported in the worker only - the supervisor does not need Slack libraries
+
+    team_aliases = dict(app.TEAM_ALIASES)
+    if workspace.team_id is not None:
+        team_aliases[workspace.team_id] = workspace.aliases
+    app.main(team_aliases=team_aliases)
+
+
+def add_label(sample_line: str, name: str, value: str) -> str:
+    """Adds a label to a sample line of Prometheus text format."""
+    label = f'{name}="{value}"'
+    series, _, sample = sample_line.rpartition(" ")
+    if series.endswith("}"):
+        return f"{series[:-1]},{label}}} {sample}"
+    return f"{series}{{{label}}} {sample}"
+
+
+def merge_metrics(workspace_to_text: Dict[str, str], own_text: str = "") -> str:
+    """Merges metrics of workers into one exposition, keeping one TYPE line per metric."""
+    family_to_type = {}
+    family_to_samples: Dict[str, List[str]] = {}
+    for workspace, text in [("", own_text)] + sorted(workspace_to_text.items()):
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                _, _, family, metric_type = line.split(" ", 3)
+                family_to_type.setdefault(family, metric_type)
+                family_to_samples.setdefault(family, [])
+            elif line and not line.startswith("#") and family is not None:
+                family_to_samples[family].append(add_label(line, "workspace", workspace) if workspace else line)
+    lines = []
+    for family in sorted(family_to_type):
+        lines.append(f"# TYPE {family} {family_to_type[family]}")
+        lines.extend(family_to_samples[family])
+    return "\n".join(lines) + "\n"
+
+
+class Supervisor:
+    def __init__(self, config: SupervisorConfig, process_factory=None, clock=time.monotonic):
+        self.config = config
+        # spawn, not fork - the supervisor runs the metrics server thread
+        context = multiprocessing.get_context("spawn")
+        self._process_factory = process_factory or (
+            lambda workspace, port: context.Process(target=run_worker, args=(workspace, port), name=workspace.name)
+        )
+        self._clock = clock
+        self._stop_requested = False
+        self.name_to_process = {}
+        self.name_to_started_at: Dict[str, float] = {}
+        self.name_to_restart_delay: Dict[str, float] = {}
+        self.name_to_restart_at: Dict[str, float] = {}
+        self.name_to_metrics_port = {
+            workspace.name: config.worker_metrics_base_port + i for i, workspace in enumerate(config.workspaces)
+        }
+
+    def _start_worker(self, workspace: WorkspaceConfig):
+        process = self._process_factory(workspace, self.name_to_metrics_port[workspace.name])
+        process.start()
+        self.name_to_process[workspace.name] = process
+        self.name_to_started_at[workspace.name] = self._clock()
+        metrics.set("activeusers_worker_up", 1, workspace=workspace.name)
+        print(f"Started worker {workspace.name} (pid {process.pid})")
+
+    def check_workers(self):
+        """Starts workers that are not running, waiting longer after each quick crash."""
+        now = self._clock()
+        for workspace in self.config.workspaces:
+            name = workspace.name
+            process = self.name_to_process.get(name)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                # the worker exited - schedule a restart
+                self.name_to_process[name] = None
+                metrics.set("activeusers_worker_up", 0, workspace=name)
+                metrics.inc("activeusers_worker_restarts_total", workspace=name)
+                delay = self.name_to_restart_delay.get(name, 0)
+                if now - self.name_to_started_at[name] >= STABLE_RUN_SECONDS:
+                    delay = 0
+                delay = min(MAX_RESTART_DELAY_SECONDS, max(MIN_RESTART_DELAY_SECONDS, delay * 2))
+                self.name_to_restart_delay[name] = delay
+                self.name_to_restart_at[name] = now + delay
+                print(f"Worker {name} exited with code {process.exitcode}, restarting in {delay}s")
+            if now >= self.name_to_restart_at.get(name, 0):
+                self._start_worker(workspace)
+
+    def gather_metrics(self) -> str:
+        workspace_to_text = {}
+        for name, port in self.name_to_metrics_port.items():
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as response:
+                    workspace_to_text[name] = response.read().decode()
+            except (URLError, OSError):
+                continue  # worker is restarting
+        return merge_metrics(workspace_to_text, own_text=metrics.render())
+
+    def stop(self):
+        self._stop_requested = True
+
+    def run(self):
+        server = None
+        if self.config.metrics_port is not None:
+            server = start_metrics_server(self.config.metrics_port, render=self.gather_metrics)
+        try:
+            while not self._stop_requested:
+                self.check_workers()
+                time.sleep(CHECK_SECONDS)
+        finally:
+            for process in self.name_to_process.values():
+                if process is not None and process.is_alive():
+                    process.terminate()
+            for process in self.name_to_process.values():
+                if process is not None:
+                    process.join()
+            if server is not None:
+                server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("config")
+    args = parser.parse_args()
+    supervisor = Supervisor(load_config(args.config))
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print("KeyboardInterrupt detected")
+
+
+if __name__ == "__main__":
+    main()
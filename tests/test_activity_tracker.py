@@ -1,9 +1,12 @@
 import datetime
 import os
+import threading
+from array import array
 
 import pytest
 
-from activity_tracker import ActivityTracker, DateTimeRange
+from activity_tracker import ActivityTracker, ActivityPersister, DateTimeRange, TimeRangeList, datetime_to_micros
+from storage import JournaledFileStorage
 
 
 def remove_file_if_exists(path):
@@ -17,8 +20,12 @@ def remove_file_if_exists(path):
 def clean_activity_file():
     """Fixture to execute asserts before and after a test is run"""
     remove_file_if_exists(ActivityTracker.STORAGE_FILE)
+    remove_file_if_exists(ActivityTracker.JOURNAL_FILE)
+    remove_file_if_exists(f"{ActivityTracker.JOURNAL_FILE}.segment")
     yield
     remove_file_if_exists(ActivityTracker.STORAGE_FILE)
+    remove_file_if_exists(ActivityTracker.JOURNAL_FILE)
+    remove_file_if_exists(f"{ActivityTracker.JOURNAL_FILE}.segment")
 
 
 class TestActivityTracker:
@@ -82,3 +89,337 @@ class TestActivityTracker:
         tracker.read_activity_status_from_file(ignore_error=True)
         assert tracker.active_users == set()
         assert len(tracker.user_to_time_ranges) == 0
+
+
+class TestJournaledActivityTracker:
+    def test_journal_replay(self):
+        tracker = ActivityTracker(storage=JournaledFileStorage(checkpoint_every=3))
+        dt = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        dts = [dt + datetime.timedelta(seconds=i) for i in range(10)]
+
+        tracker.save_activity_status(
+            active_users={"ala", "basia"}, inactive_users=set(), dt=dts[0]
+        )
+        tracker.save_activity_status(
+            active_users={"ala"}, inactive_users={"basia"}, dt=dts[1]
+        )
+        # third save is a checkpoint, the following ones go to the journal
+        tracker.save_activity_status(
+            active_users={"ala", "celina"}, inactive_users=set(), dt=dts[2]
+        )
+        tracker.save_activity_status(
+            active_users={"celina", "basia"}, inactive_users={"ala"}, dt=dts[3]
+        )
+        tracker.save_activity_status(
+            active_users={"celina", "basia"}, inactive_users=set(), dt=dts[4]
+        )
+        with open(ActivityTracker.JOURNAL_FILE) as f:
+            assert len(f.readlines()) == 2
+
+        new_tracker = ActivityTracker(storage=JournaledFileStorage(checkpoint_every=3))
+        assert new_tracker.active_users == tracker.active_users == {"basia", "celina"}
+        assert new_tracker.user_to_time_ranges == tracker.user_to_time_ranges
+        assert new_tracker.user_to_time_ranges["ala"] == [DateTimeRange(dts[0], dts[3])]
+        assert new_tracker.user_to_time_ranges["basia"] == [
+            DateTimeRange(dts[0], dts[1]),
+            DateTimeRange(dts[3], dts[4]),
+        ]
+
+    def test_journal_records_already_in_checkpoint_are_skipped(self):
+        tracker = ActivityTracker(storage=JournaledFileStorage(checkpoint_every=100))
+        dt = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=dt)
+        with open(ActivityTracker.JOURNAL_FILE) as f:
+            journal = f.read()
+        tracker.store_activity_in_file()
+        # simulate crash between the checkpoint rename and journal truncation
+        with open(ActivityTracker.JOURNAL_FILE, "w") as f:
+            f.write(journal + '{"seq": 2, "dt": "2020-')
+
+        new_tracker = ActivityTracker(storage=JournaledFileStorage())
+        assert new_tracker.user_to_time_ranges["ala"] == [DateTimeRange(dt, dt)]
+
+    def test_torn_record_is_cut_off_before_next_append(self):
+        tracker = ActivityTracker(storage=JournaledFileStorage(checkpoint_every=100))
+        dt = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=dt)
+        with open(ActivityTracker.JOURNAL_FILE, "a") as f:
+            f.write('{"seq": 2, "dt": "20')
+
+        restarted = ActivityTracker(storage=JournaledFileStorage(checkpoint_every=100))
+        later = dt + datetime.timedelta(minutes=1)
+        restarted.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=later)
+        with open(ActivityTracker.JOURNAL_FILE) as f:
+            assert len(f.readlines()) == 2
+
+        new_tracker = ActivityTracker(storage=JournaledFileStorage())
+        assert new_tracker.active_users == {"ala", "basia"}
+        assert new_tracker.user_to_time_ranges["ala"] == [DateTimeRange(dt, later)]
+
+
+class TestActivityQueries:
+    def make_tracker(self, dts):
+        tracker = ActivityTracker()
+        tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=dts[0])
+        tracker.save_activity_status(active_users={"ala"}, inactive_users={"basia"}, dt=dts[2])
+        tracker.save_activity_status(active_users=set(), inactive_users={"ala"}, dt=dts[3])
+        tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=dts[5])
+        tracker.save_activity_status(active_users={"ala"}, inactive_users={"basia"}, dt=dts[8])
+        return tracker
+
+    def test_active_users_at(self):
+        dt = datetime.datetime(year=2020, month=1, day=15, hour=13)
+        dts = [dt + datetime.timedelta(hours=i) for i in range(10)]
+        tracker = self.make_tracker(dts)
+        # ala: [0, 3], [5, 8]; basia: [0, 2], [5, 8]
+        assert tracker.active_users_at(dts[1]) == {"ala", "basia"}
+        assert tracker.active_users_at(dts[3]) == {"ala"}
+        assert tracker.active_users_at(dts[4]) == set()
+        assert tracker.active_users_at(dts[9]) == set()
+        assert tracker.active_users_at(dt - datetime.timedelta(hours=1)) == set()
+
+    def test_ranges_overlapping(self):
+        dt = datetime.datetime(year=2020, month=1, day=15, hour=13)
+        dts = [dt + datetime.timedelta(hours=i) for i in range(10)]
+        tracker = self.make_tracker(dts)
+        assert tracker.ranges_overlapping(dts[3], dts[4]) == {"ala": [DateTimeRange(dts[0], dts[3])]}
+        assert tracker.ranges_overlapping(dts[9], dts[9]) == {}
+        assert tracker.ranges_overlapping(dts[1], dts[6]) == {
+            "ala": [DateTimeRange(dts[0], dts[3]), DateTimeRange(dts[5], dts[8])],
+            "basia": [DateTimeRange(dts[0], dts[2]), DateTimeRange(dts[5], dts[8])],
+        }
+
+    def test_active_duration(self):
+        dt = datetime.datetime(year=2020, month=1, day=15, hour=13)
+        dts = [dt + datetime.timedelta(hours=i) for i in range(10)]
+        tracker = self.make_tracker(dts)
+        hour = datetime.timedelta(hours=1)
+        assert tracker.active_duration("ala", dts[0], dts[9]) == 6 * hour
+        assert tracker.active_duration("ala", dts[1], dts[6]) == 3 * hour
+        assert tracker.active_duration("ala", dts[1], dts[2]) == hour
+        assert tracker.active_duration("basia", dts[2], dts[5]) == datetime.timedelta(0)
+        assert tracker.active_duration("nobody", dts[0], dts[9]) == datetime.timedelta(0)
+
+
+class TestTimeRangeList:
+    DTS = [datetime.datetime(year=2020, month=1, day=15, hour=13) + datetime.timedelta(hours=i) for i in range(10)]
+    HOUR_MICROS = 3600 * 10**6
+
+    def make_ranges(self):
+        # [0, 1], [2, 4], [6, 7]
+        dts = self.DTS
+        return TimeRangeList(
+            [DateTimeRange(dts[0], dts[1]), DateTimeRange(dts[2], dts[4]), DateTimeRange(dts[6], dts[7])]
+        )
+
+    def test_set_last_end(self):
+        ranges = self.make_ranges()
+        ranges.set_last_end(self.DTS[9])
+        assert ranges[-1] == DateTimeRange(self.DTS[6], self.DTS[9])
+        with pytest.raises(AssertionError):
+            ranges.set_last_end(self.DTS[5])  # before the start of the last range
+        assert ranges[-1] == DateTimeRange(self.DTS[6], self.DTS[9])
+        with pytest.raises(IndexError):
+            TimeRangeList().set_last_end(self.DTS[0])
+
+    def test_indexing_and_slicing(self):
+        ranges = self.make_ranges()
+        dts = self.DTS
+        assert len(ranges) == 3
+        assert ranges[1] == DateTimeRange(dts[2], dts[4])
+        assert ranges[-1] == DateTimeRange(dts[6], dts[7])
+        assert ranges[1:] == [DateTimeRange(dts[2], dts[4]), DateTimeRange(dts[6], dts[7])]
+        assert ranges[::-2] == [DateTimeRange(dts[6], dts[7]), DateTimeRange(dts[0], dts[1])]
+        assert ranges[5:] == []
+        assert ranges[ranges.overlapping_slice(datetime_to_micros(dts[3]), datetime_to_micros(dts[6]))] == ranges[1:]
+        with pytest.raises(IndexError):
+            ranges[3]
+
+    def test_eq(self):
+        ranges = self.make_ranges()
+        assert ranges == self.make_ranges()
+        assert ranges == list(ranges)
+        assert ranges != ranges[:2]
+        assert ranges != "[]"
+        shorter = self.make_ranges()
+        shorter.set_last_end(self.DTS[6])
+        assert ranges != shorter
+
+    def test_drop_first_keeps_durations(self):
+        ranges = self.make_ranges()
+        ranges.drop_first(1)
+        assert ranges == [DateTimeRange(self.DTS[2], self.DTS[4]), DateTimeRange(self.DTS[6], self.DTS[7])]
+        start, end = datetime_to_micros(self.DTS[0]), datetime_to_micros(self.DTS[9])
+        assert ranges.duration_between(start, end) == 3 * self.HOUR_MICROS
+        ranges.append(DateTimeRange(self.DTS[8], self.DTS[9]))
+        assert ranges.duration_between(start, end) == 4 * self.HOUR_MICROS
+
+    def test_copy_is_independent(self):
+        ranges = self.make_ranges()
+        copy = ranges.copy()
+        ranges.set_last_end(self.DTS[8])
+        ranges.append(DateTimeRange(self.DTS[9], self.DTS[9]))
+        assert copy == self.make_ranges()
+        assert ranges != copy
+
+    def test_read_only_columns_are_copied_before_change(self):
+        source = self.make_ranges()
+        columns = [bytes(memoryview(column)) for column in (source.starts, source.ends)]
+        ranges = TimeRangeList.wrap(*(memoryview(column).cast("q") for column in columns))
+        assert ranges == source
+        assert ranges.duration_between(source.starts[0], source.ends[-1]) == 4 * self.HOUR_MICROS
+
+        ranges.set_last_end(self.DTS[8])
+        assert all(isinstance(column, array) for column in (ranges.starts, ranges.ends, ranges.cumulative))
+        ranges.append(DateTimeRange(self.DTS[9], self.DTS[9]))
+        assert ranges[2:] == [DateTimeRange(self.DTS[6], self.DTS[8]), DateTimeRange(self.DTS[9], self.DTS[9])]
+        assert ranges.duration_between(source.starts[0], ranges.ends[-1]) == 5 * self.HOUR_MICROS
+        # the wrapped memory is untouched
+        assert bytes(memoryview(source.ends)) == columns[1]
+
+        columns = [bytes(memoryview(column)) for column in (source.starts, source.ends, source.cumulative)]
+        with_cumulative = TimeRangeList.wrap(*(memoryview(column).cast("q") for column in columns))
+        with_cumulative.append(DateTimeRange(self.DTS[9], self.DTS[9]))
+        assert isinstance(with_cumulative.cumulative, array)
+        assert list(with_cumulative.cumulative) == [0, 1 * self.HOUR_MICROS, 3 * self.HOUR_MICROS, 4 * self.HOUR_MICROS]
+
+
+class TestCompaction:
+    def test_compaction_rolls_old_ranges_into_daily_totals(self):
+        tracker = ActivityTracker(retention_days=7)
+        now = datetime.datetime(year=2020, month=3, day=1, hour=12)
+        old = datetime.datetime(year=2020, month=2, day=1, hour=23)
+        hour = datetime.timedelta(hours=1)
+
+        tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=old)
+        tracker.save_activity_status(active_users={"basia"}, inactive_users={"ala"}, dt=old + 2 * hour)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=now - hour)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=now)
+
+        compaction = tracker.prepare_compaction(now=now)
+        assert tracker.user_to_time_ranges["ala"][0] == DateTimeRange(old, old + 2 * hour)
+        tracker.apply_compaction(compaction)
+
+        # basia's only range is still open, so it stays
+        assert tracker.user_to_time_ranges["ala"] == [DateTimeRange(now - hour, now)]
+        assert len(tracker.user_to_time_ranges["basia"]) == 1
+        assert tracker.user_to_activity_totals["ala"] == {"2020-02-01": 3600, "2020-02-02": 3600}
+        assert tracker.active_duration("ala", now - 2 * hour, now) == hour
+
+        new_tracker = ActivityTracker(retention_days=7)
+        assert new_tracker.user_to_activity_totals == tracker.user_to_activity_totals
+        assert new_tracker.user_to_time_ranges["ala"] == [DateTimeRange(now - hour, now)]
+
+    def test_no_compaction_without_retention(self):
+        tracker = ActivityTracker()
+        assert tracker.prepare_compaction() is None
+
+
+class TestActivityPersister:
+    def test_saves_are_coalesced_and_flushed_on_stop(self):
+        tracker = ActivityTracker()
+        persister = ActivityPersister(tracker, threading.Lock(), interval=3600, max_pending_saves=1000)
+        persister.start()
+        dt = datetime.datetime(year=2020, month=1, day=15, hour=13)
+        for i in range(10):
+            tracker.save_activity_status(
+                active_users={"ala"}, inactive_users=set(), dt=dt + datetime.timedelta(minutes=i)
+            )
+        assert not os.path.exists(ActivityTracker.STORAGE_FILE)
+
+        persister.stop()
+        assert not persister.is_alive()
+        new_tracker = ActivityTracker(read_status_from_file=False)
+        new_tracker.read_activity_status_from_file()
+        assert new_tracker.user_to_time_ranges["ala"] == [
+            DateTimeRange(dt, dt + datetime.timedelta(minutes=9))
+        ]
+
+    def test_write_after_max_pending_saves(self):
+        tracker = ActivityTracker()
+        persister = ActivityPersister(tracker, threading.Lock(), interval=3600, max_pending_saves=2)
+        persister.start()
+        dt = datetime.datetime(year=2020, month=1, day=15, hour=13)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=dt)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=dt)
+        for _ in range(100):
+            if os.path.exists(ActivityTracker.STORAGE_FILE):
+                break
+            threading.Event().wait(0.01)
+        assert os.path.exists(ActivityTracker.STORAGE_FILE)
+        persister.stop()
+
+    def test_journal_is_cut_when_saves_land_during_every_checkpoint(self):
+        lock = threading.Lock()
+        storage = JournaledFileStorage(checkpoint_every=5)
+        tracker = ActivityTracker(read_status_from_file=False, storage=storage)
+        persister = ActivityPersister(tracker, lock, interval=3600)
+        dt = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        saves = 0
+
+        def save():
+            nonlocal saves
+            saves += 1
+            with lock:
+                active = {"ala"} if saves % 2 else {"basia"}
+                tracker.save_activity_status(active_users=active, inactive_users={"ala", "basia"} - active, dt=dt)
+
+        write_snapshot = storage.write_snapshot
+
+        def write_while_saving(snapshot):
+            save()  # lands after the snapshot was taken, before the checkpoint is written
+            write_snapshot(snapshot)
+
+        storage.write_snapshot = write_while_saving
+        for _ in range(100):
+            save()
+            persister.write_pending()
+        persister.stop()
+        with open(ActivityTracker.JOURNAL_FILE) as f:
+            assert len(f.readlines()) <= storage.checkpoint_every
+        assert not os.path.exists(storage.segment_path)
+
+        restarted = ActivityTracker(storage=JournaledFileStorage())
+        assert restarted.active_users == tracker.active_users
+        assert restarted._journal_seq == tracker._journal_seq
+
+    def test_failed_checkpoint_keeps_journal_segment(self):
+        lock = threading.Lock()
+        storage = JournaledFileStorage(checkpoint_every=1)
+        tracker = ActivityTracker(read_status_from_file=False, storage=storage)
+        persister = ActivityPersister(tracker, lock, interval=3600)
+        dt = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        write_snapshot = storage.write_snapshot
+
+        def fail(snapshot):
+            raise OSError("No space left on device")
+
+        storage.write_snapshot = fail
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=dt)
+        persister.write_pending()  # fails, the journal was moved to the segment
+        tracker.save_activity_status(active_users={"basia"}, inactive_users=set(), dt=dt)
+        persister.write_pending()  # fails again, the segment is kept
+        assert ActivityTracker(storage=JournaledFileStorage()).active_users == {"ala", "basia"}
+
+        storage.write_snapshot = write_snapshot
+        persister.stop()
+        assert not os.path.exists(storage.segment_path)
+        assert ActivityTracker(storage=JournaledFileStorage()).active_users == {"ala", "basia"}
+
+    def test_journaled_checkpoint_keeps_newer_journal_records(self):
+        lock = threading.Lock()
+        tracker = ActivityTracker(storage=JournaledFileStorage(checkpoint_every=2))
+        persister = ActivityPersister(tracker, lock, interval=3600)
+        dt = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=dt)
+        snapshot = tracker.take_snapshot()
+        tracker.storage.snapshot_taken(tracker, snapshot)
+        tracker.save_activity_status(active_users={"basia"}, inactive_users=set(), dt=dt)
+        tracker.storage.write_snapshot(snapshot)
+        tracker.storage.snapshot_written(tracker, snapshot)
+        with open(ActivityTracker.JOURNAL_FILE) as f:
+            assert len(f.readlines()) == 1
+
+        new_tracker = ActivityTracker(storage=JournaledFileStorage())
+        assert new_tracker.active_users == {"ala", "basia"}
+        persister.stop()
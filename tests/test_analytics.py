@@ -0,0 +1,91 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from activity_tracker import ActivityTracker
+from analytics import (
+    collect_intervals,
+    daily_active_counts,
+    hour_of_week_heatmap,
+    typical_online_window,
+    activity_report,
+)
+from storage import SqliteStorage
+
+# a Monday
+SINCE = datetime.datetime(2024, 1, 1)
+UNTIL = SINCE + datetime.timedelta(days=14)
+
+
+def make_tracker(user_to_ranges, storage=None):
+    tracker = ActivityTracker(read_status_from_file=False, storage=storage)
+    for user, ranges in user_to_ranges.items():
+        for start, end in ranges:
+            tracker.save_activity_status(active_users={user}, inactive_users=set(), dt=start)
+            tracker.save_activity_status(active_users=set(), inactive_users={user}, dt=end)
+    return tracker
+
+
+def at(day, hour, minute=0):
+    return SINCE + datetime.timedelta(days=day, hours=hour, minutes=minute)
+
+
+@pytest.fixture(autouse=True)
+def no_storage_file(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+
+class TestAnalytics:
+    def test_heatmap_daily_counts_and_window(self):
+        tracker = make_tracker(
+            {
+                # 9:00-11:30 on both Mondays
+                "ala": [(at(0, 9), at(0, 11, 30)), (at(7, 9), at(7, 11, 30))],
+                # Tuesday night, over midnight
+                "basia": [(at(1, 23), at(2, 1))],
+            }
+        )
+        user_to_intervals = collect_intervals(tracker, SINCE, UNTIL)
+        ala = user_to_intervals["ala"]
+
+        heatmap = hour_of_week_heatmap(ala, SINCE, UNTIL)
+        assert heatmap.shape == (7, 24)
+        assert heatmap[0, 9] == pytest.approx(1)
+        assert heatmap[0, 11] == pytest.approx(0.5)
+        assert heatmap.sum() == pytest.approx(2.5)
+
+        days, counts = daily_active_counts(user_to_intervals, SINCE, UNTIL)
+        assert days[0] == np.datetime64("2024-01-01")
+        assert list(counts[:3]) == [1, 1, 1]
+        assert counts.sum() == 4
+
+        assert typical_online_window(ala, SINCE, UNTIL) == (9, 11)
+        assert typical_online_window(user_to_intervals["basia"], SINCE, UNTIL, coverage=1) == (23, 1)
+
+    def test_intervals_are_clipped(self):
+        tracker = make_tracker({"ala": [(at(-1, 12), at(0, 2)), (at(20, 1), at(20, 2))]})
+        starts, ends = collect_intervals(tracker, SINCE, UNTIL)["ala"]
+        assert list(ends - starts) == [2 * 3600 * 10**6]
+
+    def test_report_without_activity(self):
+        tracker = make_tracker({})
+        report = activity_report(collect_intervals(tracker, SINCE, UNTIL), "coreteam", SINCE, UNTIL)
+        assert "Typical online hours: no activity" in report
+
+    def test_sqlite_storage_gives_the_same_intervals(self, tmp_path):
+        user_to_ranges = {
+            "ala": [(at(-1, 12), at(0, 2)), (at(3, 9), at(3, 11)), (at(20, 1), at(20, 2))],
+            "basia": [(at(1, 23), at(2, 1))],
+            "celina": [(at(5, 8), at(5, 9))],
+        }
+        in_memory = make_tracker(user_to_ranges)
+        in_sqlite = make_tracker(user_to_ranges, storage=SqliteStorage(str(tmp_path / SqliteStorage.FILE)))
+        for user_ids in (None, ["ala", "celina", "nobody"]):
+            expected = collect_intervals(in_memory, SINCE, UNTIL, user_ids)
+            actual = collect_intervals(in_sqlite, SINCE, UNTIL, user_ids)
+            assert actual.keys() == expected.keys()
+            for user, (starts, ends) in expected.items():
+                assert actual[user][0].dtype == np.int64
+                assert list(actual[user][0]) == list(starts) and list(actual[user][1]) == list(ends)
+        in_sqlite.close()
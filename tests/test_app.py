@@ -0,0 +1,467 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+from functools import partial
+
+import pytest
+from slack_bolt import App, BoltRequest
+from slack_bolt.authorization import AuthorizeResult
+from slack_bolt.util.utils import get_arg_names_of_callable
+
+import app
+from activity_tracker import ActivityTracker
+from app import HistoryNotLoaded, RefreshStatusThread, handle_presence_change, handle_app_mention
+from benchmarks.fake_slack import FakeWebClient
+from directory import load_directory
+from presence import PresenceFetcher, PresenceScheduler, TokenBucket
+from storage import SqliteStorage
+from utils import GroupsAndUsersThreadSafeDict, User, Group
+
+
+def remove_file_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+@pytest.fixture(autouse=True)
+def clean_activity_file():
+    remove_file_if_exists(ActivityTracker.STORAGE_FILE)
+    remove_file_if_exists(RefreshStatusThread.DIRECTORY_CACHE_FILE)
+    remove_file_if_exists(RefreshStatusThread.HOT_STATE_FILE)
+    yield
+    remove_file_if_exists(ActivityTracker.STORAGE_FILE)
+    remove_file_if_exists(RefreshStatusThread.DIRECTORY_CACHE_FILE)
+    remove_file_if_exists(RefreshStatusThread.HOT_STATE_FILE)
+
+
+class FakeSocketModeServer:
+    """Replays events to a Bolt app the same way SocketModeHandler dispatches them."""
+
+    def __init__(self, bolt_app: App):
+        self.bolt_app = bolt_app
+
+    def replay(self, events):
+        for event in events:
+            body = {
+                "type": "event_callback",
+                "team_id": "T1",
+                "api_app_id": "A1",
+                "event": event,
+            }
+            response = self.bolt_app.dispatch(BoltRequest(body=body, mode="socket_mode"))
+            assert response.status == 200
+
+
+def make_bolt_app():
+    def authorize(**kwargs):
+        return AuthorizeResult(
+            enterprise_id=None, team_id="T1", bot_token="xoxb-test", bot_user_id="UBOT", bot_id="B1"
+        )
+
+    return App(authorize=authorize, request_verification_enabled=False, process_before_response=True)
+
+
+U0, U1, U2, U3, U4 = (f"U{i:06d}" for i in range(5))
+
+
+def make_client(users_count, active_ids, client_class=FakeWebClient):
+    """Workspace whose only group, coreteam, has all users."""
+    client = client_class(users_count=users_count, groups_count=1, group_size=users_count)
+    client.usergroups[0]["handle"] = "coreteam"
+    client.active_ids = set(active_ids)
+    return client
+
+
+def make_refresh_thread(client):
+    groups_dict = GroupsAndUsersThreadSafeDict()
+    groups_dict.set_bot_user(User("UBOT", "activeusers", "ActiveUsers", ""))
+    thread = RefreshStatusThread(client, groups_dict)
+    thread.refresh_groups_and_users_info()
+    return thread, groups_dict
+
+
+def make_groups_dict():
+    groups_dict = GroupsAndUsersThreadSafeDict()
+    users = [User(f"U{i}", f"user{i}", f"User {i}", "") for i in range(3)]
+    groups_dict.update_groups_and_users([Group("G1", "coreteam", ["U0", "U1", "U2"])], users)
+    return groups_dict
+
+
+class TestPresenceEvents:
+    def test_replayed_presence_events_update_state(self):
+        groups_dict = make_groups_dict()
+        thread = RefreshStatusThread(slack_client=None, groups_users_dict=groups_dict)
+        bolt_app = make_bolt_app()
+        bolt_app.event("presence_change")(partial(handle_presence_change, thread))
+
+        FakeSocketModeServer(bolt_app).replay(
+            [
+                {"type": "presence_change", "user": "U0", "presence": "active"},
+                {"type": "presence_change", "users": ["U1", "U2"], "presence": "active"},
+                {"type": "presence_change", "user": "U1", "presence": "away"},
+                {"type": "presence_change", "user": "UNKNOWN", "presence": "active"},
+            ]
+        )
+
+        _, users = groups_dict.get_groups_and_users([("coreteam", None)])["coreteam"]
+        assert {u.id for u in users if u.active} == {"U0", "U2"}
+        tracker = thread.activity_tracker
+        assert tracker.active_users == {"U0", "U2"}
+        assert len(tracker.user_to_time_ranges["U1"]) == 1
+        # a batched event is recorded in one save
+        assert tracker.user_to_time_ranges["U1"][0].start == tracker.user_to_time_ranges["U2"][0].start
+        assert "UNKNOWN" not in tracker.user_to_time_ranges
+
+
+    def test_events_are_written_behind(self):
+        thread = RefreshStatusThread(
+            slack_client=None, groups_users_dict=make_groups_dict(), presence_subscriber=lambda user_ids: None
+        )
+        bolt_app = make_bolt_app()
+        bolt_app.event("presence_change")(partial(handle_presence_change, thread))
+        FakeSocketModeServer(bolt_app).replay([{"type": "presence_change", "user": "U0", "presence": "active"}])
+        assert thread.activity_tracker.active_users == {"U0"}
+        assert not os.path.exists(ActivityTracker.STORAGE_FILE)
+
+        thread.shutdown()
+        assert ActivityTracker(read_status_from_file=True).active_users == {"U0"}
+
+
+    def test_storage_keeping_history_is_not_written_behind(self, tmp_path):
+        storage = SqliteStorage(str(tmp_path / SqliteStorage.FILE))
+        thread = RefreshStatusThread(
+            slack_client=None,
+            groups_users_dict=make_groups_dict(),
+            activity_tracker=ActivityTracker(read_status_from_file=False, storage=storage),
+            presence_subscriber=lambda user_ids: None,
+        )
+        assert thread.activity_tracker.persister is None
+        assert "persistence" not in thread._scheduler._jobs
+
+        handle_presence_change(thread, {"type": "presence_change", "user": "U1", "presence": "active"})
+        assert list(storage.ranges_micros(0, 2**62)) == ["U1"]  # stored by the save itself
+        thread.shutdown()
+        storage.close()
+
+    def test_polls_like_poll_mode_while_no_events_arrive(self):
+        client = make_client(5, {U1})
+        thread = RefreshStatusThread(
+            client,
+            GroupsAndUsersThreadSafeDict(),
+            refresh_seconds=900,
+            presence_subscriber=lambda user_ids: None,
+            events_fallback_seconds=120,
+            presence_scheduler=PresenceScheduler(calls_per_cycle=2),
+        )
+        thread.refresh_directory()
+        presence_job = thread._scheduler._jobs["presence"]
+        thread._check_presence_events_job()
+        assert presence_job.interval == 120
+        client.calls.clear()
+        thread.refresh_presence()
+        assert client.calls["users.getPresence"] == 2  # within the budget, as in poll mode
+
+        handle_presence_change(thread, {"type": "presence_change", "user": U0, "presence": "active"})
+        thread._check_presence_events_job()
+        assert presence_job.interval == 900
+        client.calls.clear()
+        thread.refresh_presence()
+        assert client.calls["users.getPresence"] == 5  # reconciliation sweep polls everyone
+        thread.shutdown()
+
+
+class TestAppMention:
+    def mention(self, groups_dict, text, user="U0"):
+        replies = []
+        event = {"text": text, "user": user, "ts": "1.0", "team": "T1"}
+        handle_app_mention(groups_dict, event, say=lambda **kwargs: replies.append(kwargs["text"]))
+        return replies[0]
+
+    def test_limit_picks_same_users(self):
+        groups_dict = make_groups_dict()
+        groups_dict.set_bot_user(User("UBOT", "activeusers", "ActiveUsers", ""))
+        for user_id in ["U0", "U1", "U2"]:
+            groups_dict.set_user_presence(user_id, active=True)
+        assert self.mention(groups_dict, "<@UBOT> coreteam --1") == (
+            "User <@U0> asked me to notify 1 active users of coreteam: <@U1>"
+        )
+        assert self.mention(groups_dict, "<@UBOT> coreteam", user="U9") == (
+            "User <@U9> asked me to notify all active users of coreteam: <@U0>, <@U1>, <@U2>"
+        )
+
+    def test_bolt_passes_event_and_say(self):
+        handler = partial(handle_app_mention, make_groups_dict())
+        assert get_arg_names_of_callable(handler) == ["event", "say"]
+        handler = partial(handle_app_mention, make_groups_dict(), refresh_thread=None, fresh_presence=True)
+        assert get_arg_names_of_callable(handler) == ["event", "say"]
+
+    def test_unknown_group(self):
+        groups_dict = make_groups_dict()
+        groups_dict.set_bot_user(User("UBOT", "activeusers", "ActiveUsers", ""))
+        assert self.mention(groups_dict, "<@UBOT> coreteam <@UBOT> nope") == (
+            "Can't recognise group nope. Available groups: coreteam"
+        )
+
+
+class TestRefreshStatusThread:
+    def test_paginated_directory_is_cached_between_restarts(self, monkeypatch):
+        monkeypatch.setattr(app, "USERS_PAGE_SIZE", 2)
+        client = make_client(5, {U1, U3})
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        thread = RefreshStatusThread(client, groups_dict)
+        thread.refresh_groups_and_users_info()
+        assert client.calls.get("users.list", 0) == 3
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1, U3]
+        assert thread.activity_tracker.active_users == {U1, U3}
+
+        client.calls.clear()
+        restarted_groups_dict = GroupsAndUsersThreadSafeDict()
+        restarted = RefreshStatusThread(client, restarted_groups_dict)
+        restarted.refresh_groups_and_users_info()
+        assert "users.list" not in client.calls
+        assert client.calls.get("users.getPresence", 0) == 5
+        assert [u.id for u in restarted_groups_dict.get_active_users("coreteam")] == [U1, U3]
+
+    def test_unchanged_presence_keeps_published_users(self):
+        client = make_client(5, {U1, U3})
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        thread = RefreshStatusThread(client, groups_dict)
+        thread.refresh_groups_and_users_info()
+        snapshot = groups_dict.get_snapshot()
+
+        thread.refresh_presence()
+        assert groups_dict.get_snapshot() is snapshot
+
+        client.active_ids = {U1, U4}
+        thread.refresh_presence()
+        updated = groups_dict.get_snapshot()
+        assert updated.user_id_to_user[U1] is snapshot.user_id_to_user[U1]
+        assert updated.group_handle_to_group is snapshot.group_handle_to_group
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1, U4]
+        assert thread.activity_tracker.active_users == {U1, U4}
+
+    def test_active_users_stay_published_after_directory_refresh(self):
+        client = make_client(5, {U1, U3})
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        thread = RefreshStatusThread(client, groups_dict)
+        thread.refresh_groups_and_users_info()
+        assert thread.refresh_directory()
+        thread.refresh_presence()
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1, U3]
+        assert thread.activity_tracker.active_users == {U1, U3}
+
+    def test_stale_directory_cache_is_refetched(self):
+        client = make_client(5, {U1})
+        RefreshStatusThread(client, GroupsAndUsersThreadSafeDict()).refresh_groups_and_users_info()
+        directory = load_directory(RefreshStatusThread.DIRECTORY_CACHE_FILE)
+        # a cache written by a version with other User fields
+        stale_user = {"id": U1, "nickname": "user1"}
+        with gzip.open(RefreshStatusThread.DIRECTORY_CACHE_FILE, "wt") as f:
+            json.dump({"fetched_at": directory.fetched_at, "users": [stale_user], "groups": [], "bot_user": None}, f)
+
+        client.calls.clear()
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        restarted = RefreshStatusThread(client, groups_dict)
+        restarted.refresh_groups_and_users_info()
+        assert client.calls.get("users.list", 0) == 1
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1]
+
+    def test_unchanged_directory_is_not_published_again(self):
+        client = make_client(5, {U1})
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        thread = RefreshStatusThread(client, groups_dict)
+        thread.refresh_groups_and_users_info()
+        directory, snapshot = thread.directory, groups_dict.get_snapshot()
+
+        assert thread.refresh_directory()
+        thread.refresh_presence()
+        assert thread.directory is directory
+        assert groups_dict.get_snapshot() is snapshot
+
+    def test_shutdown_interrupts_rate_limited_refresh(self):
+        client = make_client(5, {U1})
+        fetcher = PresenceFetcher(client, bucket=TokenBucket(calls=1, period=3600), max_workers=1)
+        thread = RefreshStatusThread(client, GroupsAndUsersThreadSafeDict(), presence_fetcher=fetcher)
+        thread.start()
+        while client.calls.get("users.getPresence", 0) < 1:
+            time.sleep(0.01)
+        start = time.monotonic()
+        thread.shutdown()
+        assert not thread.is_alive()
+        assert time.monotonic() - start < 1
+
+    def test_mentions_answered_from_hot_state_before_history_loads(self):
+        client = make_client(5, {U1, U3})
+        thread = RefreshStatusThread(client, GroupsAndUsersThreadSafeDict())
+        thread.refresh_groups_and_users_info()
+
+        restarted_groups_dict = GroupsAndUsersThreadSafeDict()
+        restarted = RefreshStatusThread(
+            client,
+            restarted_groups_dict,
+            activity_tracker=ActivityTracker(read_status_from_file=False),
+            load_history_in_background=True,
+        )
+        assert [u.id for u in restarted_groups_dict.get_active_users("coreteam")] == [U1, U3]
+        assert restarted.activity_tracker.active_users == set()
+        restarted._load_history()
+        assert restarted.activity_tracker.active_users == {U1, U3}
+
+    @pytest.mark.parametrize("content", ['{"active_user_ids": ["U1"]}', '["U1"]', '{"saved_at": 0.0}', "null"])
+    def test_malformed_hot_state_is_ignored(self, content):
+        client = make_client(5, {U1})
+        RefreshStatusThread(client, GroupsAndUsersThreadSafeDict()).refresh_groups_and_users_info()
+        with open(RefreshStatusThread.HOT_STATE_FILE, "w") as f:
+            f.write(content.replace("0.0", str(time.time())))
+
+        restarted = RefreshStatusThread(
+            client, GroupsAndUsersThreadSafeDict(), activity_tracker=ActivityTracker(read_status_from_file=False)
+        )
+        assert restarted._user_to_presence == {}
+
+    def test_presence_changes_do_not_wait_for_history(self):
+        client = make_client(3, {U1})
+        RefreshStatusThread(client, GroupsAndUsersThreadSafeDict()).refresh_groups_and_users_info()
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        restarted = RefreshStatusThread(
+            client,
+            groups_dict,
+            activity_tracker=ActivityTracker(read_status_from_file=False),
+            load_history_in_background=True,
+        )
+        # would block until the history is loaded, which is never in this test
+        handle_presence_change(restarted, {"type": "presence_change", "user": U2, "presence": "active"})
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1, U2]
+        assert restarted.activity_report("coreteam") == "Activity history is still loading, try again in a minute."
+
+        restarted._load_history()
+        assert restarted.activity_tracker.active_users == {U1, U2}
+        assert restarted.activity_report("coreteam").startswith("Activity of coreteam from")
+
+    def test_unreadable_history_is_not_overwritten(self):
+        client = make_client(5, {U1, U3})
+        RefreshStatusThread(client, GroupsAndUsersThreadSafeDict()).refresh_groups_and_users_info()
+        with open(ActivityTracker.STORAGE_FILE, "rb") as f:
+            content = f.read()
+        with open(ActivityTracker.STORAGE_FILE, "wb") as f:
+            f.write(content[:-10])
+
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        restarted = RefreshStatusThread(
+            client,
+            groups_dict,
+            activity_tracker=ActivityTracker(read_status_from_file=False),
+            load_history_in_background=True,
+        )
+        restarted._load_history()
+        with pytest.raises(HistoryNotLoaded):
+            restarted.refresh_presence()
+        # presence is still published, only saving activity is blocked
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1, U3]
+        handle_presence_change(restarted, {"type": "presence_change", "user": U2, "presence": "active"})
+        assert restarted.activity_report("coreteam").startswith("Activity history could not be loaded")
+        restarted.shutdown()
+        with open(ActivityTracker.STORAGE_FILE, "rb") as f:
+            assert f.read() == content[:-10]
+
+
+class GatedWebClient(FakeWebClient):
+    """Blocks presence calls until `gate` is set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def users_getPresence(self, user):
+        self.gate.wait()
+        return super().users_getPresence(user)
+
+
+class TestFreshPresence:
+    def mention(self, groups_dict, thread):
+        replies = []
+        event = {"text": "<@UBOT> coreteam", "user": "U9", "ts": "1.0"}
+        handle_app_mention(
+            groups_dict,
+            event,
+            lambda **kwargs: replies.append(kwargs["text"]),
+            refresh_thread=thread,
+            fresh_presence=True,
+        )
+        return replies[0]
+
+    def test_only_stale_presence_is_fetched(self):
+        client = make_client(3, {U1}, GatedWebClient)
+        thread, groups_dict = make_refresh_thread(client)
+        client.active_ids = {U1, U2}
+        client.calls.clear()
+        assert thread.refresh_groups_presence(["coreteam"])
+        assert client.calls == {}  # polled a moment ago
+
+        assert thread.refresh_groups_presence(["coreteam", "unknown"], ttl=-1)
+        assert client.calls.get("users.getPresence", 0) == 3
+        assert f"<@{U2}>" in self.mention(groups_dict, thread)
+        assert thread.activity_tracker.active_users == {U1, U2}
+
+    def test_deadline_falls_back_to_cache_and_fetch_is_shared(self):
+        client = make_client(3, {U1}, GatedWebClient)
+        thread, groups_dict = make_refresh_thread(client)
+        client.active_ids = {U2}
+        client.calls.clear()
+        client.gate.clear()
+        assert not thread.refresh_groups_presence(["coreteam"], ttl=-1, deadline=0.05)
+        assert not thread.refresh_groups_presence(["coreteam"], ttl=-1, deadline=0.05)
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U1]
+
+        client.gate.set()
+        thread.shutdown()
+        assert client.calls.get("users.getPresence", 0) <= 3
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == [U2]
+
+    def test_fresh_presence_is_recorded_after_concurrent_saves(self):
+        client = make_client(3, {U1}, GatedWebClient)
+        thread, _ = make_refresh_thread(client)
+        client.active_ids = {U1, U2}
+        with thread._activity_tracker_lock:
+            # fetched, but the fetch waits for the lock to record it
+            assert not thread.refresh_groups_presence(["coreteam"], ttl=-1, deadline=0.05)
+            # a refresh cycle saving meanwhile
+            saved_at = datetime.datetime.now()
+            thread.activity_tracker.save_activity_status(active_users={U2}, inactive_users=set(), dt=saved_at)
+            fetch = thread._fresh_fetches["coreteam"]
+        fetch.result()
+        assert thread.activity_tracker.user_to_time_ranges[U2][-1].end >= saved_at
+
+
+class TestActivityReport:
+    def test_report_command(self):
+        client = make_client(3, {U1})
+        thread, groups_dict = make_refresh_thread(client)
+        replies = []
+        for text in ("<@UBOT> report coreteam", f"<@UBOT> report <@{U1}>", "<@UBOT> report nope"):
+            event = {"text": text, "user": "U9", "ts": "1.0"}
+            handle_app_mention(groups_dict, event, lambda **kwargs: replies.append(kwargs["text"]), refresh_thread=thread)
+        assert replies[0].startswith("Activity of coreteam from")
+        assert replies[1].startswith(f"Activity of <@{U1}> from")
+        assert replies[2] == "Can't recognise group or user nope."
+
+
+class TestCheckStorageSettings:
+    def test_one_storage_is_accepted(self):
+        app.check_storage_settings()
+        app.check_storage_settings(sqlite_path="activeusers.sqlite3")
+        app.check_storage_settings(binary=True)
+
+    @pytest.mark.parametrize(
+        "settings",
+        [{"journaled": True, "binary": True}, {"binary": True, "sqlite_path": "activeusers.sqlite3"}],
+    )
+    def test_conflicting_storages_are_rejected(self, settings):
+        with pytest.raises(ValueError, match="ACTIVEUSERS_BINARY_STORAGE"):
+            app.check_storage_settings(**settings)
@@ -0,0 +1,88 @@
+import datetime
+import gzip
+import json
+
+import pytest
+
+import columnar
+from activity_tracker import ActivityTracker, DateTimeRange
+
+HOUR = datetime.timedelta(hours=1)
+DT = datetime.datetime(year=2020, month=1, day=15, hour=13)
+DTS = [DT + i * HOUR for i in range(10)]
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+
+def make_tracker():
+    tracker = ActivityTracker(read_status_from_file=False)
+    tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=DTS[0])
+    tracker.save_activity_status(active_users={"ala"}, inactive_users={"basia"}, dt=DTS[2])
+    tracker.save_activity_status(active_users=set(), inactive_users={"ala"}, dt=DTS[3])
+    tracker.user_to_activity_totals["celina"] = {"2020-01-01": 3600}
+    tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=DTS[5])
+    return tracker
+
+
+class TestColumnar:
+    def test_conversion_round_trip(self):
+        tracker = make_tracker()
+        columnar.convert_to_binary(ActivityTracker.STORAGE_FILE, columnar.FILE)
+
+        loaded = ActivityTracker(read_status_from_file=False)
+        then = columnar.load(loaded, columnar.FILE)
+        assert then > DTS[5]
+        assert loaded.active_users == {"ala"}
+        assert loaded.user_to_time_ranges == tracker.user_to_time_ranges
+        assert loaded.user_to_activity_totals == tracker.user_to_activity_totals
+        assert loaded.active_duration("ala", DTS[0], DTS[9]) == 3 * HOUR
+        assert loaded.active_users_at(DTS[1]) == {"ala", "basia"}
+
+        columnar.convert_to_json(columnar.FILE, "copy.json")
+        with gzip.open("copy.json", "rt") as f:
+            copy = ActivityTracker(read_status_from_file=False)
+            copy._restore_activity_status_from_dict(json.load(f))
+        assert copy.user_to_time_ranges == tracker.user_to_time_ranges
+
+    def test_loaded_ranges_are_copied_on_change(self):
+        make_tracker()
+        columnar.convert_to_binary(ActivityTracker.STORAGE_FILE, columnar.FILE)
+        loaded = ActivityTracker(read_status_from_file=False)
+        columnar.load(loaded, columnar.FILE)
+        assert isinstance(loaded.user_to_time_ranges["ala"].starts, memoryview)
+        # not stored, computed on first use
+        assert loaded.user_to_time_ranges["ala"].cumulative is None
+        assert loaded.active_duration("ala", DTS[0], DTS[9]) == 3 * HOUR
+        assert list(loaded.user_to_time_ranges["ala"].cumulative) == [0, 3 * 3600 * 10**6]
+
+        loaded.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=DTS[7])
+        assert loaded.user_to_time_ranges["ala"][-1] == DateTimeRange(DTS[5], DTS[7])
+        assert loaded.user_to_time_ranges["basia"][-1] == DateTimeRange(DTS[7], DTS[7])
+        assert loaded.active_duration("basia", DTS[0], DTS[9]) == 2 * HOUR
+
+        reloaded = ActivityTracker(read_status_from_file=False)
+        columnar.load(reloaded, columnar.FILE)
+        assert reloaded.user_to_time_ranges["ala"][-1] == DateTimeRange(DTS[5], DTS[5])
+
+    def test_tracker_with_columnar_storage(self):
+        tracker = ActivityTracker(read_status_from_file=False, storage=columnar.ColumnarFileStorage())
+        tracker.save_activity_status(active_users={"ala"}, inactive_users=set(), dt=DTS[0])
+        tracker.save_activity_status(active_users=set(), inactive_users={"ala"}, dt=DTS[2])
+        tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=DTS[4])
+
+        restarted = ActivityTracker(storage=columnar.ColumnarFileStorage())
+        assert isinstance(restarted.user_to_time_ranges["ala"].starts, memoryview)
+        assert restarted.active_users == {"ala", "basia"}
+        assert restarted.user_to_time_ranges["ala"] == [DateTimeRange(DTS[0], DTS[2]), DateTimeRange(DTS[4], DTS[4])]
+        restarted.save_activity_status(active_users={"ala"}, inactive_users={"basia"}, dt=DTS[6])
+        reloaded = ActivityTracker(storage=columnar.ColumnarFileStorage())
+        assert reloaded.active_duration("ala", DTS[0], DTS[9]) == 4 * HOUR
+        assert reloaded.active_duration("basia", DTS[0], DTS[9]) == 2 * HOUR
+
+    def test_rejects_other_files(self):
+        make_tracker()
+        with pytest.raises(ValueError):
+            columnar.load(ActivityTracker(read_status_from_file=False), ActivityTracker.STORAGE_FILE)
@@ -0,0 +1,101 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from directory import build_directory, merge_directories, store_directory, load_directory
+
+CACHE_FILE = "test_directory_cache.json"
+
+
+@pytest.fixture(autouse=True)
+def clean_cache_file():
+    yield
+    try:
+        os.unlink(CACHE_FILE)
+    except OSError:
+        pass
+
+
+def user_dict(user_id, real_name=None, deleted=False, is_bot=False):
+    return {
+        "id": user_id,
+        "name": user_id.lower(),
+        "deleted": deleted,
+        "is_bot": is_bot,
+        "real_name": real_name or user_id,
+        "profile": {"real_name": real_name or user_id, "image_48": f"https://avatar/{user_id}"},
+    }
+
+
+def group_dict(group_id, handle, users):
+    return {"id": group_id, "handle": handle, "users": users}
+
+
+class TestDirectory:
+    def test_build_directory(self):
+        directory = build_directory(
+            [user_dict("U1"), user_dict("U2", deleted=True), user_dict("B1", is_bot=True), user_dict("B2", "Bot", is_bot=True)],
+            [group_dict("G1", "coreteam", ["U1", "U2"])],
+            bot_name="Bot",
+        )
+        assert list(directory.user_id_to_user) == ["U1"]
+        assert directory.bot_user.id == "B2"
+        assert directory.users_in_groups_ids() == {"U1", "U2"}
+
+    def test_merge_reuses_unchanged_objects(self):
+        old = build_directory(
+            [user_dict("U1"), user_dict("U2"), user_dict("U3")],
+            [group_dict("G1", "coreteam", ["U1"]), group_dict("G2", "guiteam", ["U2"])],
+            bot_name="Bot",
+        )
+        new = build_directory(
+            [user_dict("U1"), user_dict("U2", real_name="Renamed"), user_dict("U4")],
+            [group_dict("G1", "coreteam", ["U1"]), group_dict("G2", "guiteam", ["U2", "U4"])],
+            bot_name="Bot",
+        )
+        merged, diff = merge_directories(old, new)
+        assert merged.user_id_to_user["U1"] is old.user_id_to_user["U1"]
+        assert merged.user_id_to_user["U2"] is new.user_id_to_user["U2"]
+        assert merged.group_handle_to_group["coreteam"] is old.group_handle_to_group["coreteam"]
+        assert (diff.added_users, diff.removed_users, diff.changed_users) == ({"U4"}, {"U3"}, {"U2"})
+        assert (diff.added_groups, diff.removed_groups, diff.changed_groups) == (set(), set(), {"guiteam"})
+        assert not diff.is_empty()
+        new.fetched_at += 3600
+        unchanged, diff = merge_directories(merged, new)
+        assert diff.is_empty()
+        assert unchanged is merged
+        assert unchanged.fetched_at == new.fetched_at
+
+    def test_store_and_load(self):
+        directory = build_directory(
+            [user_dict("U1"), user_dict("B1", "Bot", is_bot=True)],
+            [group_dict("G1", "coreteam", ["U1"])],
+            bot_name="Bot",
+            fetched_at=123.0,
+        )
+        store_directory(CACHE_FILE, directory)
+        assert load_directory(CACHE_FILE) == directory
+        assert load_directory("does_not_exist.json") is None
+
+    @pytest.mark.parametrize(
+        "content",
+        [
+            b"not gzip",
+            gzip.compress(b"{truncated"),
+            gzip.compress(b"[]"),
+            gzip.compress(json.dumps({"fetched_at": 1.0, "users": []}).encode()),
+            # written by a version with other User fields
+            gzip.compress(
+                json.dumps(
+                    {"fetched_at": 1.0, "users": [{"id": "U1", "nickname": "u1"}], "groups": [], "bot_user": None}
+                ).encode()
+            ),
+            gzip.compress(json.dumps({"fetched_at": 1.0, "users": ["U1"], "groups": [], "bot_user": None}).encode()),
+        ],
+    )
+    def test_malformed_cache_is_treated_as_missing(self, content):
+        with open(CACHE_FILE, "wb") as f:
+            f.write(content)
+        assert load_directory(CACHE_FILE) is None
@@ -0,0 +1,45 @@
+import urllib.request
+
+from metrics import Metrics, start_metrics_server
+
+
+class TestMetrics:
+    def test_render(self):
+        registry = Metrics(buckets=(0.1, 1))
+        registry.inc("calls_total", method="users.list")
+        registry.inc("calls_total", 2, method="users.list")
+        registry.set("staleness_seconds", 5, stat="max")
+        registry.observe("cycle_seconds", 0.5)
+        registry.observe("cycle_seconds", 2)
+
+        assert registry.get("calls_total", method="users.list") == 3
+        assert registry.get("cycle_seconds") == (2, 2.5)
+        assert registry.render().splitlines() == [
+            "# TYPE calls_total counter",
+            'calls_total{method="users.list"} 3',
+            "# TYPE cycle_seconds histogram",
+            'cycle_seconds_bucket{le="0.1"} 0',
+            'cycle_seconds_bucket{le="1"} 1',
+            'cycle_seconds_bucket{le="+Inf"} 2',
+            "cycle_seconds_count 2",
+            "cycle_seconds_sum 2.5",
+            "# TYPE staleness_seconds gauge",
+            'staleness_seconds{stat="max"} 5',
+        ]
+
+    def test_time(self):
+        registry = Metrics()
+        with registry.time("handler_seconds", handler="mention"):
+            pass
+        assert registry.get("handler_seconds", handler="mention")[0] == 1
+
+    def test_http_endpoint(self):
+        registry = Metrics()
+        registry.inc("mentions_total")
+        server = start_metrics_server(0, registry=registry)
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                assert "mentions_total 1" in response.read().decode()
+        finally:
+            server.shutdown()
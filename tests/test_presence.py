@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+from presence import TokenBucket, PresenceFetcher, PresenceScheduler
+
+
+def rate_limited_error(retry_after):
+    response = SlackResponse(
+        client=None,
+        http_verb="GET",
+        api_url="users.getPresence",
+        req_args={},
+        data={"ok": False, "error": "ratelimited"},
+        headers={"Retry-After": str(retry_after)},
+        status_code=429,
+    )
+    return SlackApiError("ratelimited", response)
+
+
+class FakePresenceClient:
+    def __init__(self, active_ids, failures_before_success=0):
+        self.active_ids = set(active_ids)
+        self.failures_left = failures_before_success
+        self.calls = []
+
+    def users_getPresence(self, user):
+        self.calls.append(user)
+        if self.failures_left > 0:
+            self.failures_left -= 1
+            raise rate_limited_error(retry_after=7)
+        return {"presence": "active" if user in self.active_ids else "away"}
+
+
+class TestTokenBucket:
+    def test_starts_full_then_paces(self, clock):
+        bucket = TokenBucket(calls=5, period=10, clock=clock.time, sleep=clock.sleep)
+        for _ in range(5):
+            assert bucket.acquire()
+        assert clock.now == 0
+        assert bucket.acquire()
+        assert clock.now == pytest.approx(2)
+
+    def test_pause(self, clock):
+        bucket = TokenBucket(calls=5, period=10, clock=clock.time, sleep=clock.sleep)
+        bucket.pause(30)
+        assert bucket.try_acquire() == pytest.approx(30)
+        assert bucket.acquire()
+        assert clock.now >= 30
+
+    def test_acquire_stops(self):
+        bucket = TokenBucket(calls=1, period=10)
+        assert bucket.acquire()
+        assert not bucket.acquire(should_stop=lambda: True)
+
+    def test_stop_event_interrupts_wait(self):
+        bucket = TokenBucket(calls=1, period=3600)
+        assert bucket.acquire()
+        stop_event = threading.Event()
+        threading.Timer(0.05, stop_event.set).start()
+        start = time.monotonic()
+        assert not bucket.acquire(stop_event=stop_event)
+        assert time.monotonic() - start < 0.5
+
+
+class TestPresenceFetcher:
+    def test_fetch(self):
+        client = FakePresenceClient(active_ids={"u1", "u3"})
+        fetcher = PresenceFetcher(client, bucket=TokenBucket(calls=100))
+        result = fetcher.fetch([f"u{i}" for i in range(10)])
+        assert len(result) == 10
+        assert {u for u, p in result.items() if p == "active"} == {"u1", "u3"}
+
+    def test_retry_after_429(self, clock):
+        client = FakePresenceClient(active_ids={"u1"}, failures_before_success=1)
+        bucket = TokenBucket(calls=100, clock=clock.time, sleep=clock.sleep)
+        fetcher = PresenceFetcher(client, bucket=bucket, max_workers=1)
+        assert fetcher.fetch(["u1"]) == {"u1": "active"}
+        assert client.calls == ["u1", "u1"]
+        assert clock.now >= 7
+
+    def test_gives_up_after_max_retries(self, clock):
+        client = FakePresenceClient(active_ids={"u1"}, failures_before_success=10)
+        bucket = TokenBucket(calls=100, clock=clock.time, sleep=clock.sleep)
+        fetcher = PresenceFetcher(client, bucket=bucket, max_workers=1, max_retries=2)
+        assert fetcher.fetch(["u1"]) == {}
+        assert len(client.calls) == 3
+
+
+class TestPresenceScheduler:
+    def test_new_users_first_then_by_weighted_staleness(self, clock):
+        scheduler = PresenceScheduler(calls_per_cycle=2, clock=clock.time)
+        user_to_groups = {"hot": ["coreteam"], "cold1": ["other"], "cold2": ["other"]}
+        scheduler.mark_polled(["hot", "cold1"])
+        assert scheduler.select_users(user_to_groups)[0] == "cold2"
+
+        scheduler.mark_polled(["cold2"])
+        scheduler.update_group_scores({"coreteam": 5})
+        clock.sleep(60)
+        assert scheduler.select_users(user_to_groups) == ["hot", "cold2"]
+
+    def test_recent_presence_change_raises_priority(self, clock):
+        clock.now = 10000
+        scheduler = PresenceScheduler(calls_per_cycle=1, clock=clock.time)
+        scheduler.mark_polled(["stable", "volatile"])
+        clock.sleep(30)
+        last_change = {"volatile": clock.now - 60}
+        user_to_groups = {"stable": [], "volatile": []}
+        assert scheduler.select_users(user_to_groups, last_change.get) == ["volatile"]
+        assert scheduler.staleness(["stable", "unknown"]) == {"stable": 30, "unknown": None}
+
+    def test_mention_scores_decay(self, clock):
+        scheduler = PresenceScheduler(calls_per_cycle=1, mentions_half_life=100, clock=clock.time)
+        scheduler.update_group_scores({"coreteam": 4})
+        clock.sleep(100)
+        scheduler.update_group_scores({"coreteam": 4})
+        assert scheduler.user_weight("u", ["coreteam"], None, clock.now) == pytest.approx(3)
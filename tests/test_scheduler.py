@@ -0,0 +1,86 @@
+import random
+import threading
+import time
+
+import pytest
+
+from metrics import metrics
+from scheduler import JobScheduler
+
+
+class TestJobScheduler:
+    def test_jobs_run_at_their_intervals(self, clock):
+        scheduler = JobScheduler(clock=clock.time, rng=random.Random(0))
+        runs = []
+        scheduler.add_job("directory", lambda: runs.append("directory"), interval=100)
+        scheduler.add_job("presence", lambda: runs.append("presence"), interval=10, jitter=2)
+        assert scheduler.run_pending() == pytest.approx(10, abs=2)
+        assert runs == ["directory", "presence"]
+
+        clock.now = 12
+        assert scheduler.run_pending() <= 12
+        assert runs == ["directory", "presence", "presence"]
+
+        scheduler.trigger("directory", delay=1)
+        scheduler.trigger("unknown")
+        assert scheduler.run_pending() == pytest.approx(1)
+        clock.now = 13
+        scheduler.run_pending()
+        assert runs[-1] == "directory"
+
+    def test_set_interval(self, clock):
+        scheduler = JobScheduler(clock=clock.time)
+        scheduler.add_job("presence", lambda: None, interval=900)
+        scheduler.run_pending()
+        scheduler.set_interval("presence", 120)
+        assert scheduler.run_pending() == pytest.approx(120)
+        scheduler.set_interval("presence", 900)
+        assert scheduler.run_pending() == pytest.approx(120)
+        clock.now = 120
+        assert scheduler.run_pending() == pytest.approx(900)
+
+    def test_failed_job_does_not_stop_others(self):
+        scheduler = JobScheduler()
+        runs = []
+        scheduler.add_job("failing", lambda: 1 / 0, interval=10)
+        scheduler.add_job("other", lambda: runs.append("other"), interval=10)
+        errors = metrics.get("activeusers_job_errors_total", job="failing") or 0
+        scheduler.run_pending()
+        assert runs == ["other"]
+        assert metrics.get("activeusers_job_errors_total", job="failing") == errors + 1
+
+    def test_background_job_triggered_while_running_runs_again(self):
+        scheduler = JobScheduler()
+        release = threading.Event()
+        runs = []
+
+        def write():
+            runs.append("write")
+            release.wait()
+
+        scheduler.add_job("persistence", write, interval=3600, background=True)
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        while not runs:
+            time.sleep(0.01)
+        scheduler.trigger("persistence")
+        release.set()
+        while len(runs) < 2:
+            time.sleep(0.01)
+        scheduler.stop()
+        thread.join(timeout=1)
+        scheduler.join_background_jobs()
+        assert not thread.is_alive()
+        assert runs == ["write", "write"]
+
+    def test_stop_interrupts_waiting(self):
+        scheduler = JobScheduler()
+        scheduler.add_job("presence", lambda: None, interval=3600)
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        time.sleep(0.05)
+        start = time.monotonic()
+        scheduler.stop()
+        thread.join(timeout=1)
+        assert not thread.is_alive()
+        assert time.monotonic() - start < 0.5
@@ -0,0 +1,102 @@
+import datetime
+
+import pytest
+
+from activity_tracker import ActivityTracker, DateTimeRange
+from storage import JournaledFileStorage, SqliteStorage, migrate
+
+HOUR = datetime.timedelta(hours=1)
+DT = datetime.datetime(year=2020, month=1, day=15, hour=13)
+DTS = [DT + i * HOUR for i in range(10)]
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / SqliteStorage.FILE)
+
+
+def save_history(tracker):
+    # ala: [0, 3], [5, 8]; basia: [0, 2], [5, 8]
+    tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=DTS[0])
+    tracker.save_activity_status(active_users={"ala"}, inactive_users={"basia"}, dt=DTS[2])
+    tracker.save_activity_status(active_users=set(), inactive_users={"ala"}, dt=DTS[3])
+    tracker.save_activity_status(active_users={"ala", "basia"}, inactive_users=set(), dt=DTS[5])
+    tracker.save_activity_status(active_users={"ala"}, inactive_users={"basia"}, dt=DTS[8])
+
+
+class TestSqliteStorage:
+    def test_queries(self, sqlite_path):
+        tracker = ActivityTracker(read_status_from_file=False, storage=SqliteStorage(sqlite_path))
+        save_history(tracker)
+        # only the last range stays in memory
+        assert tracker.user_to_time_ranges["ala"] == [DateTimeRange(DTS[5], DTS[8])]
+        assert tracker.active_users_at(DTS[1]) == {"ala", "basia"}
+        assert tracker.active_users_at(DTS[4]) == set()
+        assert tracker.ranges_overlapping(DTS[1], DTS[6]) == {
+            "ala": [DateTimeRange(DTS[0], DTS[3]), DateTimeRange(DTS[5], DTS[8])],
+            "basia": [DateTimeRange(DTS[0], DTS[2]), DateTimeRange(DTS[5], DTS[8])],
+        }
+        assert tracker.active_duration("ala", DTS[1], DTS[6]) == 3 * HOUR
+        assert tracker.active_duration("nobody", DTS[0], DTS[9]) == datetime.timedelta(0)
+        tracker.close()
+
+    def test_active_users_at_looks_up_one_range_per_user(self, sqlite_path):
+        storage = SqliteStorage(sqlite_path)
+        tracker = ActivityTracker(read_status_from_file=False, storage=storage)
+        save_history(tracker)
+        plan = " ".join(row[-1] for row in storage._query("EXPLAIN QUERY PLAN " + storage.ACTIVE_USERS_AT, {"dt": 0}))
+        assert "USING INDEX ranges_user_start" in plan and "SCAN ranges" not in plan
+        # databases created before the users table get it filled on open
+        storage._query("DELETE FROM users")
+        tracker.close()
+        tracker = ActivityTracker(read_status_from_file=False, storage=SqliteStorage(sqlite_path))
+        assert tracker.active_users_at(DTS[6]) == {"ala", "basia"}
+        assert tracker.active_users_at(DTS[8]) == {"ala", "basia"}
+        assert tracker.active_users_at(DTS[4]) == set()
+        tracker.close()
+
+    def test_load_closes_activities_after_long_pause(self, sqlite_path):
+        tracker = ActivityTracker(read_status_from_file=False, storage=SqliteStorage(sqlite_path))
+        save_history(tracker)
+        tracker.close()
+
+        tracker = ActivityTracker(storage=SqliteStorage(sqlite_path))
+        assert tracker.active_users == set()
+        assert tracker.last_presence_change("ala") == DTS[8]
+        tracker.save_activity_status(active_users={"basia"}, inactive_users=set(), dt=DTS[9])
+        assert tracker.ranges_overlapping(DTS[8], DTS[9]) == {
+            "ala": [DateTimeRange(DTS[5], DTS[8])],
+            "basia": [DateTimeRange(DTS[5], DTS[8]), DateTimeRange(DTS[9], DTS[9])],
+        }
+        tracker.close()
+
+    def test_compaction(self, sqlite_path):
+        tracker = ActivityTracker(read_status_from_file=False, retention_days=7, storage=SqliteStorage(sqlite_path))
+        save_history(tracker)
+        now = DTS[8] + datetime.timedelta(days=30)
+        tracker.apply_compaction(tracker.prepare_compaction(now=now))
+        # last ranges may still be extended, so they are kept
+        assert tracker.ranges_overlapping(DTS[0], now) == {
+            "ala": [DateTimeRange(DTS[5], DTS[8])],
+            "basia": [DateTimeRange(DTS[5], DTS[8])],
+        }
+        assert tracker.user_to_activity_totals["ala"] == {"2020-01-15": 3 * 3600}
+        tracker.close()
+
+        tracker = ActivityTracker(storage=SqliteStorage(sqlite_path))
+        assert tracker.user_to_activity_totals["basia"] == {"2020-01-15": 2 * 3600}
+        tracker.close()
+
+
+class TestMigration:
+    def test_migrate_storage_file_and_journal(self, tmp_path, sqlite_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        tracker = ActivityTracker(read_status_from_file=False, storage=JournaledFileStorage(checkpoint_every=3))
+        save_history(tracker)
+
+        migrate(ActivityTracker.STORAGE_FILE, sqlite_path, journal_path=ActivityTracker.JOURNAL_FILE)
+        migrated = ActivityTracker(read_status_from_file=False, storage=SqliteStorage(sqlite_path))
+        assert migrated.ranges_overlapping(DTS[0], DTS[9]) == tracker.ranges_overlapping(DTS[0], DTS[9])
+        with pytest.raises(ValueError):
+            migrate(ActivityTracker.STORAGE_FILE, sqlite_path)
+        migrated.close()
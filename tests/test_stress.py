@@ -0,0 +1,33 @@
+import io
+import json
+
+from benchmarks import stress
+from utils import ActiveUsersReplyCache
+
+SHORT_RUN = ["--users", "300", "--groups", "20", "--mention-threads", "20", "--seconds", "1", "--report-every", "0.5"]
+
+
+class TestStress:
+    def test_short_run_keeps_invariants(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        output = io.StringIO()
+        result = stress.StressTest(stress.make_parser().parse_args(SHORT_RUN)).run(output=output)
+        assert result["violation_examples"] == []
+        assert result["latency"]["count"] > 0
+        assert result["exact_replies"] > 0
+        assert result["snapshot_checks"] > 0 and result["tracker_checks"] > 0
+        assert result["snapshot_version"] > 1
+        windows = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert windows and all(window["violations"] == 0 for window in windows)
+
+    def test_detects_replies_missing_active_users(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        get_mentions = ActiveUsersReplyCache.get_mentions
+
+        def drop_last_mention(self, group_name, limit, exclude_user_id=None):
+            return get_mentions(self, group_name, limit, exclude_user_id=exclude_user_id).rpartition(",")[0]
+
+        monkeypatch.setattr(ActiveUsersReplyCache, "get_mentions", drop_last_mention)
+        result = stress.StressTest(stress.make_parser().parse_args(SHORT_RUN)).run(output=io.StringIO())
+        assert result["violations"] > 0
+        assert any("torn read" in violation for violation in result["violation_examples"])
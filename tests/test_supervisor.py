@@ -0,0 +1,104 @@
+import json
+
+from supervisor import Supervisor, SupervisorConfig, WorkspaceConfig, load_config, merge_metrics, add_label
+
+
+class FakeProcess:
+    def __init__(self, workspace, port):
+        self.workspace = workspace
+        self.port = port
+        self.pid = 1
+        self.exitcode = None
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def crash(self):
+        self.alive = False
+        self.exitcode = 1
+
+
+class TestSupervisor:
+    def test_load_config(self, tmp_path):
+        path = tmp_path / "workspaces.json"
+        path.write_text(
+            json.dumps(
+                {
+                    "metrics_port": 9100,
+                    "workspaces": [
+                        {"name": "a", "bot_token": "$A_BOT", "app_token": "$A_APP", "aliases": {"core": "coreteam"}},
+                        {"name": "b", "bot_token": "xoxb", "app_token": "xapp", "directory": "/data/b"},
+                    ],
+                }
+            )
+        )
+        config = load_config(path)
+        assert config.metrics_port == 9100
+        assert config.workspaces[0].directory == "workspaces/a"
+        assert config.workspaces[0].aliases == {"core": "coreteam"}
+        assert config.workspaces[1].directory == "/data/b"
+
+    def test_crashed_workers_are_restarted_with_backoff(self, clock):
+        processes = []
+
+        def process_factory(workspace, port):
+            processes.append(FakeProcess(workspace, port))
+            return processes[-1]
+
+        config = SupervisorConfig(
+            [WorkspaceConfig("a", "xoxb", "xapp"), WorkspaceConfig("b", "xoxb", "xapp")],
+            worker_metrics_base_port=9200,
+        )
+        supervisor = Supervisor(config, process_factory=process_factory, clock=clock.time)
+        supervisor.check_workers()
+        assert [(p.workspace.name, p.port) for p in processes] == [("a", 9200), ("b", 9201)]
+
+        processes[0].crash()
+        supervisor.check_workers()
+        assert len(processes) == 2  # waits before restarting
+        clock.now += 1
+        supervisor.check_workers()
+        assert processes[-1].workspace.name == "a"
+
+        processes[-1].crash()
+        clock.now += 1
+        supervisor.check_workers()
+        assert len(processes) == 3  # second crash in a row waits longer
+        clock.now += 1
+        supervisor.check_workers()
+        assert len(processes) == 3
+        clock.now += 1
+        supervisor.check_workers()
+        assert len(processes) == 4
+
+
+class TestMergeMetrics:
+    def test_samples_are_labelled_and_grouped(self):
+        worker_text = (
+            "# TYPE calls_total counter\n"
+            'calls_total{method="users.list"} 3\n'
+            "# TYPE cycle_seconds histogram\n"
+            'cycle_seconds_bucket{le="1"} 1\n'
+            "cycle_seconds_count 1\n"
+        )
+        own_text = "# TYPE activeusers_worker_up gauge\n" 'activeusers_worker_up{workspace="a"} 1\n'
+        merged = merge_metrics({"b": worker_text, "a": worker_text}, own_text)
+        assert merged.splitlines() == [
+            "# TYPE activeusers_worker_up gauge",
+            'activeusers_worker_up{workspace="a"} 1',
+            "# TYPE calls_total counter",
+            'calls_total{method="users.list",workspace="a"} 3',
+            'calls_total{method="users.list",workspace="b"} 3',
+            "# TYPE cycle_seconds histogram",
+            'cycle_seconds_bucket{le="1",workspace="a"} 1',
+            'cycle_seconds_count{workspace="a"} 1',
+            'cycle_seconds_bucket{le="1",workspace="b"} 1',
+            'cycle_seconds_count{workspace="b"} 1',
+        ]
+
+    def test_add_label(self):
+        assert add_label("up 1", "workspace", "a") == 'up{workspace="a"} 1'
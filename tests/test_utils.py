@@ -0,0 +1,145 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+
+import pytest
+
+from metrics import metrics
+from utils import ActiveUsersReplyCache, GroupsAndUsersThreadSafeDict, Group, User
+
+
+def make_groups_dict():
+    groups_dict = GroupsAndUsersThreadSafeDict()
+    users = [User(f"U{i}", f"user{i}", f"User {i}", "") for i in range(3)]
+    groups_dict.update_groups_and_users([Group("G1", "coreteam", ["U0", "U1", "U2", "UGONE"])], users)
+    return groups_dict
+
+
+class TestGroupsAndUsersThreadSafeDict:
+    def test_snapshot_is_not_affected_by_later_updates(self):
+        groups_dict = make_groups_dict()
+        snapshot = groups_dict.get_snapshot()
+
+        assert groups_dict.set_user_presence("U1", active=True)
+        assert not groups_dict.set_user_presence("U1", active=True)
+        assert not groups_dict.set_user_presence("UNKNOWN", active=True)
+        groups_dict.update_groups_and_users([Group("G2", "guiteam", [])], [])
+
+        assert not snapshot.user_id_to_user["U1"].active
+        assert list(snapshot.group_handle_to_group) == ["coreteam"]
+        assert groups_dict.get_snapshot().version == snapshot.version + 2
+        assert groups_dict.get_groups_handles() == ["guiteam"]
+
+    def test_get_groups_and_users_skips_unknown_users(self):
+        groups_dict = make_groups_dict()
+        group, users = groups_dict.get_groups_and_users([("coreteam", None)])["coreteam"]
+        assert group.id == "G1"
+        assert sorted(u.id for u in users) == ["U0", "U1", "U2"]
+
+    def test_active_user_index(self):
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        users = [User(f"U{i}", f"user{i}", f"User {i}", "", active=i % 2 == 0) for i in range(6)]
+        groups_dict.update_groups_and_users(
+            [Group("G1", "coreteam", ["U5", "U4", "U3", "U2", "U1", "U0"]), Group("G2", "guiteam", ["U1", "U2"])],
+            users,
+        )
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == ["U0", "U2", "U4"]
+        assert [u.id for u in groups_dict.get_active_users("coreteam", limit=2)] == ["U0", "U2"]
+        assert [u.id for u in groups_dict.get_active_users("coreteam", 2, exclude_user_id="U0")] == ["U2", "U4"]
+
+        groups_dict.set_user_presence("U1", active=True)
+        groups_dict.set_user_presence("U2", active=False)
+        assert [u.id for u in groups_dict.get_active_users("coreteam")] == ["U0", "U1", "U4"]
+        assert [u.id for u in groups_dict.get_active_users("guiteam")] == ["U1"]
+        assert groups_dict.get_snapshot().user_id_to_group_handles["U1"] == ("coreteam", "guiteam")
+
+    def test_replace_users_keeps_groups(self):
+        groups_dict = make_groups_dict()
+        snapshot = groups_dict.get_snapshot()
+        active_user = User("U1", "user1", "User 1", "", active=True)
+        groups_dict.replace_users([active_user, User("UNKNOWN", "unknown", "Unknown", "", active=True)])
+
+        updated = groups_dict.get_snapshot()
+        assert updated.user_id_to_user["U1"] is active_user
+        assert "UNKNOWN" not in updated.user_id_to_user
+        assert updated.group_handle_to_group is snapshot.group_handle_to_group
+        assert updated.group_handle_to_active_user_ids["coreteam"] == ("U1",)
+        assert snapshot.group_handle_to_active_user_ids["coreteam"] == ()
+
+    def test_update_indexes_again_only_changed_groups(self):
+        rng = random.Random(1)
+        users = [User(f"U{i}", f"user{i}", f"User {i}", "", active=rng.random() < 0.5) for i in range(40)]
+        groups = [Group(f"G{i}", f"team{i}", rng.sample([u.id for u in users], 10) + ["UGONE"]) for i in range(10)]
+        groups_dict = GroupsAndUsersThreadSafeDict()
+        groups_dict.update_groups_and_users(groups, users)
+        for step in range(20):
+            users = [replace(u, active=not u.active) if rng.random() < 0.1 else u for u in users if rng.random() < 0.95]
+            # groups list UGONE from the start, it joins the directory later
+            users.append(User("UGONE" if step == 10 else f"U{len(users) + 100}", "new", "New", "", active=True))
+            groups = [
+                Group(g.id, g.handle, g.user_ids + [u.id for u in rng.sample(users, 2)]) if rng.random() < 0.2 else g
+                for g in groups
+                if rng.random() < 0.95
+            ]
+            groups.append(Group("GNEW", f"new{step}", ["UGONE", users[-1].id]))
+            groups_dict.update_groups_and_users(groups, users)
+            rebuilt = GroupsAndUsersThreadSafeDict()
+            rebuilt.update_groups_and_users(groups, users)
+            snapshot, expected = groups_dict.get_snapshot(), rebuilt.get_snapshot()
+            assert snapshot.group_handle_to_active_user_ids == expected.group_handle_to_active_user_ids
+            assert snapshot.user_id_to_group_handles == expected.user_id_to_group_handles
+
+
+def cache_counts():
+    return {result: metrics.get("activeusers_reply_cache_total", result=result) or 0
+            for result in ("hit", "miss", "coalesced")}
+
+
+class SlowGroupsDict(GroupsAndUsersThreadSafeDict):
+    """Blocks active user lookups until `gate` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.lookups = 0
+
+    def get_active_users(self, *args, **kwargs):
+        self.lookups += 1
+        self.gate.wait()
+        return super().get_active_users(*args, **kwargs)
+
+
+class TestActiveUsersReplyCache:
+    def test_replies_are_cached_until_new_snapshot(self):
+        groups_dict = make_groups_dict()
+        groups_dict.set_user_presence("U1", active=True)
+        cache = ActiveUsersReplyCache(groups_dict)
+        before = cache_counts()
+
+        assert cache.get_mentions("coreteam", exclude_user_id="U8") == "<@U1>"
+        # non-members share the reply
+        assert cache.get_mentions("coreteam", exclude_user_id="U9") == "<@U1>"
+        assert cache.get_mentions("coreteam", exclude_user_id="U1") == ""
+        with pytest.raises(KeyError):
+            cache.get_mentions("nope")
+
+        groups_dict.set_user_presence("U2", active=True)
+        assert cache.get_mentions("coreteam", exclude_user_id="U8") == "<@U1>, <@U2>"
+        assert cache.get_mentions("coreteam", exclude_user_id="U9") == "<@U1>, <@U2>"
+
+        after = cache_counts()
+        assert after["hit"] - before["hit"] == 2
+        assert after["miss"] - before["miss"] == 4
+
+    def test_concurrent_requests_share_lookup(self):
+        groups_dict = SlowGroupsDict()
+        groups_dict.update_groups_and_users(
+            [Group("G1", "coreteam", ["U0"])], [User("U0", "user0", "User 0", "", active=True)]
+        )
+        cache = ActiveUsersReplyCache(groups_dict)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(cache.get_mentions, "coreteam") for _ in range(8)]
+            groups_dict.gate.set()
+            assert [future.result() for future in futures] == ["<@U0>"] * 8
+        assert groups_dict.lookups == 1
@@ -1,18 +1,26 @@
 import random
 import re
-from dataclasses import dataclass
+import time
+from bisect import insort
+from collections import defaultdict, Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from threading import Lock
-from typing import List, Dict, Optional, Tuple
+from types import MappingProxyType
+from typing import List, Dict, Optional, Tuple, Mapping
 
+from metrics import metrics
 
-@dataclass
+
+@dataclass(slots=True)
 class Group:
     id: str
     handle: str
     user_ids: List[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     id: str
     name: str
@@ -96,43 +104,320 @@ def get_group_name_and_limit_from_msg(text: str, bot_id: str) -> List[Tuple[str,
     return groups
 
 
+def get_report_subject_from_msg(text: str, bot_id: str) -> Optional[str]:
+    r"""
+    >>> get_report_subject_from_msg("<@ABC123> report coreteam", bot_id="ABC123")
+    'coreteam'
+    >>> get_report_subject_from_msg("please <@ABC123>  report <@U42> now", bot_id="ABC123")
+    'U42'
+    >>> get_report_subject_from_msg("<@ABC123> coreteam report", bot_id="ABC123")
+    >>> get_report_subject_from_msg("<@ABC123> report", bot_id="ABC123")
+    """
+    match = re.search(re.escape(f"<@{bot_id}>") + r"\s+report\s+(?:<@(\w+)>|(\w+))", text)
+    if match is None:
+        return None
+    return match.group(1) or match.group(2)
+
+
+@dataclass(frozen=True)
+class GroupsAndUsersSnapshot:
+    """
+    Immutable view of groups and users. Never modify objects reachable from it.
+
+    `group_handle_to_active_user_ids` lists active members of every group sorted by
+    user id, so `--N` limits always pick the same users.
+    """
+    version: int
+    group_handle_to_group: Mapping[str, Group]
+    user_id_to_user: Mapping[str, User]
+    group_handle_to_active_user_ids: Mapping[str, Tuple[str, ...]]
+    user_id_to_group_handles: Mapping[str, Tuple[str, ...]]
+
+
+EMPTY_SNAPSHOT = GroupsAndUsersSnapshot(
+    0, MappingProxyType({}), MappingProxyType({}), MappingProxyType({}), MappingProxyType({})
+)
+
+
+def build_group_indexes(
+    group_handle_to_group: Dict[str, Group], user_id_to_user: Dict[str, User]
+) -> Tuple[Dict[str, Tuple[str, ...]], Dict[str, Tuple[str, ...]]]:
+    """Returns active members of each group and groups of each user."""
+    group_handle_to_active_user_ids = {}
+    user_id_to_group_handles = defaultdict(list)
+    for handle, group in group_handle_to_group.items():
+        active_user_ids = []
+        for user_id in set(group.user_ids):
+            user = user_id_to_user.get(user_id)
+            if user is None:
+                continue
+            user_id_to_group_handles[user_id].append(handle)
+            if user.active:
+                active_user_ids.append(user_id)
+        active_user_ids.sort()
+        group_handle_to_active_user_ids[handle] = tuple(active_user_ids)
+    return group_handle_to_active_user_ids, {
+        user_id: tuple(handles) for user_id, handles in user_id_to_group_handles.items()
+    }
+
+
+def update_group_indexes(
+    snapshot: GroupsAndUsersSnapshot, group_handle_to_group: Dict[str, Group], user_id_to_user: Dict[str, User]
+) -> Tuple[Dict[str, Tuple[str, ...]], Dict[str, Tuple[str, ...]]]:
+    """
+    Returns the same as build_group_indexes, but indexes again only groups that are not the
+    same objects as in `snapshot` or have a member who was added, removed or changed presence.
+    """
+    old_groups = snapshot.group_handle_to_group
+    old_users = snapshot.user_id_to_user
+    stale_handles = {handle for handle, group in group_handle_to_group.items() if old_groups.get(handle) is not group}
+    if len(stale_handles) == len(group_handle_to_group):
+        return build_group_indexes(group_handle_to_group, user_id_to_user)
+    added_user_ids = user_id_to_user.keys() - old_users.keys()
+    changed_user_ids = added_user_ids | (old_users.keys() - user_id_to_user.keys())
+    for user_id, user in user_id_to_user.items():
+        old_user = old_users.get(user_id)
+        if old_user is not None and old_user.active != user.active:
+            changed_user_ids.add(user_id)
+    for user_id in changed_user_ids:
+        stale_handles.update(snapshot.user_id_to_group_handles.get(user_id, ()))
+    if added_user_ids:
+        # users unknown until now are not in the index, but groups may already list them
+        for handle, group in group_handle_to_group.items():
+            if handle not in stale_handles and not added_user_ids.isdisjoint(group.user_ids):
+                stale_handles.add(handle)
+    removed_handles = old_groups.keys() - group_handle_to_group.keys()
+    stale_handles -= removed_handles
+    stale_active_user_ids, stale_user_id_to_group_handles = build_group_indexes(
+        {handle: group_handle_to_group[handle] for handle in stale_handles}, user_id_to_user
+    )
+    group_handle_to_active_user_ids = {
+        handle: stale_active_user_ids[handle]
+        if handle in stale_handles
+        else snapshot.group_handle_to_active_user_ids[handle]
+        for handle in group_handle_to_group
+    }
+    # members of stale and removed groups, before and after, get their groups again
+    reindexed_user_ids = changed_user_ids | stale_user_id_to_group_handles.keys()
+    for handle in stale_handles | removed_handles:
+        old_group = old_groups.get(handle)
+        if old_group is not None:
+            reindexed_user_ids.update(old_group.user_ids)
+    position = {handle: i for i, handle in enumerate(group_handle_to_group)}
+    user_id_to_group_handles = dict(snapshot.user_id_to_group_handles)
+    for user_id in reindexed_user_ids:
+        handles = [
+            handle
+            for handle in user_id_to_group_handles.get(user_id, ())
+            if handle in position and handle not in stale_handles
+        ]
+        handles.extend(stale_user_id_to_group_handles.get(user_id, ()))
+        if handles and user_id in user_id_to_user:
+            handles.sort(key=position.__getitem__)
+            user_id_to_group_handles[user_id] = tuple(handles)
+        else:
+            user_id_to_group_handles.pop(user_id, None)
+    return group_handle_to_active_user_ids, user_id_to_group_handles
+
+
 class GroupsAndUsersThreadSafeDict:
+    """
+    Readers take the current snapshot without locking. Writers build a new snapshot
+    and publish it with a single reference assignment, which is atomic in CPython.
+    The lock only serializes writers.
+    """
+
     def __init__(self):
         self._lock = Lock()
-        self._group_handle_to_group: Dict[str, Group] = {}
-        self._user_id_to_user: Dict[str, User] = {}
+        self._snapshot: GroupsAndUsersSnapshot = EMPTY_SNAPSHOT
         self.bot_user: Optional[User] = None
+        self._group_request_counts: Counter = Counter()
+        self._group_request_counts_lock = Lock()
 
-    def update_groups_and_users(self, groups: List[Group], users: List[User]):
+    def get_snapshot(self) -> GroupsAndUsersSnapshot:
+        return self._snapshot
+
+    @contextmanager
+    def _write_lock(self):
+        start = time.perf_counter()
         with self._lock:
-            self._group_handle_to_group.clear()
-            for group in groups:
-                self._group_handle_to_group[group.handle] = group
+            metrics.observe("activeusers_groups_dict_lock_wait_seconds", time.perf_counter() - start)
+            yield
+
+    def update_groups_and_users(self, groups: List[Group], users: List[User]):
+        """
+        Groups that are the same objects as in the current snapshot keep their index entries,
+        unless a member was added, removed or changed presence.
+        """
+        group_handle_to_group = {group.handle: group for group in groups}
+        user_id_to_user = {user.id: user for user in users}
+        snapshot = self._snapshot
+        group_handle_to_active_user_ids, user_id_to_group_handles = update_group_indexes(
+            snapshot, group_handle_to_group, user_id_to_user
+        )
+        with self._write_lock():
+            if self._snapshot is not snapshot:
+                # another writer published meanwhile, the indexes may miss its changes
+                group_handle_to_active_user_ids, user_id_to_group_handles = update_group_indexes(
+                    self._snapshot, group_handle_to_group, user_id_to_user
+                )
+            self._snapshot = GroupsAndUsersSnapshot(
+                self._snapshot.version + 1,
+                MappingProxyType(group_handle_to_group),
+                MappingProxyType(user_id_to_user),
+                MappingProxyType(group_handle_to_active_user_ids),
+                MappingProxyType(user_id_to_group_handles),
+            )
 
-            self._user_id_to_user.clear()
-            for user in users:
-                self._user_id_to_user[user.id] = user
+    def set_user_presence(self, user_id: str, active: bool) -> bool:
+        """Returns True if the user is known and their presence changed."""
+        with self._write_lock():
+            user = self._snapshot.user_id_to_user.get(user_id)
+            if user is None or user.active == active:
+                return False
+            self._replace_users([replace(user, active=active)])
+            return True
+
+    def replace_users(self, users: List[User]):
+        """
+        Publishes new objects of known users, e.g. with changed presence, keeping groups.
+        Costs O(users and their groups) instead of rebuilding the indexes. Unknown users are ignored.
+        """
+        with self._write_lock():
+            self._replace_users(users)
+
+    def _replace_users(self, users: List[User]):
+        snapshot = self._snapshot
+        user_id_to_user = dict(snapshot.user_id_to_user)
+        # only groups of users whose presence changed need new active member lists
+        handle_to_active_user_ids = {}
+        for user in users:
+            old_user = user_id_to_user.get(user.id)
+            if old_user is None:
+                continue
+            user_id_to_user[user.id] = user
+            if old_user.active == user.active:
+                continue
+            for handle in snapshot.user_id_to_group_handles.get(user.id, ()):
+                active_user_ids = handle_to_active_user_ids.get(handle)
+                if active_user_ids is None:
+                    active_user_ids = handle_to_active_user_ids[handle] = list(
+                        snapshot.group_handle_to_active_user_ids[handle]
+                    )
+                if user.active:
+                    insort(active_user_ids, user.id)
+                else:
+                    active_user_ids.remove(user.id)
+        group_handle_to_active_user_ids = snapshot.group_handle_to_active_user_ids
+        if handle_to_active_user_ids:
+            group_handle_to_active_user_ids = dict(group_handle_to_active_user_ids)
+            for handle, active_user_ids in handle_to_active_user_ids.items():
+                group_handle_to_active_user_ids[handle] = tuple(active_user_ids)
+            group_handle_to_active_user_ids = MappingProxyType(group_handle_to_active_user_ids)
+        self._snapshot = GroupsAndUsersSnapshot(
+            snapshot.version + 1,
+            snapshot.group_handle_to_group,
+            MappingProxyType(user_id_to_user),
+            group_handle_to_active_user_ids,
+            snapshot.user_id_to_group_handles,
+        )
 
     def set_bot_user(self, user: User):
         self.bot_user = user
 
     def get_groups_and_users(self, group_names_with_limit):
         group_name_to_group_and_users = {}
-
-        with self._lock:
-            for group_name, _ in group_names_with_limit:
-                user_ids = set()
-                users = []
-                group = self._group_handle_to_group[group_name]
-                user_ids.update(group.user_ids)
-                for user_id in user_ids:
-                    user = self._user_id_to_user.get(user_id)
-                    if user_id is None:
-                        continue
-                    users.append(user)
-                group_name_to_group_and_users[group_name] = (group, users)
+        snapshot = self._snapshot
+        for group_name, _ in group_names_with_limit:
+            users = []
+            group = snapshot.group_handle_to_group[group_name]
+            for user_id in set(group.user_ids):
+                user = snapshot.user_id_to_user.get(user_id)
+                if user is None:
+                    continue
+                users.append(user)
+            group_name_to_group_and_users[group_name] = (group, users)
         return group_name_to_group_and_users
 
+    def get_active_users(
+        self,
+        group_name: str,
+        limit: Optional[int] = None,
+        exclude_user_id: Optional[str] = None,
+        snapshot: Optional[GroupsAndUsersSnapshot] = None,
+    ) -> List[User]:
+        """
+        Returns up to `limit` active members of the group, always in the same order.
+        Raises KeyError for unknown group.
+        """
+        if snapshot is None:
+            snapshot = self._snapshot
+        active_user_ids = snapshot.group_handle_to_active_user_ids[group_name]
+        users = []
+        for user_id in active_user_ids:
+            if limit is not None and len(users) >= limit:
+                break
+            if user_id != exclude_user_id:
+                users.append(snapshot.user_id_to_user[user_id])
+        return users
+
+    def record_group_requests(self, group_names):
+        with self._group_request_counts_lock:
+            self._group_request_counts.update(group_names)
+
+    def get_group_request_counts(self) -> Dict[str, int]:
+        """Total number of mentions of each group since start."""
+        with self._group_request_counts_lock:
+            return dict(self._group_request_counts)
+
     def get_groups_handles(self):
+        return list(self._snapshot.group_handle_to_group.keys())
+
+
+class ActiveUsersReplyCache:
+    """
+    Mentions of active group members for replies, e.g. "<@U1>, <@U2>", cached per
+    (group, limit, excluded user) until the groups dict publishes a new snapshot.
+    Concurrent requests for the same key share one lookup.
+    """
+
+    MAX_ENTRIES = 1024
+
+    def __init__(self, groups_dict: GroupsAndUsersThreadSafeDict, max_entries=MAX_ENTRIES):
+        self._groups_dict = groups_dict
+        self._max_entries = max_entries
+        self._lock = Lock()
+        self._version = 0
+        self._key_to_reply: Dict[Tuple[str, Optional[int], Optional[str]], Future] = {}
+
+    def get_mentions(self, group_name: str, limit: Optional[int] = None, exclude_user_id: Optional[str] = None) -> str:
+        """Returns mentions of active members, "" if there are none. Raises KeyError for unknown group."""
+        snapshot = self._groups_dict.get_snapshot()
+        if group_name not in snapshot.user_id_to_group_handles.get(exclude_user_id, ()):
+            exclude_user_id = None  # excluding a non-member gives the same reply, so share it
+        key = (group_name, limit, exclude_user_id)
+        owner = False
         with self._lock:
-            return list(self._group_handle_to_group.keys())
+            if snapshot.version > self._version:
+                self._version = snapshot.version
+                self._key_to_reply.clear()
+            if snapshot.version < self._version:
+                # published after this request started - answer it without touching the cache
+                future, owner, result = Future(), True, "miss"
+            else:
+                future = self._key_to_reply.get(key)
+                if future is not None:
+                    result = "hit" if future.done() else "coalesced"
+                else:
+                    if len(self._key_to_reply) >= self._max_entries:
+                        self._key_to_reply.clear()
+                    future = self._key_to_reply[key] = Future()
+                    owner, result = True, "miss"
+        metrics.inc("activeusers_reply_cache_total", result=result)
+        if owner:
+            try:
+                users = self._groups_dict.get_active_users(group_name, limit, exclude_user_id, snapshot=snapshot)
+                future.set_result(", ".join(f"<@{user.id}>" for user in users))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()